@@ -1,4 +1,4 @@
-from flask import Flask, render_template, request, redirect, url_for, session
+from flask import Flask, render_template, request, redirect, url_for, session, Response
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 from flask_wtf import FlaskForm
 from wtforms import StringField, FileField, TextAreaField
@@ -10,11 +10,24 @@ from uuid import uuid4
 import time
 from io import BytesIO
 import re
+import shlex
 import base64
 # import config 
 import subprocess
 import json
 import os
+import sys
+import threading
+import tempfile
+import queue
+import livefeed
+import enrollment
+import jobqueue
+import authsession
+
+# Modules shared with the Lambda functions
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lambda', 'common'))
+import resultcache
 
 
 
@@ -44,14 +57,69 @@ login_manager = LoginManager()
 login_manager.login_view = 'login'
 login_manager.init_app(application)
 
+
+def server_workers():
+    '''The number of gunicorn worker processes serving the app, from its command line,
+    GUNICORN_CMD_ARGS or WEB_CONCURRENCY. 1 when the app is not run by gunicorn.'''
+    if not os.path.basename(sys.argv[0]).startswith('gunicorn'):
+        return 1
+    # Command line options take precedence over GUNICORN_CMD_ARGS, which takes precedence over WEB_CONCURRENCY
+    args = shlex.split(os.environ.get('GUNICORN_CMD_ARGS', '')) + sys.argv[1:]
+    workers = os.environ.get('WEB_CONCURRENCY', 1)
+    for index, arg in enumerate(args):
+        if arg in ('-w', '--workers') and index + 1 < len(args):
+            workers = args[index + 1]
+        elif arg.startswith('--workers='):
+            workers = arg.split('=', 1)[1]
+        elif arg.startswith('-w') and arg[2:].isdigit():
+            workers = arg[2:]
+    return int(workers)
+
+# Background jobs, bulk enrollment progress and sessions in the memory store are kept in the process that
+# started them, so a request sent to another worker would not find them. This holds whatever the session store
+# is. Serve the app from one process with many threads, see the Procfile. server_workers() does not see a
+# "workers" setting in a gunicorn config file passed with -c; keep it at 1 there too.
+if server_workers() > 1:
+    raise ValueError("The app keeps background jobs in memory and must run in one process; "
+                     "start gunicorn with --workers 1 and more --threads instead.")
+
 # Configure Amazon Rekognition
 rekognition_client = boto3.client('rekognition', region_name="us-east-1")
 
 rekognition_collection_name = config['rekognition_col_name']
 
+# Live detection feed, see livefeed.py. Built on first use, one reader thread per process.
+live_feed_hub = None
+live_feed_lock = threading.Lock()
+
+# Bulk enrollment jobs by job id, see enrollment.py. Kept in memory, so a job is lost if the process restarts;
+# uploading the same manifest again skips everyone it already enrolled. Progress is only found in the process
+# running the job, which is why the Procfile serves the app from a single process.
+enrollment_jobs = {}
+enrollment_lock = threading.Lock()
+watchlist_enroller = None
+
+# Background jobs for enrolling and comparing faces, see jobqueue.py. Started on first use.
+job_queue = None
+job_queue_lock = threading.Lock()
+
+# Largest image Rekognition takes as Image.Bytes; larger ones are searched from S3
+MAX_IMAGE_BYTES = 5 * 1024 * 1024
+
 app_client_id = os.environ.get("APP_CLIENT_ID")
 user_pool_id = os.environ.get("USER_POOL_ID")
 
+# Results of recent compares, see resultcache.py. Keyed by the watchlist version, which is re-read every
+# watchlist_version_check_secs and set at once when this process enrolls someone.
+recognition_results = None
+recognition_results_lock = threading.Lock()
+watchlist_version = None
+watchlist_version_checked = 0.0
+
+# Login sessions, see authsession.py. The session cookie only holds the session id.
+login_sessions = None
+login_sessions_lock = threading.Lock()
+
 
 class SubmitForm(FlaskForm):
     name = StringField('Name', validators=[InputRequired()])
@@ -64,10 +132,35 @@ class CompareForm(FlaskForm):
 class User(UserMixin):
     pass
 
+def build_token_store():
+    ttl = config.get('session_ttl', 43200)
+    store = config.get('session_store', 'memory')
+    if store == 'redis':
+        return authsession.RedisTokenStore.from_url(config['session_redis_url'], ttl=ttl)
+    if store != 'memory':
+        raise ValueError('Unknown session_store {}; use "memory" or "redis".'.format(store))
+    return authsession.MemoryTokenStore(size=config.get('session_store_size', 10000), ttl=ttl)
+
+def sessions():
+    global login_sessions
+    with login_sessions_lock:
+        if login_sessions is None:
+            verifier = authsession.TokenVerifier("us-east-1", user_pool_id, app_client_id,
+                                                 jwks_ttl=config.get('jwks_cache_secs', 3600))
+            login_sessions = authsession.SessionManager(build_token_store(), verifier, client, user_pool_id,
+                                                        app_client_id,
+                                                        refresh_margin=config.get('session_refresh_margin', 300))
+        return login_sessions
+
 @login_manager.user_loader
-def user_loader(email):
+def user_loader(sid):
+    # Checks the session's access token locally; Cognito is only called when it needs refreshing
+    record = sessions().load(sid)
+    if record is None:
+        return None
     user = User()
-    user.id = email
+    user.id = sid
+    user.email = record['email']
     return user
 
 # Create Rekognition Face Collection if it doesn't exist
@@ -82,6 +175,142 @@ def create_rekognition_collection(collection_id):
 
 create_rekognition_collection(rekognition_collection_name)
 
+def build_enroller():
+    # Separate clients with adaptive retries and a connection per worker
+    workers = config.get('enrollment_workers', 8)
+    client_config = enrollment.client_config(max_pool_connections=workers + 2)
+    return enrollment.Enroller(
+        boto3.client('s3', region_name="us-east-1", config=client_config),
+        boto3.client('rekognition', region_name="us-east-1", config=client_config),
+        boto3.resource('dynamodb', region_name="us-east-1", config=client_config).Table(table_name),
+        s3_bucket_name,
+        rekognition_collection_name,
+        key_prefix=config.get('enrollment_key_prefix', 'watchlist/'),
+        max_workers=workers,
+        version_every_secs=config.get('enrollment_version_every_secs', 5),
+        index_faces_tps=config.get('enrollment_index_faces_tps', 50)
+    )
+
+def enroller():
+    global watchlist_enroller
+    with enrollment_lock:
+        if watchlist_enroller is None:
+            watchlist_enroller = build_enroller()
+        return watchlist_enroller
+
+def jobs():
+    global job_queue
+    with job_queue_lock:
+        if job_queue is None:
+            job_queue = jobqueue.JobQueue(
+                workers=config.get('job_workers', 8),
+                backend=jobqueue.LocalQueue(config.get('job_queue_size', 200)),
+                result_ttl=config.get('job_result_ttl', 300)
+            ).start()
+        return job_queue
+
+def recognition_cache():
+    global recognition_results
+    with recognition_results_lock:
+        if recognition_results is None:
+            hash_size = config.get('recognition_cache_hash_size', 16)
+            shared_table = config.get('ddb_recognition_cache_table')
+            recognition_results = resultcache.RecognitionCache(
+                resultcache.LocalResultStore(config.get('recognition_cache_size', 1024)),
+                resultcache.DynamoResultStore(dynamodb, shared_table, hash_bits=hash_size * hash_size)
+                if shared_table else None,
+                hash_mode=config.get('recognition_cache_hash', 'phash'),
+                hash_size=hash_size,
+                max_distance=config.get('recognition_cache_max_distance', 8),
+                ttl_secs=config.get('recognition_cache_ttl_secs', 300)
+            )
+        return recognition_results
+
+def current_watchlist_version():
+    global watchlist_version, watchlist_version_checked
+    with recognition_results_lock:
+        if time.time() - watchlist_version_checked < config.get('watchlist_version_check_secs', 30):
+            return watchlist_version
+    item = dynamodb.Table(table_name).get_item(Key={'ID': enrollment.WATCHLIST_VERSION_ID}).get('Item', {})
+    with recognition_results_lock:
+        watchlist_version = int(item.get('Version', 0))
+        watchlist_version_checked = time.time()
+        return watchlist_version
+
+def enroll_person(entry):
+    global watchlist_version, watchlist_version_checked
+    # Store the image in S3, index the face and save the entry to DynamoDB
+    status, unique_id = enroller().enroll(entry)
+    if status == enrollment.ENROLLED:
+        version = enrollment.bump_version(dynamodb.Table(table_name))
+        # Earlier compares may have missed this person; stop using them now
+        with recognition_results_lock:
+            watchlist_version = version
+            watchlist_version_checked = time.time()
+    return {'status': status, 'id': unique_id}
+
+def search_collection(image_bytes, extension):
+    if len(image_bytes) <= MAX_IMAGE_BYTES:
+        image = {'Bytes': image_bytes}
+    else:
+        image_key = f"{str(uuid4())}.{extension}"
+        s3_client.put_object(Bucket=s3_bucket_name, Key=image_key, Body=image_bytes)
+        image = {'S3Object': {'Bucket': s3_bucket_name, 'Name': image_key}}
+
+    # Search for faces in the Rekognition collection
+    return rekognition_client.search_faces_by_image(
+        CollectionId=rekognition_collection_name,
+        Image=image,
+    )
+
+def compare_face(image_bytes, extension):
+    # The same photo compared again, even re-encoded, reuses the earlier result
+    response = recognition_cache().search(image_bytes, rekognition_collection_name, 'compare',
+                                          current_watchlist_version(),
+                                          lambda: search_collection(image_bytes, extension))
+
+    if 'FaceMatches' in response and response['FaceMatches']:
+        best_match = max(response['FaceMatches'], key=lambda match: match['Similarity'])
+        return {'match': True, 'similarity': best_match['Similarity'], 'face_id': best_match['Face']['FaceId']}
+    return {'match': False}
+
+def run_enrollment_job(job_id, manifest_path, entries, progress):
+    try:
+        enroller().run(entries, progress=progress, report=lambda progress: print(f"Enrollment {job_id}: {progress}"))
+    except Exception as e:
+        print(e)
+        progress.errors.append({'image': None, 'error': str(e)})
+        progress.finished = time.time()
+    finally:
+        os.remove(manifest_path)
+
+
+def frame_event(item):
+    '''What the live feed sends for a new EnrichedFrame item: the item and a pre-signed URL of its image.'''
+    event = dict(item)
+    event['s3_presigned_url'] = s3_client.generate_presigned_url(
+        ClientMethod='get_object',
+        Params={'Bucket': item['s3_bucket'], 'Key': item['s3_key']},
+        ExpiresIn=config.get('live_feed_url_expiry', 1800)
+    )
+    return event
+
+def build_live_feed_tailer():
+    if config.get('live_feed_source', 'dynamodb-stream') == 'local':
+        return livefeed.LocalTailer()
+    # The EnrichedFrame table streams new images of its items, see aws-infra/main.tf
+    stream_arn = dynamodb.meta.client.describe_table(
+        TableName=config.get('ddb_frame_table', 'EnrichedFrame'))['Table']['LatestStreamArn']
+    return livefeed.DynamoStreamTailer(boto3.client('dynamodbstreams', region_name="us-east-1"), stream_arn)
+
+def live_feed():
+    global live_feed_hub
+    with live_feed_lock:
+        if live_feed_hub is None:
+            live_feed_hub = livefeed.FeedHub(build_live_feed_tailer(), transform=frame_event,
+                                             history=config.get('live_feed_history', 500)).start()
+        return live_feed_hub
+
 
 @application.route('/')
 def home():
@@ -133,8 +362,12 @@ def login():
                 }
             )
 
+            if 'AuthenticationResult' not in auth_response:
+                return "Additional sign-in steps are required for this account."
+
             user = User()
-            user.id = email
+            user.id = sessions().create(email, auth_response['AuthenticationResult'])
+            user.email = email
             login_user(user)
 
             return redirect(url_for('submit'))
@@ -144,6 +377,8 @@ def login():
             return "Incorrect username or password."
         except NoCredentialsError:
             return "AWS credentials not found."
+        except authsession.TokenError as e:
+            return f"Could not verify the sign-in: {str(e)}"
 
     return render_template('login.html')
 
@@ -168,43 +403,13 @@ def submit():
             image = form.image.data
             image_filename = f"{str(uuid4())}.{image.filename.split('.')[-1]}"
 
+        image_bytes = image.read()
+        entry = enrollment.Entry(image_filename, name, message, lambda: image_bytes)
         try:
-            # Save image to S3
-            unique_id = int(time.time())
-            image_filename = f"{str(uuid4())}.{image.filename.split('.')[-1]}"
-            image_key = f"{image_filename}"
-            s3_client.upload_fileobj(image, s3_bucket_name, image_key)
-            image_url = f"https://{s3_bucket_name}.s3.amazonaws.com/{image_key}"
-
-            # Save data to DynamoDB
-            table = dynamodb.Table(table_name)
-            table.put_item(
-                Item={
-                    'ID': unique_id,
-                    'Name': name,
-                    'Message': message,
-                    'ImageURL': image_url,
-                }
-            )
-
-            # Index faces in the Rekognition Face Collection
-            response = rekognition_client.index_faces(
-                CollectionId=rekognition_collection_name,
-                Image={
-                    'S3Object': {
-                        'Bucket': s3_bucket_name,
-                        'Name': image_key,
-                    },
-                },
-                ExternalImageId=str(unique_id),
-                MaxFaces=1,
-                DetectionAttributes=['ALL'],
-            )
-
-            return redirect(url_for('home'))
-        except Exception as e:
-            print(e)
-            return render_template('submit.html', form=form, error=f"Error during submission: {str(e)}")
+            job = jobs().submit('submit', current_user.get_id(), enroll_person, entry)
+        except queue.Full:
+            return render_template('submit.html', form=form, error="The server is busy, please try again in a minute."), 503
+        return render_template('job.html', job_id=job.id)
 
     return render_template('submit.html', form=form)
 
@@ -216,44 +421,135 @@ def compare():
     if form.validate_on_submit():
         image_to_compare = form.image_to_compare.data
 
+        # Rekognition gets the image bytes directly, without a copy in S3
+        image_bytes = image_to_compare.read()
+        extension = image_to_compare.filename.split('.')[-1]
         try:
-            # Save image to S3
-            unique_id = int(time.time())
-            image_filename = f"{str(uuid4())}.{image_to_compare.filename.split('.')[-1]}"
-            image_key = f"{image_filename}"
-            s3_client.upload_fileobj(image_to_compare, s3_bucket_name, image_key)
-
-            # Search for faces in the Rekognition collection
-            response = rekognition_client.search_faces_by_image(
-                CollectionId=rekognition_collection_name,
-                Image={
-                    'S3Object': {
-                        'Bucket': s3_bucket_name,
-                        'Name': image_key,
-                    },
-                },
-            )
+            job = jobs().submit('compare', current_user.get_id(), compare_face, image_bytes, extension)
+        except queue.Full:
+            return render_template('result.html', error="The server is busy, please try again in a minute."), 503
+        return render_template('job.html', job_id=job.id)
 
-            # Process the response
-            if 'FaceMatches' in response and response['FaceMatches']:
-                best_match = max(response['FaceMatches'], key=lambda match: match['Similarity'])
-                similarity = best_match['Similarity']
-                face_id = best_match['Face']['FaceId']
-                return render_template('result.html', match=True, similarity=similarity, face_id=face_id)
-            else:
-                return render_template('result.html', match=False)
+    return render_template('compare.html', form=form)   
 
-        except ClientError as e:
-           
-            return render_template('result.html', error=f"Error during face comparison: {str(e)}")
 
-    return render_template('compare.html', form=form)   
 
+@application.route('/jobs/<job_id>')
+@login_required
+def job_status(job_id):
+    '''Status of a submit or compare job as JSON.'''
+    job = jobs().get(job_id, current_user.get_id())
+    if job is None:
+        return Response(json.dumps({'error': 'No such job.'}), status=404, mimetype='application/json')
+    return Response(json.dumps(job.status()), mimetype='application/json', headers={'Cache-Control': 'no-cache'})
+
+@application.route('/jobs/<job_id>/result')
+@login_required
+def job_result(job_id):
+    '''The page a finished submit or compare job leads to.'''
+    job = jobs().get(job_id, current_user.get_id())
+    if job is None:
+        return redirect(url_for('home'))
+    if job.state in (jobqueue.QUEUED, jobqueue.RUNNING):
+        return render_template('job.html', job_id=job.id)
+
+    if job.kind == 'compare':
+        if job.state == jobqueue.FAILED:
+            return render_template('result.html', error=f"Error during face comparison: {job.error}")
+        return render_template('result.html', **job.result)
+
+    if job.state == jobqueue.FAILED:
+        return render_template('submit.html', form=SubmitForm(), error=f"Error during submission: {job.error}")
+    if job.result['status'] == enrollment.SKIPPED:
+        return render_template('submit.html', form=SubmitForm(), error=f"This photo is already enrolled as ID {job.result['id']}.")
+    return redirect(url_for('home'))
+
+
+@application.route('/enroll/bulk', methods=['GET', 'POST'])
+@login_required
+def enroll_bulk():
+    '''Starts enrolling everyone in an uploaded ZIP or CSV manifest, see enrollment.py.'''
+    if request.method == 'GET':
+        return render_template('enroll.html')
+
+    manifest = request.files.get('manifest')
+    if manifest is None or not manifest.filename:
+        return render_template('enroll.html', error="Choose a ZIP or CSV manifest to upload.")
+    handle, manifest_path = tempfile.mkstemp(suffix=os.path.splitext(manifest.filename)[1])
+    os.close(handle)
+    manifest.save(manifest_path)
+    try:
+        # Uploaded CSV manifests may only point at S3, not at files on this server
+        entries = enrollment.read_manifest(manifest_path, s3_client, allow_files=False)
+    except Exception as e:
+        os.remove(manifest_path)
+        return render_template('enroll.html', error=f"Could not read the manifest: {str(e)}")
+
+    job_id = str(uuid4())
+    progress = enrollment.Progress(len(entries))
+    with enrollment_lock:
+        enrollment_jobs[job_id] = progress
+    worker = threading.Thread(target=run_enrollment_job, args=(job_id, manifest_path, entries, progress))
+    worker.daemon = True
+    worker.start()
+    return render_template('enroll.html', job_id=job_id, total=len(entries))
+
+@application.route('/enroll/bulk/<job_id>')
+@login_required
+def enroll_bulk_status(job_id):
+    '''Progress of a bulk enrollment job as JSON.'''
+    with enrollment_lock:
+        progress = enrollment_jobs.get(job_id)
+    if progress is None:
+        return Response(json.dumps({'error': 'No such job.'}), status=404, mimetype='application/json')
+    return Response(json.dumps(dict(progress.snapshot(), job_id=job_id)), mimetype='application/json',
+                    headers={'Cache-Control': 'no-cache'})
+
+
+@application.route('/live')
+@login_required
+def live():
+    return render_template('live.html')
+
+@application.route('/live/events')
+@login_required
+def live_events():
+    '''Server-sent events: one event per new detection, as JSON.'''
+    hub = live_feed()
+    if hub.client_count() >= config.get('live_feed_max_streams', 50):
+        # Each stream holds a server thread; the browser falls back to /live/poll
+        return Response('Too many live streams.', status=503, headers={'Retry-After': '10'})
+    # Browsers send the id of the last event they got when they reconnect
+    last_id = request.headers.get('Last-Event-ID') or request.args.get('after')
+    last_id = int(last_id) if last_id and last_id.isdigit() else hub.last_id()
+    stream = livefeed.sse_stream(hub, last_id, stream_secs=config.get('live_feed_stream_secs', 300))
+    return Response(stream, mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@application.route('/live/poll')
+@login_required
+def live_poll():
+    '''Long polling: waits up to timeout seconds (at most 30) for detections after the given event id.'''
+    hub = live_feed()
+    after = request.args.get('after', '')
+    after = int(after) if after.isdigit() else hub.last_id()
+    try:
+        timeout = min(float(request.args.get('timeout', 25)), 30.0)
+    except ValueError:
+        timeout = 25.0
+    events, gap = hub.events_after(after, timeout)
+    # Payloads are JSON already, serialized once for all clients
+    body = '{{"events": [{}], "last_id": {}, "gap": {}}}'.format(
+        ', '.join('{{"id": {}, "frame": {}}}'.format(event_id, payload) for event_id, payload in events),
+        events[-1][0] if events else after,
+        'true' if gap else 'false')
+    return Response(body, mimetype='application/json', headers={'Cache-Control': 'no-cache'})
 
 
 @application.route('/logout')
 @login_required
 def logout():
+    sessions().destroy(current_user.get_id())
     logout_user()
     return redirect(url_for('login'))
 
@@ -0,0 +1,284 @@
+'''Login sessions backed by Cognito tokens kept on the server.
+
+Logging in stores the tokens Cognito returns in a token store under a random
+session id. Only that id goes into the browser's session cookie. On each
+request the session's access token is checked locally against the user
+pool's signing keys (JWKS), which are fetched once and cached. So Cognito
+is only called to log in and to refresh tokens that are about to expire.
+Signatures are checked with the cryptography package.
+
+Token stores have three methods: get(sid), put(sid, record) and delete(sid).
+MemoryTokenStore keeps records in the web server process, which suits a
+single instance. RedisTokenStore shares them between processes and
+instances through Redis, or through any client with the same get, setex and
+delete methods.'''
+import base64
+import collections
+import json
+import os
+import threading
+import time
+import urllib.request
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+try:
+    from cryptography.exceptions import InvalidSignature
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric import padding, rsa
+except ImportError:
+    rsa = None
+
+
+class TokenError(Exception):
+    '''A token that is malformed, badly signed, expired or meant for another app.'''
+
+
+def b64url_decode(text):
+    if isinstance(text, str):
+        text = text.encode('ascii')
+    return base64.urlsafe_b64decode(text + b'=' * (-len(text) % 4))
+
+
+def b64url_int(text):
+    return int.from_bytes(b64url_decode(text), 'big')
+
+
+def rsa_public_key(jwk):
+    '''The public key of an RSA JSON Web Key.'''
+    return rsa.RSAPublicNumbers(b64url_int(jwk['e']), b64url_int(jwk['n'])).public_key(default_backend())
+
+
+def rs256_verify(public_key, message, signature):
+    '''Checks an RSASSA-PKCS1-v1_5 SHA-256 signature.'''
+    try:
+        public_key.verify(signature, message, padding.PKCS1v15(), hashes.SHA256())
+        return True
+    except InvalidSignature:
+        return False
+
+
+def fetch_jwks(url):
+    with urllib.request.urlopen(url, timeout=5) as response:
+        return json.loads(response.read().decode('utf-8'))
+
+
+class TokenVerifier(object):
+    '''Verifies Cognito access tokens of one user pool and app client without calling Cognito.
+
+    The pool's JWKS is fetched on first use and kept for jwks_ttl seconds. A
+    token signed with a key that is not in it makes the verifier fetch it
+    again, at most once per refetch_secs, so rotated keys are picked up.'''
+
+    def __init__(self, region, user_pool_id, app_client_id, jwks_ttl=3600, refetch_secs=60, leeway=5,
+                 fetch=fetch_jwks):
+        if rsa is None:
+            raise ValueError('Verifying Cognito tokens needs the cryptography package, which is not installed.')
+        self.issuer = 'https://cognito-idp.{}.amazonaws.com/{}'.format(region, user_pool_id)
+        self.app_client_id = app_client_id
+        self.jwks_ttl = jwks_ttl
+        self.refetch_secs = refetch_secs
+        self.leeway = leeway
+        self.fetch = fetch
+        self._keys = {}
+        self._fetched = None
+        self._lock = threading.Lock()
+        self.stats = {'verified': 0, 'rejected': 0, 'jwks_fetches': 0}
+
+    def _key(self, kid, now):
+        with self._lock:
+            age = now - self._fetched if self._fetched is not None else None
+            if age is None or age >= self.jwks_ttl or (kid not in self._keys and age >= self.refetch_secs):
+                jwks = self.fetch(self.issuer + '/.well-known/jwks.json')
+                self.stats['jwks_fetches'] += 1
+                self._keys = dict((key['kid'], rsa_public_key(key))
+                                  for key in jwks['keys'] if key.get('kty') == 'RSA')
+                self._fetched = now
+            return self._keys.get(kid)
+
+    def _reject(self, reason):
+        self.stats['rejected'] += 1
+        raise TokenError(reason)
+
+    def verify(self, token, now=None):
+        '''The claims of a valid access token. Raises TokenError otherwise.'''
+        now = now or time.time()
+        try:
+            header_part, claims_part, signature_part = token.split('.')
+            header = json.loads(b64url_decode(header_part))
+            claims = json.loads(b64url_decode(claims_part))
+            signature = b64url_decode(signature_part)
+        except (ValueError, AttributeError):
+            self._reject('Malformed token')
+        if header.get('alg') != 'RS256':
+            self._reject('Unexpected token algorithm {}'.format(header.get('alg')))
+        key = self._key(header.get('kid'), now)
+        if key is None:
+            self._reject('Token signed with unknown key {}'.format(header.get('kid')))
+        if not rs256_verify(key, (header_part + '.' + claims_part).encode('ascii'), signature):
+            self._reject('Bad token signature')
+        if claims.get('iss') != self.issuer:
+            self._reject('Token from another user pool')
+        if claims.get('token_use') != 'access' or claims.get('client_id') != self.app_client_id:
+            self._reject('Not an access token of this app')
+        if claims.get('exp', 0) + self.leeway < now:
+            self._reject('Token expired')
+        self.stats['verified'] += 1
+        return claims
+
+
+class MemoryTokenStore(object):
+    '''In-process LRU token store. Records are dropped ttl seconds after they are put,
+    and the least recently used go first once there are more than size.'''
+
+    def __init__(self, size=10000, ttl=43200):
+        self.size = size
+        self.ttl = ttl
+        self._records = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, sid):
+        with self._lock:
+            entry = self._records.get(sid)
+            if entry is None:
+                return None
+            if entry[0] <= time.time():
+                del self._records[sid]
+                return None
+            self._records.move_to_end(sid)
+            return dict(entry[1])
+
+    def put(self, sid, record):
+        with self._lock:
+            self._records[sid] = (time.time() + self.ttl, dict(record))
+            self._records.move_to_end(sid)
+            while len(self._records) > self.size:
+                self._records.popitem(last=False)
+
+    def delete(self, sid):
+        with self._lock:
+            self._records.pop(sid, None)
+
+
+class RedisTokenStore(object):
+    '''Token store in Redis; records expire ttl seconds after they are put.'''
+
+    def __init__(self, client, ttl=43200, prefix='session:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        if redis is None:
+            raise ValueError('The redis package is needed for a Redis session store.')
+        return cls(redis.Redis.from_url(url), **kwargs)
+
+    def get(self, sid):
+        value = self.client.get(self.prefix + sid)
+        return json.loads(value) if value is not None else None
+
+    def put(self, sid, record):
+        self.client.setex(self.prefix + sid, self.ttl, json.dumps(record))
+
+    def delete(self, sid):
+        self.client.delete(self.prefix + sid)
+
+
+class SessionManager(object):
+    '''Creates, loads and ends login sessions.
+
+    load() verifies the session's access token on every call and refreshes
+    the tokens with the refresh token when they expire within refresh_margin
+    seconds. Concurrent requests of one session refresh only once.'''
+
+    def __init__(self, store, verifier, cognito_client, user_pool_id, app_client_id, refresh_margin=300):
+        self.store = store
+        self.verifier = verifier
+        self.cognito_client = cognito_client
+        self.user_pool_id = user_pool_id
+        self.app_client_id = app_client_id
+        self.refresh_margin = refresh_margin
+        self._refreshing = {}
+        self._lock = threading.Lock()
+        self.stats = {'created': 0, 'loaded': 0, 'missing': 0, 'refreshed': 0, 'invalid': 0}
+
+    def _record(self, email, result, refresh_token):
+        claims = self.verifier.verify(result['AccessToken'])
+        return {
+            'email': email,
+            'sub': claims.get('sub'),
+            'access_token': result['AccessToken'],
+            'id_token': result.get('IdToken'),
+            'refresh_token': refresh_token,
+            'expires_at': claims['exp']
+        }
+
+    def create(self, email, result):
+        '''Starts a session from the AuthenticationResult of a login and returns its id.'''
+        sid = base64.urlsafe_b64encode(os.urandom(24)).decode('ascii')
+        self.store.put(sid, self._record(email, result, result.get('RefreshToken')))
+        self.stats['created'] += 1
+        return sid
+
+    def _refresh(self, sid, record):
+        #One lock per session, kept while any request waits on it, so a request arriving
+        #meanwhile queues behind the same refresh instead of starting its own
+        with self._lock:
+            entry = self._refreshing.get(sid)
+            if entry is None:
+                entry = self._refreshing[sid] = [threading.Lock(), 0]
+            entry[1] += 1
+        try:
+            with entry[0]:
+                #Another request may have refreshed the session while this one waited
+                current = self.store.get(sid)
+                if current is None or current['expires_at'] - time.time() > self.refresh_margin:
+                    return current
+                response = self.cognito_client.admin_initiate_auth(
+                    UserPoolId=self.user_pool_id,
+                    ClientId=self.app_client_id,
+                    AuthFlow='REFRESH_TOKEN_AUTH',
+                    AuthParameters={'REFRESH_TOKEN': current['refresh_token']}
+                )
+                #Cognito only sends a new refresh token when the pool rotates them
+                result = response['AuthenticationResult']
+                refreshed = self._record(current['email'], result,
+                                         result.get('RefreshToken') or current['refresh_token'])
+                self.store.put(sid, refreshed)
+                self.stats['refreshed'] += 1
+                return refreshed
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._refreshing[sid]
+
+    def load(self, sid):
+        '''The session record, or None when the session does not exist or can no longer be used.'''
+        record = self.store.get(sid) if sid else None
+        if record is None:
+            self.stats['missing'] += 1
+            return None
+        try:
+            if record['expires_at'] - time.time() <= self.refresh_margin:
+                record = self._refresh(sid, record)
+                if record is None:
+                    self.stats['missing'] += 1
+                    return None
+            self.verifier.verify(record['access_token'])
+        except Exception as e:
+            #A revoked refresh token or a forged record ends the session
+            print('Session ended: {}'.format(e))
+            self.stats['invalid'] += 1
+            self.store.delete(sid)
+            return None
+        self.stats['loaded'] += 1
+        return record
+
+    def destroy(self, sid):
+        self.store.delete(sid)
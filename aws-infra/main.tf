@@ -227,6 +227,8 @@ resource "aws_iam_policy" "image_processor_policy" {
         Effect = "Allow",
         Action = [
           "dynamodb:GetItem",
+          "dynamodb:BatchGetItem",
+          "dynamodb:BatchWriteItem",
           "dynamodb:Query",
           "dynamodb:PutItem",
           "dynamodb:UpdateItem",
@@ -356,6 +358,11 @@ resource "aws_iam_policy" "frame_fetcher_policy" {
           "${aws_s3_bucket.frame_s3_bucket.arn}/*",
         ],
       },
+      {
+        Effect = "Allow",
+        Action = "ssm:GetParameter",
+        Resource = "arn:aws:ssm:${data.aws_region.current.name}:${data.aws_caller_identity.current.account_id}:parameter/framefetcher/*",
+      },
     ],
   })
 }
@@ -419,6 +426,7 @@ resource "aws_lambda_event_source_mapping" "event_source_mapping" {
   event_source_arn = aws_kinesis_stream.frame_stream.arn
   function_name    = aws_lambda_function.image_processor_lambda.arn
   starting_position = "TRIM_HORIZON"
+  function_response_types = ["ReportBatchItemFailures"]
   depends_on = [ 
     aws_kinesis_stream.frame_stream,
     aws_lambda_function.image_processor_lambda,
@@ -448,6 +456,10 @@ resource "aws_dynamodb_table" "enriched_frame" {
   write_capacity = 10
   
   hash_key = "frame_id"
+
+  # Read by the web app's live detection feed
+  stream_enabled   = true
+  stream_view_type = "NEW_IMAGE"
   
   attribute {
     name = "frame_id"
@@ -488,6 +500,40 @@ resource "aws_dynamodb_table" "felon_images_metadata"{
 
 }
 
+resource "aws_dynamodb_table" "alert_dedup" {
+    name = var.ddb_alert_dedup_table_name
+    billing_mode = "PAY_PER_REQUEST"
+
+    hash_key = "dedup_key"
+
+    attribute {
+      name = "dedup_key"
+      type = "S"
+    }
+
+    ttl {
+      attribute_name = "expires_at"
+      enabled        = true
+    }
+}
+
+resource "aws_dynamodb_table" "recognition_cache" {
+    name = var.ddb_recognition_cache_table_name
+    billing_mode = "PAY_PER_REQUEST"
+
+    hash_key = "cache_key"
+
+    attribute {
+      name = "cache_key"
+      type = "S"
+    }
+
+    ttl {
+      attribute_name = "expires_at"
+      enabled        = true
+    }
+}
+
 resource "aws_api_gateway_rest_api" "vid_analyzer_rest_api" {
   name        = var.api_gateway_rest_api_name
   description = "The amazon rekognition video analyzer public API"
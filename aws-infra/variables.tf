@@ -26,6 +26,14 @@ variable "ddb_table_name" {
     type = string
     default = "EnrichedFrame"
 }
+variable "ddb_alert_dedup_table_name" {
+    type = string
+    default = "AlertDedup"
+}
+variable "ddb_recognition_cache_table_name" {
+    type = string
+    default = "RecognitionCache"
+}
 variable "ddb_global_secondary_index_name" {
     type = string
     default = "processed_year_month-processed_timestamp-index"
@@ -0,0 +1,126 @@
+'''Times frame archiving in Image Processor and counts the S3 PUTs it saves.
+
+Feeds batches of frames from a mostly static camera through
+imageprocessor.handler against stubbed S3 and Rekognition with simulated
+latency. Most frames show the same scene with a little sensor noise, so they
+differ byte for byte but not perceptually. Compares uploading before the face
+search (how Image Processor used to work) with background uploads, content and
+perceptual dedup, and storing only frames with matches.
+
+Usage: python benchmarks/archive.py [batches] [records_per_batch] [changed_fraction]'''
+from __future__ import print_function
+import base64
+import io
+import os
+import random
+import sys
+import time
+
+import numpy as np
+from PIL import Image
+
+import localaws
+
+localaws.use_fake_credentials()
+localaws.use_lambda_path('imageprocessor')
+
+import archive
+import frameformat
+import warmruntime
+import imageprocessor
+
+
+class SerialArchiver(archive.FrameArchiver):
+    '''Waits for every upload before returning, like the original inline put_object.'''
+
+    def archive(self, image_bytes, camera_id, s3_key, now=None):
+        s3_key = archive.FrameArchiver.archive(self, image_bytes, camera_id, s3_key, now)
+        self.wait()
+        return s3_key
+
+
+def jpeg(pixels):
+    output = io.BytesIO()
+    Image.fromarray(pixels).save(output, format='JPEG', quality=85)
+    return output.getvalue()
+
+
+def camera_frames(count, changed_fraction):
+    '''JPEG frames of a static scene with noise; changed_fraction of them show a new scene.'''
+    rng = np.random.RandomState(7)
+    scene = rng.randint(0, 255, (240, 320, 3)).astype(np.uint8)
+    scene = np.array(Image.fromarray(scene).resize((32, 24)).resize((320, 240), Image.BILINEAR))
+    frames = []
+    for _ in range(count):
+        if rng.rand() < changed_fraction:
+            scene = np.roll(scene, rng.randint(20, 100), axis=1)
+        noise = rng.randint(-3, 4, scene.shape)
+        frames.append(jpeg(np.clip(scene.astype(int) + noise, 0, 255).astype(np.uint8)))
+    return frames
+
+
+def event_for(frames):
+    event = localaws.kinesis_event(len(frames))
+    for frame_count, (record, image_bytes) in enumerate(zip(event['Records'], frames)):
+        data = frameformat.encode_frame(image_bytes, time.time(), frame_count, 'camera-0')
+        record['kinesis']['data'] = base64.b64encode(data).decode('ascii')
+    return event
+
+
+def run(name, overrides, events, matched_fraction, serial=False):
+    warmruntime.reset()
+    config = dict(warmruntime.load_config('imageprocessor-params.json'))
+    config.update(overrides)
+    warmruntime.set_config('imageprocessor-params.json', config)
+
+    def search(request):
+        if random.random() < matched_fraction:
+            return localaws.face_match_response()
+        return {'FaceMatches': []}
+
+    responder = localaws.StubResponder(
+        {'rekognition.SearchFacesByImage': search},
+        latency={'s3.PutObject': 0.030, 'rekognition.SearchFacesByImage': 0.060, '*': 0.005})
+    responder.install(warmruntime.session())
+    if serial:
+        ctx = imageprocessor.build_context()
+        ctx['archiver'] = SerialArchiver(ctx['archiver'].s3_client, config['s3_bucket'], dedup_window_secs=0)
+        warmruntime.cached('imageprocessor.context', lambda: ctx)
+
+    sys.stdout, real_stdout = open(os.devnull, 'w'), sys.stdout
+    start = time.perf_counter()
+    try:
+        for event in events:
+            imageprocessor.handler(event, None)
+    finally:
+        sys.stdout = real_stdout
+    elapsed = time.perf_counter() - start
+
+    records = sum(len(event['Records']) for event in events)
+    print('%-26s %7.1f ms per record   %4d PutObject for %d frames' % (
+        name, elapsed * 1000 / records, responder.calls.get('s3.PutObject', 0), records))
+
+
+def main():
+    batches = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    records = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    changed_fraction = float(sys.argv[3]) if len(sys.argv) > 3 else 0.1
+    matched_fraction = 0.05
+
+    os.chdir(localaws.CONFIG_DIR)
+    random.seed(7)
+    frames = camera_frames(batches * records, changed_fraction)
+    events = [event_for(frames[i:i + records]) for i in range(0, len(frames), records)]
+    # One record at a time, so per-record latency is not hidden by the worker pool.
+    base = {'max_concurrency': 1, 'archive_matches_only': False}
+
+    run('upload before search', base, events, matched_fraction, serial=True)
+    run('background upload', dict(base, archive_dedup_window_secs=0), events, matched_fraction)
+    run('content dedup', dict(base, archive_dedup_hash='content'), events, matched_fraction)
+    run('perceptual dedup', dict(base, archive_dedup_hash='perceptual'), events, matched_fraction)
+    run('matches only', dict(base, archive_matches_only=True, archive_dedup_window_secs=0), events,
+        matched_fraction)
+
+
+if __name__ == '__main__':
+    main()
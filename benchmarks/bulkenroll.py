@@ -0,0 +1,129 @@
+'''Throughput of bulk watchlist enrollment against local stand-ins.
+
+Enrolls a ZIP of --people generated photos through enrollment.Enroller, with
+S3 and Rekognition answered by StubResponder and a local watchlist table:
+
+single - One person at a time.
+unpaced, paced - The bulk pipeline with 4, 8 and 16 workers.
+twice - Every photo submitted twice at once: each is still indexed only once.
+resumed - A run stopped halfway and started again with its journal.
+rerun - The whole manifest again without a journal: everyone is skipped after
+    one conditional PutItem each.
+
+Rekognition allows --tps IndexFaces calls per second; calls over that are
+throttled and retried. The bulk runs are shown without and with the Enroller
+pacing its IndexFaces calls to that rate. Also checks that every person got
+their own ID.
+
+Usage: python benchmarks/bulkenroll.py [--people N] [--tps N] [--latency MS]'''
+from __future__ import print_function
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+import zipfile
+
+import localaws
+
+localaws.use_fake_credentials()
+localaws.use_app_path()
+
+import boto3
+
+import enrollment
+
+
+def make_manifest(directory, people):
+    path = os.path.join(directory, 'people.zip')
+    with zipfile.ZipFile(path, 'w') as archive:
+        for i in range(people):
+            archive.writestr('person_%05d.jpg' % i, b'\xff\xd8' + os.urandom(20000))
+    return path
+
+
+class RateLimit(object):
+    '''Answers IndexFaces, throttling calls past tps in any one second.'''
+
+    def __init__(self, tps):
+        self.tps = tps
+        self.second = 0
+        self.count = 0
+        self.throttled = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, request):
+        with self._lock:
+            second = int(time.time())
+            if second != self.second:
+                self.second, self.count = second, 0
+            self.count += 1
+            if self.tps and self.count > self.tps:
+                self.throttled += 1
+                return localaws.ErrorResponse('ThrottlingException', 'Rate exceeded')
+        external_image_id = json.loads(request.body)['ExternalImageId']
+        return {'FaceRecords': [{'Face': {'FaceId': str(uuid.uuid4()), 'ExternalImageId': external_image_id}}]}
+
+
+def build_enroller(args, table, workers, paced):
+    session = boto3.session.Session()
+    limit = RateLimit(args.tps)
+    responder = localaws.StubResponder({'rekognition.IndexFaces': limit, 's3.PutObject': b''},
+                                       latency={'*': args.latency / 1000.0})
+    responder.install(session)
+    config = enrollment.client_config(max_pool_connections=workers + 2)
+    enroller = enrollment.Enroller(session.client('s3', config=config), session.client('rekognition', config=config),
+                                   table, 'local-bucket', 'felon_images', max_workers=workers,
+                                   index_faces_tps=args.tps if paced else None)
+    return enroller, responder, limit
+
+
+def run(name, args, entries, workers, paced=True, table=None, journal=None):
+    table = table or localaws.LocalDynamoTable('felon_images_metadata', ['ID'], latency=args.latency / 1000.0)
+    enroller, responder, limit = build_enroller(args, table, workers, paced)
+    progress = enroller.run(entries, journal_path=journal)
+    state = progress.snapshot()
+    print('%-10s %3d workers  %6.1f people/s  enrolled %4d  skipped %4d  failed %3d  IndexFaces %4d (throttled %4d)'
+          '  PutItem %4d  version bumps %4d' % (
+              name, workers, state['images_per_sec'], state['enrolled'], state['skipped'], state['failed'],
+              responder.calls.get('rekognition.IndexFaces', 0), limit.throttled, table.calls.get('PutItem', 0),
+              table.calls.get('UpdateItem', 0)))
+    return table
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Bulk enrollment benchmark.')
+    parser.add_argument('--people', type=int, default=200)
+    parser.add_argument('--tps', type=int, default=50, help='IndexFaces calls per second before throttling, 0 for none.')
+    parser.add_argument('--latency', type=float, default=30.0, help='Simulated latency of every AWS request, ms.')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        entries = enrollment.read_manifest(make_manifest(directory, args.people))
+        run('single', args, entries, 1)
+        for workers in (4, 8, 16):
+            run('unpaced', args, entries, workers, paced=False)
+            table = run('paced', args, entries, workers)
+        people = [item for key, item in table.items.items() if key != (enrollment.WATCHLIST_VERSION_ID,)]
+        print('%d people, %d distinct IDs' % (len(entries), len(set(item['ID'] for item in people))))
+
+        twice = [entry for pair in zip(entries, entries) for entry in pair]
+        table = run('twice', args, twice, 8)
+        people = [item for key, item in table.items.items() if key != (enrollment.WATCHLIST_VERSION_ID,)]
+        print('%d photos submitted twice, %d people with a FaceId' % (
+            len(entries), sum(1 for item in people if item.get('FaceId'))))
+
+        journal = os.path.join(directory, 'people.zip.journal')
+        table = run('stopped', args, entries[:len(entries) // 2], 8, journal=journal)
+        run('resumed', args, entries, 8, table=table, journal=journal)
+        run('rerun', args, entries, 8, table=table)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+'''Compares cold and warm Lambda invocations against locally stubbed AWS clients.
+
+Usage: python benchmarks/coldstart.py [invocations] [records_per_batch]'''
+from __future__ import print_function
+import os
+import statistics
+import sys
+import time
+
+import localaws
+
+localaws.use_fake_credentials()
+localaws.use_lambda_path('imageprocessor', 'framefetcher')
+
+import warmruntime
+import imageprocessor
+import framefetcher
+
+
+def stubbed_session():
+    responder = localaws.StubResponder({
+        'rekognition.SearchFacesByImage': localaws.face_match_response(),
+        'dynamodb.GetItem': localaws.watchlist_item_response(),
+        'dynamodb.Query': {'Items': [], 'Count': 0, 'ScannedCount': 0}
+    })
+    responder.install(warmruntime.session())
+    return responder
+
+
+def time_invocations(fn, event, invocations, cold):
+    timings = []
+    if not cold:
+        # Prime the container once; only the invocations after it are timed.
+        warmruntime.reset()
+        stubbed_session()
+        fn(event, None)
+    for _ in range(invocations):
+        if cold:
+            warmruntime.reset()
+            stubbed_session()
+        start = time.perf_counter()
+        fn(event, None)
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def report(name, timings):
+    print('%-32s mean %8.2f ms   median %8.2f ms   max %8.2f ms' % (
+        name, statistics.mean(timings), statistics.median(timings), max(timings)))
+
+
+def main():
+    invocations = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    records = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+    os.chdir(localaws.CONFIG_DIR)
+    ip_event = localaws.kinesis_event(records)
+    ff_event = {'httpMethod': 'GET'}
+
+    sys.stdout, real_stdout = open(os.devnull, 'w'), sys.stdout
+    try:
+        results = [
+            ('imageprocessor cold', time_invocations(imageprocessor.handler, ip_event, invocations, True)),
+            ('imageprocessor warm', time_invocations(imageprocessor.handler, ip_event, invocations, False)),
+            ('framefetcher cold', time_invocations(framefetcher.handler, ff_event, invocations, True)),
+            ('framefetcher warm', time_invocations(framefetcher.handler, ff_event, invocations, False)),
+        ]
+    finally:
+        sys.stdout = real_stdout
+
+    print('%d invocations, %d records per imageprocessor batch' % (invocations, records))
+    for name, timings in results:
+        report(name, timings)
+
+
+if __name__ == '__main__':
+    main()
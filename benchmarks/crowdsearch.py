@@ -0,0 +1,185 @@
+'''Watchlist matches found on crowded frames with each face search mode.
+
+Feeds frames showing up to --max-people people through imageprocessor.handler
+against a stubbed Rekognition. DetectFaces reports every face of a frame.
+SearchFacesByImage, like the real service, only looks at the largest face of
+what it is sent, matches it when that person is on the watchlist, and rejects
+images without a face. Half of the people are on the watchlist.
+
+largest - one SearchFacesByImage call per frame, as Image Processor always did.
+all - one DetectFaces call, then one search per face crop (face_search_mode "all").
+
+Reports watchlist people matched out of those in the frames, Rekognition calls,
+time per frame and failed records. Without a face to search, SearchFacesByImage
+rejects the whole frame, which then goes to the dead-letter store.
+
+Usage: python benchmarks/crowdsearch.py [--frames N] [--max-people N] [--latency MS]'''
+from __future__ import print_function
+import argparse
+import base64
+import hashlib
+import io
+import json
+import os
+import sys
+import time
+
+import numpy as np
+from PIL import Image
+
+import localaws
+
+localaws.use_fake_credentials()
+localaws.use_lambda_path('imageprocessor')
+
+import frameformat
+import imageprocessor
+import warmruntime
+
+WIDTH, HEIGHT = 640, 480
+FACE_WIDTH, FACE_HEIGHT = 60, 72
+PEOPLE = 8
+# Each person's face is drawn in its own color, so a crop tells who is in it
+COLORS = [(40 + 25 * person, 200 - 20 * person, 60 + 15 * person) for person in range(PEOPLE)]
+
+
+def jpeg(pixels):
+    output = io.BytesIO()
+    Image.fromarray(pixels).save(output, format='JPEG', quality=85)
+    return output.getvalue()
+
+
+def crowd_frames(rng, count, max_people):
+    '''(jpeg, faces) frames, faces being (person, left, top, width, height) with the largest first.'''
+    background = rng.randint(0, 255, (HEIGHT, WIDTH, 3)).astype(np.uint8)
+    background = np.array(Image.fromarray(background).resize((32, 24)).resize((WIDTH, HEIGHT), Image.BILINEAR))
+    frames = []
+    for _ in range(count):
+        pixels = background.copy()
+        people = rng.choice(PEOPLE, rng.randint(0, max_people + 1), replace=False)
+        faces = []
+        for slot, person in enumerate(people):
+            scale = rng.uniform(0.6, 1.4)
+            width, height = int(FACE_WIDTH * scale), int(FACE_HEIGHT * scale)
+            left = 20 + (slot % 4) * 150 + rng.randint(0, 20)
+            top = 40 + (slot // 4) * 200 + rng.randint(0, 20)
+            pixels[top:top + height, left:left + width] = COLORS[person]
+            pixels[top + height // 4:top + height // 3, left + width // 5:left + width * 4 // 5] = 30
+            faces.append((int(person), left, top, width, height))
+        faces.sort(key=lambda face: face[3] * face[4], reverse=True)
+        frames.append((jpeg(pixels), faces))
+    return frames
+
+
+def person_in(image_bytes):
+    '''The person whose face is at the center of a crop.'''
+    image = np.array(Image.open(io.BytesIO(image_bytes)).convert('RGB')).astype(int)
+    height, width = image.shape[:2]
+    color = image[height // 2 + 2:height // 2 + 8, width // 2 - 3:width // 2 + 3].reshape(-1, 3).mean(axis=0)
+    return int(np.argmin([np.abs(color - np.array(candidate)).sum() for candidate in COLORS]))
+
+
+class LocalRekognition(object):
+    '''Answers DetectFaces and SearchFacesByImage from the frames' known faces.'''
+
+    def __init__(self, frames, enrolled):
+        self.faces = dict((hashlib.sha1(image_bytes).digest(), faces) for image_bytes, faces in frames)
+        self.enrolled = enrolled
+
+    def image(self, request):
+        return base64.b64decode(json.loads(request.body)['Image']['Bytes'])
+
+    def detect_faces(self, request):
+        faces = self.faces[hashlib.sha1(self.image(request)).digest()]
+        return {'FaceDetails': [{
+            'BoundingBox': {'Left': left / float(WIDTH), 'Top': top / float(HEIGHT),
+                            'Width': width / float(WIDTH), 'Height': height / float(HEIGHT)},
+            'Confidence': 99.9
+        } for _, left, top, width, height in faces]}
+
+    def search_faces_by_image(self, request):
+        image_bytes = self.image(request)
+        faces = self.faces.get(hashlib.sha1(image_bytes).digest())
+        if faces is not None and not faces:
+            return localaws.ErrorResponse('InvalidParameterException', 'There are no faces in the image.')
+        person = faces[0][0] if faces is not None else person_in(image_bytes)
+        if person not in self.enrolled:
+            return {'FaceMatches': []}
+        return localaws.face_match_response(str(person + 1))
+
+
+def event_for(frames):
+    event = localaws.kinesis_event(len(frames))
+    for frame_count, (record, (image_bytes, _)) in enumerate(zip(event['Records'], frames)):
+        data = frameformat.encode_frame(image_bytes, time.time(), frame_count, 'camera-0')
+        record['kinesis']['data'] = base64.b64encode(data).decode('ascii')
+    return event
+
+
+def run(name, args, frames, events, enrolled, overrides):
+    warmruntime.reset()
+    config = dict(warmruntime.load_config('imageprocessor-params.json'))
+    config.update(overrides)
+    warmruntime.set_config('imageprocessor-params.json', config)
+
+    rekognition = LocalRekognition(frames, enrolled)
+    latency = args.latency / 1000.0
+    responder = localaws.StubResponder(
+        {'rekognition.DetectFaces': rekognition.detect_faces,
+         'rekognition.SearchFacesByImage': rekognition.search_faces_by_image},
+        latency={'rekognition.DetectFaces': latency, 'rekognition.SearchFacesByImage': latency, '*': 0.002})
+    responder.install(warmruntime.session())
+
+    found = {}
+    sys.stdout, real_stdout = open(os.devnull, 'w'), sys.stdout
+    try:
+        ctx = warmruntime.cached('imageprocessor.context', imageprocessor.build_context)
+        search = ctx['faces'].search
+
+        def recorded_search(image_bytes):
+            response = search(image_bytes)
+            found[hashlib.sha1(image_bytes).digest()] = set(
+                int(match['Face']['ExternalImageId']) - 1 for match in response['FaceMatches'])
+            return response
+        ctx['faces'].search = recorded_search
+
+        start = time.perf_counter()
+        failed = sum(len(imageprocessor.handler(event, None)['batchItemFailures']) for event in events)
+        elapsed = time.perf_counter() - start
+    finally:
+        sys.stdout = real_stdout
+
+    present = matched = 0
+    for image_bytes, faces in frames:
+        wanted = set(person for person, _, _, _, _ in faces if person in enrolled)
+        present += len(wanted)
+        matched += len(wanted & found.get(hashlib.sha1(image_bytes).digest(), set()))
+    print('%-8s %4d frames  matched %4d of %4d watchlist faces (%3.0f%%)  DetectFaces %4d  '
+          'SearchFacesByImage %4d  %6.1f ms per frame  failed %3d' % (
+              name, len(frames), matched, present, 100.0 * matched / max(1, present),
+              responder.calls.get('rekognition.DetectFaces', 0),
+              responder.calls.get('rekognition.SearchFacesByImage', 0),
+              elapsed * 1000 / len(frames), ctx['dead_letters'].stats['records'] + failed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Crowded frame face search benchmark.')
+    parser.add_argument('--frames', type=int, default=200)
+    parser.add_argument('--batch', type=int, default=20, help='Records per Kinesis batch.')
+    parser.add_argument('--max-people', type=int, default=6)
+    parser.add_argument('--latency', type=float, default=100.0, help='Simulated Rekognition latency, ms.')
+    args = parser.parse_args()
+
+    os.chdir(localaws.CONFIG_DIR)
+    rng = np.random.RandomState(11)
+    frames = crowd_frames(rng, args.frames, args.max_people)
+    events = [event_for(frames[i:i + args.batch]) for i in range(0, len(frames), args.batch)]
+    enrolled = set(range(0, PEOPLE, 2))
+
+    base = {'max_concurrency': 8, 'archive_matches_only': True, 'recognition_cache_ttl_secs': 0}
+    run('largest', args, frames, events, enrolled, dict(base, face_search_mode='largest'))
+    run('all', args, frames, events, enrolled, dict(base, face_search_mode='all'))
+
+
+if __name__ == '__main__':
+    main()
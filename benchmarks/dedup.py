@@ -0,0 +1,66 @@
+'''Checks and times alert deduplication across concurrent Lambda containers.
+
+Simulates several containers, each with its own AlertDeduplicator and worker
+threads, sharing one local DynamoDB table. Every container sees the same
+people on the same cameras over a simulated span of time. With a correct
+deduplicator exactly one alert fires per person, camera and cooldown window.
+
+Usage: python benchmarks/dedup.py [containers] [threads] [people] [cameras]'''
+from __future__ import print_function
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import localaws
+
+localaws.use_lambda_path('imageprocessor')
+
+import dedup
+
+
+def main():
+    containers = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    people = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+    cameras = int(sys.argv[4]) if len(sys.argv) > 4 else 3
+    cooldown = 600
+    windows = 3
+    sightings_per_window = 10
+
+    table = localaws.LocalDynamoTable('AlertDedup', ['dedup_key'], latency=0.002)
+    deduplicators = [dedup.AlertDeduplicator(table, cooldown_secs=cooldown) for _ in range(containers)]
+
+    start_ts = 1700000000
+    sightings = []
+    for window in range(windows):
+        for sighting in range(sightings_per_window):
+            now = start_ts + window * (cooldown + 1) + sighting
+            for container in range(containers):
+                for person in range(people):
+                    for camera in range(cameras):
+                        sightings.append((container, str(person), 'camera-%d' % camera, now))
+
+    def claim(sighting):
+        container, person, camera, now = sighting
+        return deduplicators[container].claim(person, camera, now)
+
+    start = time.perf_counter()
+    alerts = 0
+    for window in range(windows):
+        # Windows run one after another; sightings within a window race each other.
+        per_window = len(sightings) // windows
+        batch = sightings[window * per_window:(window + 1) * per_window]
+        with ThreadPoolExecutor(max_workers=containers * threads) as executor:
+            alerts += sum(1 for claimed in executor.map(claim, batch) if claimed)
+    elapsed = time.perf_counter() - start
+
+    expected = people * cameras * windows
+    print('%d containers x %d threads, %d sightings in %.2f s (%.0f claims/s)' % (
+        containers, threads, len(sightings), elapsed, len(sightings) / elapsed))
+    print('alerts fired %d, expected %d -> %s' % (alerts, expected, 'OK' if alerts == expected else 'MISMATCH'))
+    print('DynamoDB calls: %s (%.1f%% of sightings)' % (
+        table.calls, 100.0 * sum(table.calls.values()) / len(sightings)))
+
+
+if __name__ == '__main__':
+    main()
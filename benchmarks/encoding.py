@@ -0,0 +1,109 @@
+'''Bytes per frame, encode time and match quality of the video capture encoding profiles.
+
+Encodes the given images or video frames with every profile in
+client/encoding.py. Without inputs it synthesizes 1920x1080 frames. Match
+quality is reported as the PSNR of the decoded JPEG against the original
+(scaled to the same size). With --collection, each encoded frame is also sent
+to Rekognition search_faces_by_image on that collection. The top match
+similarity is reported next to the one for the original frame. This needs AWS
+credentials, and inputs that show enrolled faces.
+
+Usage: python benchmarks/encoding.py [--collection NAME] [--frames N] [image or video ...]'''
+from __future__ import print_function
+import argparse
+import statistics
+import time
+
+import localaws
+
+localaws.use_client_path()
+
+import cv2
+import numpy
+
+import encoding
+
+
+def synthesize(count):
+    rng = numpy.random.RandomState(5)
+    frames = []
+    for _ in range(count):
+        texture = rng.randint(0, 256, (54, 96, 3)).astype(numpy.uint8)
+        frame = cv2.resize(texture, (1920, 1080), interpolation=cv2.INTER_CUBIC)
+        noise = rng.randint(-4, 5, frame.shape)
+        frames.append(numpy.clip(frame.astype(numpy.int16) + noise, 0, 255).astype(numpy.uint8))
+    return frames
+
+
+def read_inputs(paths, count):
+    frames = []
+    for path in paths:
+        image = cv2.imread(path)
+        if image is not None:
+            frames.append(image)
+            continue
+        cap = cv2.VideoCapture(path)
+        while len(frames) < count:
+            ok, frame = cap.read()
+            if not ok:
+                break
+            frames.append(frame)
+        cap.release()
+    return frames[:count]
+
+
+def psnr(original, buff, profile):
+    decoded = cv2.imdecode(buff, cv2.IMREAD_UNCHANGED)
+    reference = profile.prepare(original)
+    if decoded.shape != reference.shape:
+        return float('nan')
+    return cv2.PSNR(reference, decoded)
+
+
+def top_similarity(rekognition, collection, image_bytes):
+    try:
+        response = rekognition.search_faces_by_image(
+            CollectionId=collection, FaceMatchThreshold=40, Image={'Bytes': image_bytes})
+    except Exception as e:
+        print('  search_faces_by_image failed: {}'.format(e))
+        return 0.0
+    return max([match['Similarity'] for match in response.get('FaceMatches', [])] or [0.0])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Encoding profile benchmark.')
+    parser.add_argument('inputs', nargs='*', help='Images or videos. Default: synthetic 1080p frames.')
+    parser.add_argument('--frames', type=int, default=20)
+    parser.add_argument('--collection', help='Rekognition collection to search, e.g. felon_images.')
+    args = parser.parse_args()
+
+    frames = read_inputs(args.inputs, args.frames) if args.inputs else synthesize(args.frames)
+    if not frames:
+        parser.error('No frames could be read.')
+
+    rekognition = None
+    if args.collection:
+        import boto3
+        rekognition = boto3.client('rekognition')
+
+    encoding.face_detector()  # Load the cascade before timing
+    for name in sorted(encoding.PROFILES, key=lambda name: name != 'original'):
+        profile = encoding.PROFILES[name]
+        sizes, timings, qualities, similarities = [], [], [], []
+        for frame in frames:
+            start = time.perf_counter()
+            buff = profile.encode(frame)
+            timings.append((time.perf_counter() - start) * 1000)
+            sizes.append(len(buff))
+            qualities.append(psnr(frame, buff, profile))
+            if rekognition is not None:
+                similarities.append(top_similarity(rekognition, args.collection, buff.tobytes()))
+        line = '%-9s %8.1f KB/frame  %6.2f ms/frame  PSNR %5.1f dB' % (
+            name, statistics.mean(sizes) / 1024.0, statistics.mean(timings), statistics.mean(qualities))
+        if similarities:
+            line += '  similarity %5.1f (lowest %5.1f)' % (statistics.mean(similarities), min(similarities))
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+'''Recall and speed of the local face pre-matcher used by the watchlist pre-filter.
+
+Recall is measured against Rekognition's answers: the share of frames in which
+Rekognition found a watchlist face that the pre-matcher also passes on to it.
+Give a labels CSV (frame path, ExternalImageId Rekognition matched or empty)
+and the enrollment images (ExternalImageId, image path) to measure real
+footage. Without them, synthetic face crops are used: each enrolled "face" is
+a smooth random texture, and frames show an enrolled face under different
+light and noise, or a stranger. Synthetic frames skip face detection, so they
+measure the embedding and index only: their recall says nothing about real
+faces, and neither embedder is validated by it. Measure recall on labeled
+footage, with --embedder sface --model <onnx> for the default client embedder.
+
+Also times batch scoring against an index of --index-size faces, memory-mapped
+from disk and loaded into memory.
+
+Usage: python benchmarks/facematch.py [--labels CSV --enrolled CSV] [--embedder pixels|sface --model ONNX]
+       [--threshold T] [--index-size N]'''
+from __future__ import print_function
+import argparse
+import csv
+import os
+import tempfile
+import time
+
+import localaws
+
+localaws.use_client_path()
+
+import cv2
+import numpy
+
+import facematch
+import prefilter
+
+
+class WholeFrame(object):
+    '''Detector for frames that are already face crops.'''
+
+    def detect(self, frame):
+        return [(0, 0, frame.shape[1], frame.shape[0])]
+
+
+def synthetic_faces(count, rng):
+    faces = []
+    for _ in range(count):
+        texture = rng.randint(0, 256, (12, 12)).astype(numpy.uint8)
+        faces.append(cv2.resize(texture, (96, 96), interpolation=cv2.INTER_CUBIC))
+    return faces
+
+
+def synthetic_frames(enrolled, strangers, count, rng):
+    '''(frame, ExternalImageId Rekognition would match or None) pairs.'''
+    frames = []
+    for i in range(count):
+        if i % 2 == 0:
+            index = rng.randint(len(enrolled))
+            face, label = enrolled[index], str(index)
+        else:
+            face, label = strangers[rng.randint(len(strangers))], None
+        gain, offset = rng.uniform(0.7, 1.3), rng.uniform(-30, 30)
+        noisy = face.astype(numpy.float32) * gain + offset + rng.normal(0, 8, face.shape)
+        shift = rng.randint(-3, 4, 2)
+        noisy = numpy.roll(noisy, tuple(shift), axis=(0, 1))
+        frames.append((numpy.clip(noisy, 0, 255).astype(numpy.uint8), label))
+    return frames
+
+
+def read_image(path):
+    image = cv2.imread(path)
+    if image is None:
+        raise ValueError('Could not read image "{}".'.format(path))
+    return image
+
+
+def labeled_data(labels_path, enrolled_path):
+    detector = prefilter.FaceFilter(width=640)
+    faces = []
+    with open(enrolled_path) as enrolled_file:
+        for external_image_id, path in csv.reader(enrolled_file):
+            image = read_image(path)
+            boxes = detector.detect(image)
+            if boxes:
+                faces.append((external_image_id, facematch.crop_face(image, max(boxes, key=lambda b: b[2] * b[3]))))
+    with open(labels_path) as labels_file:
+        frames = [(read_image(path), label or None) for path, label in csv.reader(labels_file)]
+    return faces, frames, detector
+
+
+def report_recall(matcher, frames, batch_size=16):
+    start = time.perf_counter()
+    results = []
+    for i in range(0, len(frames), batch_size):
+        results.extend(matcher.match_batch([frame for frame, _ in frames[i:i + batch_size]]))
+    elapsed = time.perf_counter() - start
+
+    matched = [label for _, label in frames if label is not None]
+    found = sum(1 for (_, label), candidates in zip(frames, results)
+                if label is not None and any(external_image_id == label for external_image_id, _ in candidates))
+    passed = sum(1 for candidates in results if candidates)
+    print('threshold %.2f: recall %.3f (%d of %d Rekognition matches), %d of %d frames sent to Rekognition, %.0f frames/s' % (
+        matcher.threshold, found / float(len(matched)) if matched else 0.0, found, len(matched),
+        passed, len(frames), len(frames) / elapsed))
+
+
+def time_scoring(index_size, dim, queries, rng):
+    index = facematch.FaceIndex(
+        [str(i) for i in range(index_size)],
+        facematch.normalize(rng.normal(size=(index_size, dim)).astype(numpy.float32)), 'pixels')
+    query_rows = facematch.normalize(rng.normal(size=(queries, dim)).astype(numpy.float32))
+    path = os.path.join(tempfile.mkdtemp(), 'faceindex')
+    index.save(path)
+
+    for name, loaded in (('memory-mapped', facematch.FaceIndex.load(path)),
+                         ('in memory', facematch.FaceIndex.load(path, mmap=False))):
+        start = time.perf_counter()
+        for row in query_rows:
+            loaded.best(row[numpy.newaxis, :])
+        one_by_one = time.perf_counter() - start
+        start = time.perf_counter()
+        loaded.best(query_rows)
+        batched = time.perf_counter() - start
+        print('%d faces, %s: %.0f queries/s one at a time, %.0f queries/s in one batch of %d' % (
+            index_size, name, queries / one_by_one, queries / batched, queries))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local face pre-matcher benchmark.')
+    parser.add_argument('--labels', help='CSV of frame path, ExternalImageId Rekognition matched (or empty).')
+    parser.add_argument('--enrolled', help='CSV of ExternalImageId, enrollment image path.')
+    parser.add_argument('--threshold', type=float, action='append', dest='thresholds',
+                        help='Similarity threshold; repeat to compare several. Default: 0.3, 0.5, 0.7.')
+    parser.add_argument('--embedder', default='pixels', help='Face embedding, pixels or sface. Default: %(default)s.')
+    parser.add_argument('--model', help='ONNX model file for the sface embedder.')
+    parser.add_argument('--index-size', type=int, default=10000)
+    args = parser.parse_args()
+
+    rng = numpy.random.RandomState(3)
+    embedder = facematch.build_embedder(args.embedder, args.model)
+    if args.labels and args.enrolled:
+        faces, frames, detector = labeled_data(args.labels, args.enrolled)
+    else:
+        enrolled = synthetic_faces(20, rng)
+        faces = [(str(i), face) for i, face in enumerate(enrolled)]
+        frames = synthetic_frames(enrolled, synthetic_faces(200, rng), 1000, rng)
+        detector = WholeFrame()
+        print('Synthetic crops with face detection skipped: recall below is not recall on real faces. '
+              'Pass --labels and --enrolled to measure it.')
+
+    index = facematch.FaceIndex.build(faces, embedder)
+    for threshold in args.thresholds or [0.3, 0.5, 0.7]:
+        report_recall(facematch.PreMatcher(detector, embedder, index, threshold=threshold), frames)
+    time_scoring(args.index_size, embedder.dim, 256, rng)
+
+
+if __name__ == '__main__':
+    main()
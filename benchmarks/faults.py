@@ -0,0 +1,101 @@
+'''Runs Image Processor batches against a Rekognition stand-in that throttles and fails.
+
+Rekognition throttles a share of calls whenever more than --tps calls arrive
+in a second, and rejects some frames as invalid images. Reports how many
+records were processed, dead-lettered and handed back to Lambda as
+batchItemFailures, how often calls were throttled, and the request rate the
+caller settled at. With --dead-letter-down the dead-letter store fails as
+well, so failed records must be reported back to Lambda.
+
+Usage: python benchmarks/faults.py [--batches N] [--records N] [--tps N] [--invalid F] [--dead-letter-down]'''
+from __future__ import print_function
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+
+import localaws
+
+localaws.use_fake_credentials()
+localaws.use_lambda_path('imageprocessor')
+
+import warmruntime
+import imageprocessor
+
+
+class ThrottlingRekognition(object):
+    '''Answers SearchFacesByImage, throttling calls beyond tps per second.'''
+
+    def __init__(self, tps, invalid_fraction):
+        self.tps = tps
+        self.invalid_fraction = invalid_fraction
+        self.calls = []
+        self.throttled = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, request):
+        now = time.time()
+        with self._lock:
+            self.calls = [ts for ts in self.calls if ts > now - 1.0]
+            if len(self.calls) >= self.tps:
+                self.throttled += 1
+                return localaws.ErrorResponse('ThrottlingException', 'Rate exceeded')
+            self.calls.append(now)
+        if random.random() < self.invalid_fraction:
+            return localaws.ErrorResponse('InvalidImageFormatException', 'Request has invalid image format')
+        return localaws.face_match_response() if random.random() < 0.1 else {'FaceMatches': []}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Image Processor fault handling benchmark.')
+    parser.add_argument('--batches', type=int, default=5)
+    parser.add_argument('--records', type=int, default=40)
+    parser.add_argument('--tps', type=int, default=20, help='Rekognition calls per second before it throttles.')
+    parser.add_argument('--invalid', type=float, default=0.02, help='Share of frames Rekognition rejects.')
+    parser.add_argument('--dead-letter-down', action='store_true')
+    args = parser.parse_args()
+
+    os.chdir(localaws.CONFIG_DIR)
+    random.seed(11)
+    config = dict(warmruntime.load_config('imageprocessor-params.json'))
+    # The caller starts at twice the real quota, to show it backing off.
+    config.update({'rekognition_tps': args.tps * 2, 'rekognition_acquire_timeout_secs': 30})
+    warmruntime.set_config('imageprocessor-params.json', config)
+
+    rekognition = ThrottlingRekognition(args.tps, args.invalid)
+
+    def dead_letter_put(request):
+        if args.dead_letter_down and 'deadletter/' in request.url:
+            return localaws.ErrorResponse('ServiceUnavailable', 'Stubbed outage', status=503)
+        return b''
+
+    responder = localaws.StubResponder(
+        {'rekognition.SearchFacesByImage': rekognition, 's3.PutObject': dead_letter_put},
+        latency={'rekognition.SearchFacesByImage': 0.05, '*': 0.005})
+    responder.install(warmruntime.session())
+
+    processed = reported = 0
+    sys.stdout, real_stdout = open(os.devnull, 'w'), sys.stdout
+    start = time.perf_counter()
+    try:
+        for _ in range(args.batches):
+            event = localaws.kinesis_event(args.records)
+            response = imageprocessor.handler(event, None)
+            reported += len(response['batchItemFailures'])
+            processed += len(event['Records'])
+    finally:
+        sys.stdout = real_stdout
+    elapsed = time.perf_counter() - start
+
+    ctx = warmruntime.cached('imageprocessor.context', imageprocessor.build_context)
+    dead_letters = ctx['dead_letters'].stats if ctx['dead_letters'] else {}
+    print('%d records in %.1f s (%.1f records/s)' % (processed, elapsed, processed / elapsed))
+    print('dead-lettered %d, reported as batchItemFailures %d' % (dead_letters.get('records', 0), reported))
+    print('Rekognition stand-in throttled %d calls; caller stats %s, settled at %.1f TPS (quota %d)' % (
+        rekognition.throttled, ctx['rekognition'].stats, ctx['rekognition'].current_tps(), args.tps))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+'''A dashboard polling Frame Fetcher while few new frames arrive, with and without caching.
+
+Simulates --duration seconds of a dashboard that asks for the newest --limit
+frames every --interval seconds, while a new frame is stored every --arrival
+seconds. The clock is simulated, so the run takes only as long as the
+handler does. With caching on, the dashboard sends If-None-Match with its last
+ETag, as a browser would. Reports Lambda time, DynamoDB queries and items
+read, 304 responses and bytes returned. It also checks that every new frame
+appears within result_cache_ttl_secs of being stored.
+
+Usage: python benchmarks/fetchcache.py [--duration S] [--interval S] [--arrival S] [--limit N] [--latency MS]'''
+from __future__ import print_function
+import argparse
+import json
+import os
+import sys
+import time
+import uuid
+from decimal import Decimal
+
+import localaws
+
+localaws.use_fake_credentials()
+localaws.use_lambda_path('framefetcher')
+
+import warmruntime
+import framefetcher
+import framequery
+
+GSI = 'processed_year_month-processed_timestamp-index'
+
+
+class Clock(object):
+    '''Stands in for the time module in framefetcher.'''
+
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+def store_frame(table, ts):
+    frame_id = str(uuid.uuid4())
+    table.items[(frame_id,)] = {
+        'frame_id': frame_id,
+        'processed_timestamp': Decimal(str(ts)),
+        'approx_capture_timestamp': Decimal(str(ts - 1)),
+        'processed_year_month': framequery.month_of(ts),
+        's3_bucket': 'local-bucket',
+        's3_key': 'frames/2026/10/18/09/%s.jpg' % frame_id,
+        'camera_id': 'camera-0'
+    }
+    return frame_id
+
+
+def run(args, cached):
+    start_ts = time.time()
+    clock = Clock(start_ts)
+    framefetcher.time = clock
+    table = localaws.LocalDynamoTable('EnrichedFrame', ['frame_id'], latency=args.latency / 1000.0,
+                                      indexes={GSI: ('processed_year_month', 'processed_timestamp')})
+    for i in range(args.limit * 2):
+        store_frame(table, start_ts - 600 + i)
+
+    warmruntime.reset()
+    config = dict(warmruntime.load_config('framefetcher-params.json'))
+    if not cached:
+        config.update(result_cache_ttl_secs=0, result_cache_size=0, serialized_frame_cache_size=0)
+    warmruntime.set_config('framefetcher-params.json', config)
+    warmruntime.cached('framefetcher.table', lambda: table)
+    ttl = float(config.get('result_cache_ttl_secs', 2))
+
+    etag, pending, stored_at = None, None, start_ts
+    requests = not_modified = sent = late = 0
+    worst = 0.0
+    lambda_secs = 0.0
+    next_arrival = start_ts + args.arrival
+    sys.stdout, real_stdout = open(os.devnull, 'w'), sys.stdout
+    try:
+        while clock.now < start_ts + args.duration:
+            if clock.now >= next_arrival:
+                pending, stored_at = store_frame(table, clock.now), clock.now
+                next_arrival += args.arrival
+            event = {'httpMethod': 'GET', 'queryStringParameters': {'limit': str(args.limit)},
+                     'headers': {'If-None-Match': etag} if cached and etag else None}
+            begin = time.perf_counter()
+            response = framefetcher.handler(event, None)
+            lambda_secs += time.perf_counter() - begin
+            requests += 1
+            sent += len(response['body'])
+            if response['statusCode'] == '304':
+                not_modified += 1
+            else:
+                etag = response['headers'].get('ETag')
+                frames = json.loads(response['body'])
+                shown = frames[0]['frame_id'] if frames else None
+            if pending is not None and shown == pending:
+                #How long the dashboard took to show the new frame
+                worst = max(worst, clock.now - stored_at)
+                if clock.now - stored_at > ttl:
+                    late += 1
+                pending = None
+            clock.now += args.interval
+    finally:
+        sys.stdout = real_stdout
+        framefetcher.time = time
+
+    print('%-11s %5d requests  %6.2f ms/request  %4d queries  %6d items read  %4d not modified  %7.1f KB sent  '
+          'new frames shown within %.1f s%s' % (
+              'cache on' if cached else 'cache off', requests, lambda_secs / requests * 1000,
+              table.calls.get('Query', 0), table.items_read, not_modified, sent / 1024.0, worst,
+              '' if not late else ' (%d frames later than the TTL)' % late))
+    return late == 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Frame Fetcher result cache benchmark.')
+    parser.add_argument('--duration', type=float, default=600, help='Simulated seconds of polling.')
+    parser.add_argument('--interval', type=float, default=1.0, help='Seconds between polls.')
+    parser.add_argument('--arrival', type=float, default=30.0, help='Seconds between new frames.')
+    parser.add_argument('--limit', type=int, default=100)
+    parser.add_argument('--latency', type=float, default=0.0, help='Simulated DynamoDB latency, ms.')
+    args = parser.parse_args()
+
+    os.chdir(localaws.CONFIG_DIR)
+    ok = run(args, cached=False)
+    ok &= run(args, cached=True)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
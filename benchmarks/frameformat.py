@@ -0,0 +1,83 @@
+'''Decode throughput and memory of the binary frame format vs. the legacy pickle envelope.
+
+Each iteration decodes one base64 Kinesis record the way Image Processor does.
+Uses a real 1080p JPEG when OpenCV is installed, random bytes of similar size otherwise.
+
+Usage: python benchmarks/frameformat.py [iterations]'''
+from __future__ import print_function
+import base64
+import os
+import pickle
+import sys
+import time
+import tracemalloc
+
+import localaws
+
+localaws.use_lambda_path()
+
+import frameformat
+
+
+def sample_jpeg_1080p():
+    try:
+        import cv2
+        import numpy
+    except ImportError:
+        return os.urandom(450 * 1024)
+
+    rng = numpy.random.RandomState(0)
+    frame = rng.randint(0, 256, size=(1080 // 8, 1920 // 8, 3)).astype(numpy.uint8)
+    frame = cv2.resize(frame, (1920, 1080), interpolation=cv2.INTER_LINEAR)
+    retval, buff = cv2.imencode('.jpg', frame)
+    return buff.tobytes()
+
+
+def decode_pickle(record_data):
+    frame_package = pickle.loads(base64.b64decode(record_data))
+    return frame_package['ImageBytes']
+
+
+def decode_binary(record_data):
+    return frameformat.decode_frame(base64.b64decode(record_data)).payload
+
+
+def measure(name, decode, record_data, iterations):
+    decode(record_data)
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        decode(record_data)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    payload = decode(record_data)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del payload
+
+    print('%-8s %9.0f frames/s  %8.1f MB/s   peak alloc per decode %7.1f KB' % (
+        name, iterations / elapsed, iterations * len(record_data) / elapsed / 1e6, peak / 1024.0))
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+
+    jpeg = sample_jpeg_1080p()
+    capture_ts = time.time()
+
+    pickle_record = base64.b64encode(pickle.dumps({
+        'ApproximateCaptureTime': capture_ts,
+        'FrameCount': 1,
+        'ImageBytes': bytearray(jpeg)
+    }))
+    binary_record = base64.b64encode(frameformat.encode_frame(jpeg, capture_ts, 1, 'camera-0'))
+
+    print('1080p JPEG payload %d bytes; record size pickle %d, binary %d bytes' % (
+        len(jpeg), len(base64.b64decode(pickle_record)), len(base64.b64decode(binary_record))))
+    measure('pickle', decode_pickle, pickle_record, iterations)
+    measure('binary', decode_binary, binary_record, iterations)
+
+
+if __name__ == '__main__':
+    main()
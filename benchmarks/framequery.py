@@ -0,0 +1,114 @@
+'''Pages through Frame Fetcher results against a local EnrichedFrame table.
+
+Fills a local table with frames from several cameras spread over a few months.
+Then it reads every page of a few queries through framefetcher.handler,
+following the X-Next-Cursor header. It checks that each frame in range comes
+back exactly once and in timestamp order. It also times the month partitions
+queried in parallel against one after another.
+
+Usage: python benchmarks/framequery.py [frames] [months] [latency_ms]'''
+from __future__ import print_function
+import json
+import os
+import random
+import sys
+import time
+import uuid
+from decimal import Decimal
+
+import localaws
+
+localaws.use_fake_credentials()
+localaws.use_lambda_path('framefetcher')
+
+import warmruntime
+import framefetcher
+import framequery
+
+GSI = 'processed_year_month-processed_timestamp-index'
+CAMERAS = ['camera-0', 'camera-1', 'cam2', 'cam3']
+
+
+def fill(table, frames, start_ts, end_ts):
+    rng = random.Random(5)
+    for _ in range(frames):
+        ts = rng.uniform(start_ts, end_ts)
+        frame_id = str(uuid.uuid4())
+        table.items[(frame_id,)] = {
+            'frame_id': frame_id,
+            'processed_timestamp': Decimal(str(ts)),
+            'approx_capture_timestamp': Decimal(str(ts - 1)),
+            'processed_year_month': framequery.month_of(ts),
+            's3_bucket': 'local-bucket',
+            's3_key': 'frames/%s.jpg' % frame_id,
+            'camera_id': rng.choice(CAMERAS)
+        }
+
+
+def fetch_all(params):
+    pages, frames = 0, []
+    params = dict(params)
+    while True:
+        sys.stdout, real_stdout = open(os.devnull, 'w'), sys.stdout
+        try:
+            response = framefetcher.handler({'httpMethod': 'GET', 'queryStringParameters': params}, None)
+        finally:
+            sys.stdout = real_stdout
+        if response['statusCode'] != '200':
+            raise ValueError(response['body'])
+        pages += 1
+        frames.extend(json.loads(response['body']))
+        cursor = response['headers'].get('X-Next-Cursor')
+        if not cursor:
+            return pages, frames
+        params = {'cursor': cursor, 'limit': params.get('limit')}
+
+
+def check(name, table, params, start_ts, end_ts, cameras=None, ascending=False):
+    start = time.perf_counter()
+    pages, frames = fetch_all(params)
+    elapsed = time.perf_counter() - start
+    expected = sorted((item for item in table.items.values()
+                       if start_ts <= item['processed_timestamp'] <= end_ts
+                       and (not cameras or item['camera_id'] in cameras)),
+                      key=lambda item: item['processed_timestamp'], reverse=not ascending)
+    ids = [frame['frame_id'] for frame in frames]
+    ok = ids == [item['frame_id'] for item in expected]
+    print('%-34s %5d frames in %3d pages, %7.1f ms  %s' % (
+        name, len(frames), pages, elapsed * 1000, 'OK' if ok else 'MISMATCH (%d expected)' % len(expected)))
+    return ok
+
+
+def main():
+    frames = int(sys.argv[1]) if len(sys.argv) > 1 else 3000
+    months = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    latency = (float(sys.argv[3]) if len(sys.argv) > 3 else 10.0) / 1000.0
+
+    os.chdir(localaws.CONFIG_DIR)
+    end_ts = time.time()
+    start_ts = end_ts - months * 30 * 24 * 3600
+    table = localaws.LocalDynamoTable('EnrichedFrame', ['frame_id'], latency=latency,
+                                      indexes={GSI: ('processed_year_month', 'processed_timestamp')})
+    fill(table, frames, start_ts, end_ts)
+
+    ok = True
+    for workers in (8, 1):
+        warmruntime.reset()
+        config = dict(warmruntime.load_config('framefetcher-params.json'), max_partition_queries=workers)
+        warmruntime.set_config('framefetcher-params.json', config)
+        warmruntime.cached('framefetcher.table', lambda: table)
+        print('%d parallel partition queries:' % workers)
+        span = {'from': str(start_ts), 'to': str(end_ts)}
+        ok &= check('  all frames, 100 per page', table, dict(span, limit='100'), start_ts, end_ts)
+        ok &= check('  oldest first, 100 per page', table, dict(span, limit='100', order='asc'),
+                    start_ts, end_ts, ascending=True)
+        ok &= check('  camera-1 only, 50 per page', table, dict(span, limit='50', camera='camera-1'),
+                    start_ts, end_ts, cameras=['camera-1'])
+        ok &= check('  two cameras, fields, 100 per page', table,
+                    dict(span, limit='100', camera='cam2,cam3', fields='camera_id'),
+                    start_ts, end_ts, cameras=['cam2', 'cam3'])
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
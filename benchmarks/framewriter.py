@@ -0,0 +1,65 @@
+'''Times persisting EnrichedFrame items: one PutItem per frame against BatchWriteItem.
+
+Writes frames to a local DynamoDB stand-in with a simulated round-trip time,
+once with put_item per frame (how imageprocessor used to write) and once with
+framewriter.BatchWriter, including throttled batches that leave items
+unprocessed. Reports the write latency per 100 frames.
+
+Usage: python benchmarks/framewriter.py [frames] [latency_ms] [unprocessed_fraction]'''
+from __future__ import print_function
+import sys
+import time
+import uuid
+from decimal import Decimal
+
+import localaws
+
+localaws.use_lambda_path('imageprocessor')
+
+import framewriter
+
+
+def frame_item(frame_count):
+    now = time.time()
+    return {
+        'frame_id': str(uuid.uuid4()),
+        'processed_timestamp': Decimal(now),
+        'approx_capture_timestamp': Decimal(now),
+        'processed_year_month': '201911',
+        's3_bucket': 'local-bucket',
+        's3_key': 'frames/%d.jpg' % frame_count,
+        'camera_id': 'camera-0'
+    }
+
+
+def main():
+    frames = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    latency = (float(sys.argv[2]) if len(sys.argv) > 2 else 8.0) / 1000.0
+    unprocessed_fraction = float(sys.argv[3]) if len(sys.argv) > 3 else 0.1
+    items = [frame_item(frame_count) for frame_count in range(frames)]
+
+    dynamodb = localaws.LocalDynamoDB(latency=latency)
+    table = dynamodb.create_table('EnrichedFrame', ['frame_id'])
+    start = time.perf_counter()
+    for item in items:
+        table.put_item(Item=item)
+    put_item_secs = time.perf_counter() - start
+    print('put_item:                 %4d requests, %7.1f ms per 100 frames' % (
+        table.calls['PutItem'], put_item_secs * 1000 * 100 / frames))
+
+    for fraction in (0.0, unprocessed_fraction):
+        dynamodb = localaws.LocalDynamoDB(latency=latency, unprocessed_fraction=fraction)
+        table = dynamodb.create_table('EnrichedFrame', ['frame_id'])
+        writer = framewriter.BatchWriter(dynamodb, 'EnrichedFrame')
+        start = time.perf_counter()
+        for item in items:
+            writer.put(item)
+        failed = writer.flush()
+        batch_secs = time.perf_counter() - start
+        print('batch (%3d%% unprocessed): %4d requests, %7.1f ms per 100 frames, %d retried, %d failed, %d stored' % (
+            fraction * 100, writer.stats['requests'], batch_secs * 1000 * 100 / frames,
+            writer.stats['retried'], len(failed), len(table.items)))
+
+
+if __name__ == '__main__':
+    main()
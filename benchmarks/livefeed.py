@@ -0,0 +1,157 @@
+'''Detection-to-screen latency and upstream load of the live feed against polling.
+
+Stores a new detection every --interval seconds for --duration seconds while
+--clients browsers watch for it, in two ways:
+
+push - One DynamoStreamTailer reads a local DynamoDB stream stand-in, and each
+    client follows the server-sent event stream of livefeed.py.
+poll - Each client queries a local EnrichedFrame table for the newest frames
+    every --poll seconds, as the dashboard does with Frame Fetcher.
+
+Reports the delay from storing a detection to each client seeing it, and how
+many requests reached DynamoDB.
+
+Usage: python benchmarks/livefeed.py [--clients N] [--duration S] [--interval S] [--poll S]'''
+from __future__ import print_function
+import argparse
+import json
+import statistics
+import threading
+import time
+import uuid
+from decimal import Decimal
+
+import localaws
+
+localaws.use_fake_credentials()
+localaws.use_lambda_path('framefetcher')
+localaws.use_app_path()
+
+import boto3
+from boto3.dynamodb.conditions import Key
+
+import framequery
+import livefeed
+
+GSI = 'processed_year_month-processed_timestamp-index'
+
+
+def detection(ts):
+    frame_id = str(uuid.uuid4())
+    return {
+        'frame_id': frame_id,
+        'processed_timestamp': Decimal(str(ts)),
+        'approx_capture_timestamp': Decimal(str(ts - 1)),
+        'processed_year_month': framequery.month_of(ts),
+        's3_bucket': 'local-bucket',
+        's3_key': 'frames/2026/10/18/09/%s.jpg' % frame_id,
+        'camera_id': 'camera-0'
+    }
+
+
+def write_detections(args, store, stored, done):
+    '''Stores a detection every interval and records when each was stored.'''
+    end = time.time() + args.duration
+    while time.time() < end:
+        time.sleep(args.interval)
+        item = detection(time.time())
+        stored[item['frame_id']] = time.time()
+        store(item)
+    #Let the last detection reach everyone
+    time.sleep(max(args.poll, 2.0))
+    done.set()
+
+
+def report(name, args, stored, seen, requests):
+    delays = sorted(delay for client in seen for delay in client)
+    missing = len(stored) * len(seen) - len(delays)
+    print('%-5s %4d clients  %3d detections  delay p50 %7.1f ms  p99 %7.1f ms  %6d DynamoDB requests  %s' % (
+        name, len(seen), len(stored), statistics.median(delays) * 1000, delays[int(len(delays) * 0.99) - 1] * 1000,
+        requests, 'all delivered' if not missing else '%d deliveries missing' % missing))
+
+
+def run_push(args):
+    stream = localaws.LocalDynamoStream(shard_count=2)
+    session = boto3.session.Session()
+    responder = localaws.StubResponder(stream.responses(), latency={'*': args.latency / 1000.0})
+    responder.install(session)
+    tailer = livefeed.DynamoStreamTailer(session.client('dynamodbstreams'), stream.ARN)
+    hub = livefeed.FeedHub(tailer).start()
+
+    stored, done = {}, threading.Event()
+    seen = [[] for _ in range(args.clients)]
+
+    def watch(delays):
+        for chunk in livefeed.sse_stream(hub, hub.last_id(), stream_secs=args.duration + 5, heartbeat_secs=1):
+            now = time.time()
+            for line in chunk.split('\n'):
+                if line.startswith('data: '):
+                    delays.append(now - stored[json.loads(line[6:])['frame_id']])
+            if done.is_set():
+                return
+
+    while hub.tailer.stats['requests'] == 0:
+        time.sleep(0.05)
+    clients = [threading.Thread(target=watch, args=(delays,)) for delays in seen]
+    for client in clients:
+        client.start()
+    write_detections(args, stream.put, stored, done)
+    for client in clients:
+        client.join()
+    report('push', args, stored, seen, sum(responder.calls.values()))
+
+
+def run_poll(args):
+    table = localaws.LocalDynamoTable('EnrichedFrame', ['frame_id'], latency=args.latency / 1000.0,
+                                      indexes={GSI: ('processed_year_month', 'processed_timestamp')})
+    stored, done = {}, threading.Event()
+    seen = [[] for _ in range(args.clients)]
+    start_ts = time.time()
+
+    def watch(index, delays):
+        shown = set()
+        #Clients poll out of step with each other, as separate browsers would
+        time.sleep(args.poll * index / float(args.clients))
+        while not done.is_set():
+            response = table.query(
+                IndexName=GSI,
+                KeyConditionExpression=Key('processed_year_month').eq(framequery.month_of(time.time())) &
+                Key('processed_timestamp').gte(Decimal(str(start_ts))),
+                ScanIndexForward=False,
+                Limit=10
+            )
+            now = time.time()
+            for item in response['Items']:
+                if item['frame_id'] not in shown:
+                    shown.add(item['frame_id'])
+                    delays.append(now - stored[item['frame_id']])
+            time.sleep(args.poll)
+
+    clients = [threading.Thread(target=watch, args=(index, delays)) for index, delays in enumerate(seen)]
+    for client in clients:
+        client.start()
+
+    def store(item):
+        with table._lock:
+            table.items[(item['frame_id'],)] = item
+    write_detections(args, store, stored, done)
+    for client in clients:
+        client.join()
+    report('poll', args, stored, seen, table.calls.get('Query', 0))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Live feed benchmark.')
+    parser.add_argument('--clients', type=int, default=100)
+    parser.add_argument('--duration', type=float, default=20.0)
+    parser.add_argument('--interval', type=float, default=1.0, help='Seconds between detections.')
+    parser.add_argument('--poll', type=float, default=2.0, help='Seconds between polls of each polling client.')
+    parser.add_argument('--latency', type=float, default=10.0, help='Simulated DynamoDB latency, ms.')
+    args = parser.parse_args()
+
+    run_push(args)
+    run_poll(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,519 @@
+'''Local stand-ins for AWS used by the benchmarks. Nothing here talks to a real account.'''
+import base64
+import hashlib
+import json
+import os
+import pickle
+import random
+import sys
+import threading
+import time
+from urllib.parse import parse_qs
+
+from boto3.dynamodb.types import TypeSerializer
+from botocore.awsrequest import AWSResponse
+from botocore.exceptions import ClientError
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+CONFIG_DIR = os.path.join(ROOT_DIR, 'config')
+
+
+def use_lambda_path(*functions):
+    '''Makes the named lambda functions and the shared lambda code importable.'''
+    for function in ('common',) + functions:
+        path = os.path.join(ROOT_DIR, 'lambda', function)
+        if path not in sys.path:
+            sys.path.insert(0, path)
+
+
+def use_client_path():
+    '''Makes the video capture client modules importable.'''
+    use_lambda_path()
+    path = os.path.join(ROOT_DIR, 'client')
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+
+def use_app_path():
+    '''Makes the web app modules at the root of the project importable.'''
+    if ROOT_DIR not in sys.path:
+        sys.path.insert(0, ROOT_DIR)
+
+
+def use_fake_credentials():
+    '''Points boto3 at dummy credentials so clients can be built offline.'''
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+
+
+class _RawBody(object):
+    def __init__(self, body):
+        self.body = body
+
+    def stream(self, **kwargs):
+        yield self.body
+
+    def read(self, *args, **kwargs):
+        return self.body
+
+
+SNS_PUBLISH_BODY = (b'<PublishResponse xmlns="http://sns.amazonaws.com/doc/2010-03-31/">'
+                    b'<PublishResult><MessageId>local-message</MessageId></PublishResult>'
+                    b'</PublishResponse>')
+
+
+def sns_publish_batch_body(request):
+    '''Reports every entry of a PublishBatch request as successful.'''
+    form = parse_qs(request.body.decode('utf-8') if isinstance(request.body, bytes) else request.body)
+    ids = [values[0] for key, values in sorted(form.items())
+           if key.startswith('PublishBatchRequestEntries.member.') and key.endswith('.Id')]
+    members = ''.join('<member><Id>%s</Id><MessageId>local-%s</MessageId></member>' % (entry_id, entry_id)
+                      for entry_id in ids)
+    return ('<PublishBatchResponse xmlns="http://sns.amazonaws.com/doc/2010-03-31/"><PublishBatchResult>'
+            '<Successful>%s</Successful><Failed/></PublishBatchResult></PublishBatchResponse>' % members).encode('utf-8')
+
+
+DEFAULT_BODIES = {
+    'sns.Publish': SNS_PUBLISH_BODY,
+    'sns.PublishBatch': sns_publish_batch_body,
+}
+
+
+class ErrorResponse(object):
+    '''A stubbed AWS error reply for JSON protocol services (Rekognition, DynamoDB, Kinesis).'''
+
+    def __init__(self, code, message='Stubbed error', status=400):
+        self.code = code
+        self.message = message
+        self.status = status
+
+    def body(self):
+        return json.dumps({'__type': self.code, 'message': self.message}).encode('utf-8')
+
+
+class StubResponder(object):
+    '''A botocore "before-send" handler that answers every request locally.
+
+    responses maps "service.Operation" (e.g. "rekognition.SearchFacesByImage")
+    to a dict (sent as JSON), raw bytes, an ErrorResponse, or a callable taking
+    the request and returning one of those. latency maps the same keys, or "*",
+    to seconds of simulated network time.'''
+
+    def __init__(self, responses=None, latency=None):
+        self.responses = responses or {}
+        self.latency = latency or {}
+        self.calls = {}
+
+    def install(self, session):
+        session.events.register('before-send', self)
+        return self
+
+    def __call__(self, request, event_name, **kwargs):
+        # event_name looks like "before-send.rekognition.SearchFacesByImage"
+        key = '.'.join(event_name.split('.')[1:3])
+        self.calls[key] = self.calls.get(key, 0) + 1
+
+        delay = self.latency.get(key, self.latency.get('*', 0))
+        if delay:
+            time.sleep(delay)
+
+        body = self.responses.get(key, DEFAULT_BODIES.get(key, b''))
+        if callable(body):
+            body = body(request)
+        if isinstance(body, ErrorResponse):
+            return AWSResponse(request.url, body.status, {}, _RawBody(body.body()))
+        if isinstance(body, dict):
+            body = json.dumps(body).encode('utf-8')
+
+        return AWSResponse(request.url, 200, {}, _RawBody(body))
+
+
+class LocalKinesis(object):
+    '''In-process Kinesis stream with per-shard write limits (1 MB/s and 1,000 records/s).
+
+    Records over a shard's limit in the current second are rejected with
+    ProvisionedThroughputExceededException, as Kinesis does. latency is the
+    simulated round-trip time of every request.'''
+
+    SHARD_RECORDS_PER_SEC = 1000
+    SHARD_BYTES_PER_SEC = 1024 * 1024
+
+    def __init__(self, shard_count=1, latency=0.0):
+        self.shard_count = shard_count
+        self.latency = latency
+        self.requests = 0
+        self.shards = [[] for _ in range(shard_count)]
+        self._window = [(0, 0, 0)] * shard_count
+
+    def shard_for(self, partition_key):
+        hash_key = int(hashlib.md5(partition_key.encode('utf-8')).hexdigest(), 16)
+        return hash_key * self.shard_count >> 128
+
+    def _accept(self, shard, size):
+        second = int(time.time())
+        window_second, records, data_bytes = self._window[shard]
+        if window_second != second:
+            records, data_bytes = 0, 0
+        if records + 1 > self.SHARD_RECORDS_PER_SEC or data_bytes + size > self.SHARD_BYTES_PER_SEC:
+            self._window[shard] = (second, records, data_bytes)
+            return False
+        self._window[shard] = (second, records + 1, data_bytes + size)
+        return True
+
+    def _put(self, data, partition_key):
+        shard = self.shard_for(partition_key)
+        if not self._accept(shard, len(data) + len(partition_key)):
+            return {'ErrorCode': 'ProvisionedThroughputExceededException',
+                    'ErrorMessage': 'Rate exceeded for shard shardId-%012d' % shard}
+        self.shards[shard].append(data)
+        return {'ShardId': 'shardId-%012d' % shard, 'SequenceNumber': str(len(self.shards[shard]))}
+
+    def put_record(self, StreamName, Data, PartitionKey, **kwargs):
+        self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+        result = self._put(Data, PartitionKey)
+        if 'ErrorCode' in result:
+            raise Exception('ProvisionedThroughputExceededException: ' + result['ErrorMessage'])
+        return result
+
+    def put_records(self, StreamName, Records, **kwargs):
+        self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+        results = [self._put(record['Data'], record['PartitionKey']) for record in Records]
+        return {
+            'FailedRecordCount': sum(1 for result in results if 'ErrorCode' in result),
+            'Records': results
+        }
+
+
+def _evaluate_condition(condition, item):
+    '''Evaluates a boto3.dynamodb.conditions expression against a plain item dict.'''
+    expression = condition.get_expression()
+    operator = expression['operator']
+    values = expression['values']
+
+    if operator == 'OR':
+        return any(_evaluate_condition(value, item) for value in values)
+    if operator == 'AND':
+        return all(_evaluate_condition(value, item) for value in values)
+    if operator == 'NOT':
+        return not _evaluate_condition(values[0], item)
+    if operator == 'attribute_not_exists':
+        return values[0].name not in item
+    if operator == 'attribute_exists':
+        return values[0].name in item
+
+    name, operand = values[0].name, values[1]
+    if name not in item:
+        return False
+    current = item[name]
+    if operator == 'BETWEEN':
+        return operand <= current <= values[2]
+    if operator == 'IN':
+        return current in operand
+    return {
+        '=': lambda: current == operand,
+        '<>': lambda: current != operand,
+        '<': lambda: current < operand,
+        '<=': lambda: current <= operand,
+        '>': lambda: current > operand,
+        '>=': lambda: current >= operand,
+    }[operator]()
+
+
+class LocalDynamoTable(object):
+    '''Thread-safe in-process stand-in for a boto3 DynamoDB Table resource.
+
+    Supports put_item (with boto3 condition objects), get_item, delete_item,
+    update_item (ADD only) and query. indexes maps global secondary index names to their (hash, range)
+    key names. latency is the simulated round-trip time of every request.
+    items_read counts the items queries read, which is what they are billed by.'''
+
+    # Items a query returns at most, standing in for DynamoDB's 1 MB page limit
+    MAX_QUERY_PAGE = 1000
+
+    def __init__(self, name, key_names, latency=0.0, indexes=None):
+        self.name = name
+        self.key_names = tuple(key_names)
+        self.latency = latency
+        self.indexes = indexes or {}
+        self.items = {}
+        self.calls = {}
+        self.items_read = 0
+        self._lock = threading.Lock()
+
+    def _request(self, operation):
+        with self._lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _key(self, item):
+        return tuple(item[name] for name in self.key_names)
+
+    def put_item(self, Item, ConditionExpression=None, **kwargs):
+        self._request('PutItem')
+        with self._lock:
+            current = self.items.get(self._key(Item), {})
+            if ConditionExpression is not None and not _evaluate_condition(ConditionExpression, current):
+                raise ClientError({'Error': {'Code': 'ConditionalCheckFailedException',
+                                             'Message': 'The conditional request failed'}}, 'PutItem')
+            self.items[self._key(Item)] = dict(Item)
+        return {}
+
+    def get_item(self, Key, **kwargs):
+        self._request('GetItem')
+        with self._lock:
+            item = self.items.get(self._key(Key))
+        return {'Item': dict(item)} if item is not None else {}
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeValues=None, ReturnValues='NONE', **kwargs):
+        '''Supports "ADD <attribute> :value" expressions only, as used for counters.'''
+        self._request('UpdateItem')
+        action, name, value = UpdateExpression.split()
+        if action != 'ADD':
+            raise ValueError('Unsupported update expression: %s' % UpdateExpression)
+        with self._lock:
+            item = self.items.setdefault(self._key(Key), dict(Key))
+            item[name] = item.get(name, 0) + ExpressionAttributeValues[value]
+            updated = item[name]
+        return {'Attributes': {name: updated}} if ReturnValues != 'NONE' else {}
+
+    def delete_item(self, Key, **kwargs):
+        self._request('DeleteItem')
+        with self._lock:
+            self.items.pop(self._key(Key), None)
+        return {}
+
+    def query(self, KeyConditionExpression, IndexName=None, FilterExpression=None, Limit=None,
+              ScanIndexForward=True, ExclusiveStartKey=None, ProjectionExpression=None,
+              ExpressionAttributeNames=None, **kwargs):
+        self._request('Query')
+        hash_name, range_name = self.indexes[IndexName] if IndexName else (self.key_names + (None,))[:2]
+        with self._lock:
+            matches = [dict(item) for item in self.items.values() if _evaluate_condition(KeyConditionExpression, item)]
+        order = lambda item: (item.get(range_name), self._key(item))
+        matches.sort(key=order, reverse=not ScanIndexForward)
+        if ExclusiveStartKey:
+            start = order(ExclusiveStartKey)
+            matches = [item for item in matches if (order(item) > start if ScanIndexForward else order(item) < start)]
+
+        page = matches[:min(Limit or self.MAX_QUERY_PAGE, self.MAX_QUERY_PAGE)]
+        response = {'ScannedCount': len(page)}
+        with self._lock:
+            self.items_read += len(page)
+        if len(page) < len(matches):
+            last = page[-1]
+            response['LastEvaluatedKey'] = dict((name, last[name]) for name in
+                                                self.key_names + tuple(n for n in (hash_name, range_name) if n))
+        if FilterExpression is not None:
+            page = [item for item in page if _evaluate_condition(FilterExpression, item)]
+        if ProjectionExpression:
+            names = [(ExpressionAttributeNames or {}).get(name.strip(), name.strip())
+                     for name in ProjectionExpression.split(',')]
+            page = [dict((name, item[name]) for name in names if name in item) for item in page]
+        response['Items'] = page
+        response['Count'] = len(page)
+        return response
+
+
+class LocalDynamoDB(object):
+    '''Stand-in for a boto3 DynamoDB service resource holding LocalDynamoTables.
+
+    batch_write_item leaves a random unprocessed_fraction of the items
+    unprocessed, the way DynamoDB does when a partition is throttled.'''
+
+    def __init__(self, latency=0.0, unprocessed_fraction=0.0):
+        self.latency = latency
+        self.unprocessed_fraction = unprocessed_fraction
+        self.tables = {}
+        self.calls = {}
+        self._lock = threading.Lock()
+
+    def create_table(self, name, key_names, indexes=None):
+        self.tables[name] = LocalDynamoTable(name, key_names, self.latency, indexes)
+        return self.tables[name]
+
+    def Table(self, name):
+        return self.tables[name]
+
+    def batch_get_item(self, RequestItems, **kwargs):
+        with self._lock:
+            self.calls['BatchGetItem'] = self.calls.get('BatchGetItem', 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+        responses = {}
+        for name, request in RequestItems.items():
+            if len(request['Keys']) > 100:
+                raise ClientError({'Error': {'Code': 'ValidationException',
+                                             'Message': 'Too many items requested for the BatchGetItem call'}},
+                                  'BatchGetItem')
+            table = self.tables[name]
+            with table._lock:
+                responses[name] = [dict(table.items[table._key(key)]) for key in request['Keys']
+                                   if table._key(key) in table.items]
+        return {'Responses': responses, 'UnprocessedKeys': {}}
+
+    def batch_write_item(self, RequestItems, **kwargs):
+        with self._lock:
+            self.calls['BatchWriteItem'] = self.calls.get('BatchWriteItem', 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+        unprocessed = {}
+        for name, requests in RequestItems.items():
+            if len(requests) > 25:
+                raise ClientError({'Error': {'Code': 'ValidationException',
+                                             'Message': 'Too many items requested for the BatchWriteItem call'}},
+                                  'BatchWriteItem')
+            table = self.tables[name]
+            for request in requests:
+                if random.random() < self.unprocessed_fraction:
+                    unprocessed.setdefault(name, []).append(request)
+                    continue
+                with table._lock:
+                    if 'PutRequest' in request:
+                        item = request['PutRequest']['Item']
+                        table.items[table._key(item)] = dict(item)
+                    else:
+                        table.items.pop(table._key(request['DeleteRequest']['Key']), None)
+        return {'UnprocessedItems': unprocessed}
+
+
+class LocalDynamoStream(object):
+    '''A DynamoDB stream with a NEW_IMAGE view, served through a StubResponder.
+
+    put() records an inserted item in one of shard_count shards, picked by its
+    hash key. Install responses() on a StubResponder to answer DescribeStream,
+    GetShardIterator and GetRecords for the dynamodbstreams client.'''
+
+    ARN = 'arn:aws:dynamodb:us-east-1:000000000000:table/EnrichedFrame/stream/local'
+
+    def __init__(self, shard_count=1, key_name='frame_id'):
+        self.key_name = key_name
+        self.shards = ['shardId-%020d-%08d' % (i, i) for i in range(shard_count)]
+        self.records = dict((shard, []) for shard in self.shards)
+        self._sequence = 0
+        self._serializer = TypeSerializer()
+        self._lock = threading.Lock()
+
+    def put(self, item):
+        key = str(item[self.key_name]).encode('utf-8')
+        shard = self.shards[int(hashlib.md5(key).hexdigest(), 16) % len(self.shards)]
+        with self._lock:
+            self._sequence += 1
+            self.records[shard].append({
+                'eventID': str(self._sequence),
+                'eventName': 'INSERT',
+                'eventSource': 'aws:dynamodb',
+                'dynamodb': {
+                    'ApproximateCreationDateTime': int(time.time()),
+                    'Keys': {self.key_name: self._serializer.serialize(item[self.key_name])},
+                    'NewImage': dict((name, self._serializer.serialize(value)) for name, value in item.items()),
+                    'SequenceNumber': '%021d' % self._sequence,
+                    'StreamViewType': 'NEW_IMAGE'
+                }
+            })
+
+    def _describe(self, request):
+        shards = [{'ShardId': shard, 'SequenceNumberRange': {'StartingSequenceNumber': '0'}} for shard in self.shards]
+        return {'StreamDescription': {'StreamArn': self.ARN, 'StreamStatus': 'ENABLED',
+                                      'StreamViewType': 'NEW_IMAGE', 'Shards': shards}}
+
+    def _iterator(self, request):
+        body = json.loads(request.body)
+        with self._lock:
+            position = len(self.records[body['ShardId']]) if body['ShardIteratorType'] == 'LATEST' else 0
+        return {'ShardIterator': '%s/%d' % (body['ShardId'], position)}
+
+    def _get_records(self, request):
+        body = json.loads(request.body)
+        shard, position = body['ShardIterator'].rsplit('/', 1)
+        position = int(position)
+        with self._lock:
+            records = self.records[shard][position:position + body.get('Limit', 1000)]
+        return {'Records': records, 'NextShardIterator': '%s/%d' % (shard, position + len(records))}
+
+    def responses(self):
+        return {
+            'dynamodb-streams.DescribeStream': self._describe,
+            'dynamodb-streams.GetShardIterator': self._iterator,
+            'dynamodb-streams.GetRecords': self._get_records
+        }
+
+
+class LocalRedis(object):
+    '''In-process stand-in for the few redis-py client methods the web app uses:
+    get, setex and delete. latency is the simulated round-trip time of every call.'''
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.values = {}
+        self.calls = {}
+        self._lock = threading.Lock()
+
+    def _request(self, command):
+        with self._lock:
+            self.calls[command] = self.calls.get(command, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def get(self, key):
+        self._request('GET')
+        with self._lock:
+            value, expires = self.values.get(key, (None, None))
+            if expires is not None and expires <= time.time():
+                del self.values[key]
+                return None
+            return value
+
+    def setex(self, key, seconds, value):
+        self._request('SETEX')
+        with self._lock:
+            self.values[key] = (value.encode('utf-8') if isinstance(value, str) else value, time.time() + seconds)
+        return True
+
+    def delete(self, key):
+        self._request('DEL')
+        with self._lock:
+            return 1 if self.values.pop(key, None) is not None else 0
+
+
+def face_match_response(external_image_id='1', similarity=99.0):
+    return {
+        'FaceMatches': [{
+            'Similarity': similarity,
+            'Face': {'FaceId': 'local-face', 'ExternalImageId': external_image_id, 'Confidence': 99.9}
+        }]
+    }
+
+
+def watchlist_item_response(external_image_id='1'):
+    return {'Item': {'ID': {'N': external_image_id}, 'Name': {'S': 'Local Person'}, 'Message': {'S': 'Local message'}}}
+
+
+def kinesis_event(record_count, image_bytes=b'\xff\xd8' + b'\x00' * 20000, legacy_pickle=False):
+    '''Builds a Kinesis trigger event carrying record_count frames.'''
+    use_lambda_path()
+    import frameformat
+
+    records = []
+    for frame_count in range(record_count):
+        if legacy_pickle:
+            data = pickle.dumps({
+                'ApproximateCaptureTime': time.time(),
+                'FrameCount': frame_count,
+                'ImageBytes': bytearray(image_bytes)
+            })
+        else:
+            data = frameformat.encode_frame(image_bytes, time.time(), frame_count, 'camera-0')
+        records.append({
+            'kinesis': {
+                'partitionKey': 'camera-0',
+                'sequenceNumber': str(frame_count),
+                'data': base64.b64encode(data).decode('ascii')
+            }
+        })
+    return {'Records': records}
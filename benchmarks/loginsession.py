@@ -0,0 +1,191 @@
+'''Latency of authenticated requests to the web app, and Cognito calls per session.
+
+Imports the web app with Cognito answered by StubResponder, logs in once and
+loads the /live page --requests times, with the session checked:
+
+cognito - by asking Cognito (GetUser) on every request, the usual way to
+    validate a token without verifying it locally.
+memory - locally against the cached JWKS, with tokens in a MemoryTokenStore.
+redis - locally, with tokens in a RedisTokenStore on a LocalRedis stand-in.
+
+Then --threads threads share one session for --refresh-run seconds with
+tokens that live only --token-life seconds, to count how often they are
+refreshed. Tokens are signed with an RSA key generated on the spot, which
+needs the cryptography package.
+
+Usage: python benchmarks/loginsession.py [--requests N] [--latency MS] [--token-life S]'''
+from __future__ import print_function
+import argparse
+import base64
+import json
+import math
+import os
+import statistics
+import sys
+import threading
+import time
+
+import localaws
+
+localaws.use_fake_credentials()
+localaws.use_app_path()
+os.environ.setdefault('USER_POOL_ID', 'us-east-1_LocalPool')
+os.environ.setdefault('APP_CLIENT_ID', 'localappclient')
+
+import boto3
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import padding, rsa
+
+import authsession
+
+
+def b64url(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+class LocalCognito(object):
+    '''Signs Cognito-like access tokens and answers AdminInitiateAuth and GetUser.'''
+
+    KID = 'local-key'
+
+    def __init__(self, issuer, app_client_id, token_life):
+        self.issuer = issuer
+        self.app_client_id = app_client_id
+        self.token_life = token_life
+        self.key = rsa.generate_private_key(public_exponent=65537, key_size=2048, backend=default_backend())
+        self.jwks_fetches = 0
+
+    def token(self):
+        header = b64url(json.dumps({'kid': self.KID, 'alg': 'RS256'}).encode('utf-8'))
+        claims = b64url(json.dumps({'sub': 'local-user', 'iss': self.issuer, 'client_id': self.app_client_id,
+                                    'token_use': 'access', 'exp': int(time.time() + self.token_life),
+                                    'username': 'local-user'}).encode('utf-8'))
+        signature = self.key.sign((header + '.' + claims).encode('ascii'), padding.PKCS1v15(), hashes.SHA256())
+        return header + '.' + claims + '.' + b64url(signature)
+
+    def initiate_auth(self, request):
+        result = {'AccessToken': self.token(), 'IdToken': 'local-id-token', 'ExpiresIn': self.token_life,
+                  'TokenType': 'Bearer'}
+        if json.loads(request.body)['AuthFlow'] != 'REFRESH_TOKEN_AUTH':
+            result['RefreshToken'] = 'local-refresh-token'
+        return {'AuthenticationResult': result}
+
+    def jwks(self, url):
+        self.jwks_fetches += 1
+        numbers = self.key.public_key().public_numbers()
+        return {'keys': [{'kid': self.KID, 'kty': 'RSA', 'alg': 'RS256', 'use': 'sig',
+                          'n': b64url(numbers.n.to_bytes((numbers.n.bit_length() + 7) // 8, 'big')),
+                          'e': b64url(numbers.e.to_bytes(3, 'big'))}]}
+
+
+class CognitoCheckedSessions(authsession.SessionManager):
+    '''Checks every request's access token with Cognito GetUser instead of locally.'''
+
+    def load(self, sid):
+        record = self.store.get(sid)
+        if record is None:
+            return None
+        self.cognito_client.get_user(AccessToken=record['access_token'])
+        return record
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[max(0, int(math.ceil(len(values) * fraction)) - 1)]
+
+
+def cognito_calls(responder):
+    return sum(responder.calls.get('cognito-identity-provider.' + operation, 0)
+               for operation in ('AdminInitiateAuth', 'GetUser'))
+
+
+def run(name, application, responder, sessions, requests):
+    application.login_sessions = sessions
+    client = application.application.test_client()
+    before = cognito_calls(responder)
+    response = client.post('/login', data={'email': 'person@example.com', 'password': 'secret'})
+    if response.status_code != 302:
+        raise ValueError(response.get_data(as_text=True))
+    timings = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        response = client.get('/live')
+        timings.append((time.perf_counter() - start) * 1000)
+        if response.status_code != 200:
+            raise ValueError('Request was not authenticated: %d' % response.status_code)
+    print('%-8s %5d requests  p50 %6.2f ms  p99 %6.2f ms  Cognito calls %5d' % (
+        name, requests, statistics.median(timings), percentile(timings, 0.99),
+        cognito_calls(responder) - before))
+
+
+def run_refresh(args, application, responder, cognito, sessions):
+    application.login_sessions = sessions
+    client = application.application.test_client()
+    client.post('/login', data={'email': 'person@example.com', 'password': 'secret'})
+    before = responder.calls.get('cognito-identity-provider.AdminInitiateAuth', 0)
+    end, failures, counts = time.time() + args.refresh_run, [], []
+
+    def browse():
+        count = 0
+        while time.time() < end:
+            if client.get('/live').status_code != 200:
+                failures.append(1)
+            count += 1
+        counts.append(count)
+
+    threads = [threading.Thread(target=browse) for _ in range(args.threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    print('refresh  %5d requests over %.0f s from %d threads, tokens living %.0f s: %d refreshes, %d logged out' % (
+        sum(counts), args.refresh_run, args.threads, args.token_life,
+        responder.calls.get('cognito-identity-provider.AdminInitiateAuth', 0) - before, len(failures)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Login session benchmark.')
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--latency', type=float, default=40.0, help='Simulated Cognito latency, ms.')
+    parser.add_argument('--redis-latency', type=float, default=0.3, help='Simulated Redis latency, ms.')
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--token-life', type=float, default=4.0, help='Access token lifetime in the refresh run, s.')
+    parser.add_argument('--refresh-run', type=float, default=10.0, help='Length of the refresh run, s.')
+    args = parser.parse_args()
+
+    pool, app_client = os.environ['USER_POOL_ID'], os.environ['APP_CLIENT_ID']
+    cognito = LocalCognito('https://cognito-idp.us-east-1.amazonaws.com/%s' % pool, app_client, 3600)
+    responder = localaws.StubResponder(
+        {'cognito-identity-provider.AdminInitiateAuth': cognito.initiate_auth,
+         'cognito-identity-provider.GetUser': {'Username': 'local-user', 'UserAttributes': []}},
+        latency={'cognito-identity-provider.AdminInitiateAuth': args.latency / 1000.0,
+                 'cognito-identity-provider.GetUser': args.latency / 1000.0})
+    boto3.setup_default_session()
+    responder.install(boto3.DEFAULT_SESSION)
+
+    os.chdir(localaws.ROOT_DIR)
+    sys.stdout, real_stdout = open(os.devnull, 'w'), sys.stdout
+    try:
+        import application
+    finally:
+        sys.stdout = real_stdout
+    application.application.config['WTF_CSRF_ENABLED'] = False
+
+    def manager(store, checked=False):
+        verifier = authsession.TokenVerifier('us-east-1', pool, app_client, fetch=cognito.jwks)
+        cls = CognitoCheckedSessions if checked else authsession.SessionManager
+        return cls(store, verifier, application.client, pool, app_client, refresh_margin=args.token_life / 4)
+
+    run('cognito', application, responder, manager(authsession.MemoryTokenStore(), checked=True), args.requests)
+    run('memory', application, responder, manager(authsession.MemoryTokenStore()), args.requests)
+    redis = localaws.LocalRedis(latency=args.redis_latency / 1000.0)
+    run('redis', application, responder, manager(authsession.RedisTokenStore(redis)), args.requests)
+    print('JWKS fetched %d times, once per session manager' % cognito.jwks_fetches)
+
+    cognito.token_life = args.token_life
+    run_refresh(args, application, responder, cognito, manager(authsession.MemoryTokenStore()))
+
+
+if __name__ == '__main__':
+    main()
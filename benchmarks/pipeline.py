@@ -0,0 +1,309 @@
+'''End-to-end load test of the frame pipeline against in-process AWS stand-ins.
+
+Cameras send JPEG frames through the client's KinesisProducer to a
+LocalKinesis stream. The stream is read in batches of each --batch-sizes size
+and handed to imageprocessor.handler. Rekognition, S3 and SNS are answered by
+StubResponder with the given latencies. Frame metadata, the watchlist, alert
+dedup and the shared recognition cache live in LocalDynamoDB tables. Then a
+dashboard reads the stored frames back through framefetcher.handler: it
+pages through all of them and polls the newest page of each camera.
+
+For each batch size, reports:
+- records per second and per-record and per-batch latency (p50, p99);
+- the Python memory high-water mark of Image Processor (tracemalloc peak),
+  from a second run of the same batches, since tracing slows Python down;
+- the calls made to each AWS API;
+- Frame Fetcher request latency, and whether every stored frame came back.
+
+The process's maximum resident set size, which Lambda reports as Max Memory
+Used, is printed at the end. Exits with 1 if a frame is lost, or if
+--max-p99-ms or --min-records-per-sec is not met, so the run can gate
+changes.
+
+Usage: python benchmarks/pipeline.py [--frames N] [--batch-sizes 1,10,100] [--search-latency MS]'''
+from __future__ import print_function
+import argparse
+import base64
+import io
+import json
+import math
+import os
+import random
+import resource
+import statistics
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+from PIL import Image
+
+import localaws
+
+localaws.use_fake_credentials()
+localaws.use_client_path()
+localaws.use_lambda_path('imageprocessor', 'framefetcher')
+
+from producer import KinesisProducer, partition_key_for
+
+import dedup
+import framefetcher
+import frameformat
+import framewriter
+import imageprocessor
+import resultcache
+import warmruntime
+import watchlist
+
+GSI = 'processed_year_month-processed_timestamp-index'
+WATCHLIST_PEOPLE = 5
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[max(0, int(math.ceil(len(values) * fraction)) - 1)]
+
+
+def jpeg(pixels):
+    output = io.BytesIO()
+    Image.fromarray(pixels).save(output, format='JPEG', quality=85)
+    return output.getvalue()
+
+
+def camera_frames(rng, count, cameras, changed_fraction):
+    '''(camera_id, jpeg) pairs, the cameras in turn, each showing its scene with noise and changing it now and then.'''
+    scenes = []
+    for _ in range(cameras):
+        scene = rng.randint(0, 255, (240, 320, 3)).astype(np.uint8)
+        scenes.append(np.array(Image.fromarray(scene).resize((32, 24)).resize((320, 240), Image.BILINEAR)))
+    frames = []
+    for index in range(count):
+        camera = index % cameras
+        if rng.rand() < changed_fraction:
+            scenes[camera] = np.roll(scenes[camera], rng.randint(20, 100), axis=1)
+        noise = rng.randint(-3, 4, scenes[camera].shape)
+        frames.append(('camera-%d' % camera,
+                       jpeg(np.clip(scenes[camera].astype(int) + noise, 0, 255).astype(np.uint8))))
+    return frames
+
+
+def capture(frames, args):
+    '''Sends the frames through a KinesisProducer and returns the stream.'''
+    stream = localaws.LocalKinesis(args.shards, args.kinesis_latency / 1000.0)
+    kinesis_producer = KinesisProducer(stream, 'FrameStream', linger_secs=0.05)
+    for frame_count, (camera_id, image_bytes) in enumerate(frames):
+        data = frameformat.encode_frame(image_bytes, time.time(), frame_count, camera_id)
+        kinesis_producer.put(data, partition_key_for(int(camera_id.split('-')[1])))
+    kinesis_producer.close()
+    return stream, kinesis_producer.stats.snapshot()
+
+
+def kinesis_events(stream, batch_size):
+    '''Lambda trigger events of up to batch_size records, shard by shard.'''
+    events = []
+    for shard_index, shard in enumerate(stream.shards):
+        for start in range(0, len(shard), batch_size):
+            events.append({'Records': [{
+                'kinesis': {
+                    'partitionKey': 'shard-%d' % shard_index,
+                    'sequenceNumber': '%d-%d' % (shard_index, start + offset),
+                    'data': base64.b64encode(data).decode('ascii')
+                }
+            } for offset, data in enumerate(shard[start:start + batch_size])]})
+    return events
+
+
+def local_tables(args):
+    dynamodb = localaws.LocalDynamoDB(latency=args.ddb_latency / 1000.0)
+    frames = dynamodb.create_table('EnrichedFrame', ('frame_id',),
+                                   indexes={GSI: ('processed_year_month', 'processed_timestamp')})
+    people = dynamodb.create_table('felon_images_metadata', ('ID',))
+    people.items[(0,)] = {'ID': 0, 'Version': 1}
+    for person in range(1, WATCHLIST_PEOPLE + 1):
+        people.items[(person,)] = {'ID': person, 'Name': 'Person %d' % person, 'Message': 'Local message'}
+    dynamodb.create_table('AlertDedup', ('dedup_key',))
+    dynamodb.create_table('RecognitionCache', ('cache_key',))
+    return dynamodb, frames
+
+
+def local_context(dynamodb, config):
+    '''Image Processor's context with its DynamoDB tables replaced by local ones.'''
+    ctx = imageprocessor.build_context()
+    ctx['frame_writer'] = framewriter.BatchWriter(dynamodb, 'EnrichedFrame')
+    ctx['watchlist'] = watchlist.WatchlistCache(dynamodb, 'felon_images_metadata')
+    ctx['dedup'] = dedup.AlertDeduplicator(dynamodb.Table('AlertDedup'),
+                                           cooldown_secs=int(config.get('alert_cooldown_secs', 600)))
+    cache = ctx['results']
+    ctx['results'] = resultcache.RecognitionCache(
+        cache.local, resultcache.DynamoResultStore(dynamodb, 'RecognitionCache', cache.hash_size * cache.hash_size),
+        hash_mode=cache.hash_mode, hash_size=cache.hash_size, max_distance=cache.max_distance,
+        ttl_secs=cache.ttl_secs)
+    return ctx
+
+
+def process(args, events, dynamodb, traced=False):
+    '''Runs every event through imageprocessor.handler. Returns the timings and counts,
+    and with traced, the peak of Python memory allocated meanwhile.'''
+    warmruntime.reset()
+    config = dict(warmruntime.load_config('imageprocessor-params.json'))
+    config.update(max_concurrency=args.concurrency)
+    warmruntime.set_config('imageprocessor-params.json', config)
+
+    def search(request):
+        if random.random() < args.matched_fraction:
+            return localaws.face_match_response(str(random.randint(1, WATCHLIST_PEOPLE)))
+        return {'FaceMatches': []}
+
+    responder = localaws.StubResponder(
+        {'rekognition.SearchFacesByImage': search},
+        latency={'rekognition.SearchFacesByImage': args.search_latency / 1000.0,
+                 's3.PutObject': args.s3_latency / 1000.0, '*': args.ddb_latency / 1000.0})
+    responder.install(warmruntime.session())
+
+    record_ms, batch_ms, failed = [], [], 0
+    run_record = imageprocessor.run_record
+
+    def timed_run_record(record, ctx):
+        start = time.perf_counter()
+        try:
+            return run_record(record, ctx)
+        finally:
+            record_ms.append((time.perf_counter() - start) * 1000)
+
+    imageprocessor.run_record = timed_run_record
+    sys.stdout, real_stdout = open(os.devnull, 'w'), sys.stdout
+    if traced:
+        tracemalloc.start()
+    try:
+        ctx = warmruntime.cached('imageprocessor.context', lambda: local_context(dynamodb, config))
+        start = time.perf_counter()
+        for event in events:
+            begin = time.perf_counter()
+            failed += len(imageprocessor.handler(event, None)['batchItemFailures'])
+            batch_ms.append((time.perf_counter() - begin) * 1000)
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1] if traced else None
+    finally:
+        if traced:
+            tracemalloc.stop()
+        imageprocessor.run_record = run_record
+        sys.stdout = real_stdout
+
+    calls = dict(responder.calls)
+    for operation, count in dynamodb.calls.items():
+        calls['dynamodb.' + operation] = count
+    for table in dynamodb.tables.values():
+        for operation, count in table.calls.items():
+            calls['dynamodb.' + operation] = calls.get('dynamodb.' + operation, 0) + count
+    return {'elapsed': elapsed, 'record_ms': record_ms, 'batch_ms': batch_ms, 'failed': failed,
+            'dead_lettered': ctx['dead_letters'].stats['records'] if ctx['dead_letters'] else 0,
+            'peak': peak, 'calls': calls, 'cache': ctx['results'].stats}
+
+
+def fetch(args, frames_table):
+    '''Reads every stored frame back through framefetcher.handler, then polls each camera's newest page.'''
+    warmruntime.reset()
+    table = frames_table
+    warmruntime.cached('framefetcher.table', lambda: table)
+    before = dict(table.calls)
+    timings, seen = [], set()
+    now = time.time()
+
+    def get(params):
+        start = time.perf_counter()
+        response = framefetcher.handler({'httpMethod': 'GET', 'queryStringParameters': params}, None)
+        timings.append((time.perf_counter() - start) * 1000)
+        if response['statusCode'] != '200':
+            raise ValueError('Frame Fetcher answered %s: %s' % (response['statusCode'], response['body']))
+        return response
+
+    sys.stdout, real_stdout = open(os.devnull, 'w'), sys.stdout
+    try:
+        params = {'from': str(int(now - 3600)), 'to': str(int(now + 60)), 'limit': '100'}
+        while params is not None:
+            response = get(params)
+            seen.update(frame['frame_id'] for frame in json.loads(response['body']))
+            cursor = response['headers'].get('X-Next-Cursor')
+            params = {'cursor': cursor, 'limit': '100'} if cursor else None
+        for poll in range(args.polls):
+            get({'camera': 'camera-%d' % (poll % args.cameras), 'limit': '20'})
+    finally:
+        sys.stdout = real_stdout
+    queries = table.calls.get('Query', 0) - before.get('Query', 0)
+    return timings, seen, queries
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end frame pipeline load test.')
+    parser.add_argument('--frames', type=int, default=200)
+    parser.add_argument('--cameras', type=int, default=4)
+    parser.add_argument('--shards', type=int, default=2)
+    parser.add_argument('--batch-sizes', default='1,10,100', help='Kinesis batch sizes to run, comma-separated.')
+    parser.add_argument('--concurrency', type=int, default=8, help='Image Processor max_concurrency.')
+    parser.add_argument('--changed-fraction', type=float, default=0.2, help='Share of frames with a new scene.')
+    parser.add_argument('--matched-fraction', type=float, default=0.3, help='Share of searches that match.')
+    parser.add_argument('--search-latency', type=float, default=100.0, help='Simulated Rekognition latency, ms.')
+    parser.add_argument('--s3-latency', type=float, default=30.0, help='Simulated S3 latency, ms.')
+    parser.add_argument('--ddb-latency', type=float, default=5.0, help='Simulated DynamoDB and SNS latency, ms.')
+    parser.add_argument('--kinesis-latency', type=float, default=20.0, help='Simulated Kinesis latency, ms.')
+    parser.add_argument('--polls', type=int, default=100, help='Frame Fetcher polls after the read-back.')
+    parser.add_argument('--no-memory', dest='memory', action='store_false',
+                        help='Skip the second, traced run that measures the memory high-water mark.')
+    parser.add_argument('--max-p99-ms', type=float, help='Fail if the per-record p99 is higher.')
+    parser.add_argument('--min-records-per-sec', type=float, help='Fail if throughput is lower.')
+    args = parser.parse_args()
+
+    os.chdir(localaws.CONFIG_DIR)
+    random.seed(7)
+    frames = camera_frames(np.random.RandomState(7), args.frames, args.cameras, args.changed_fraction)
+    stream, sent = capture(frames, args)
+    print('capture  %d frames of %.1f KB from %d cameras: %d PutRecords requests, %d retried, '
+          'producer latency p50 %.1f ms, p99 %.1f ms' % (
+              len(frames), statistics.mean(len(image_bytes) for _, image_bytes in frames) / 1024.0, args.cameras,
+              stream.requests, sent['records_retried'], sent.get('latency_p50', 0) * 1000,
+              sent.get('latency_p99', 0) * 1000))
+
+    ok = True
+    for batch_size in [int(size) for size in args.batch_sizes.split(',')]:
+        dynamodb, frames_table = local_tables(args)
+        events = kinesis_events(stream, batch_size)
+        result = process(args, events, dynamodb)
+        if args.memory:
+            result['peak'] = process(args, events, local_tables(args)[0], traced=True)['peak']
+        records = len(result['record_ms'])
+        throughput = records / result['elapsed']
+        p99 = percentile(result['record_ms'], 0.99)
+        print('batch %-4d imageprocessor  %6.1f records/s  record p50 %6.1f ms  p99 %6.1f ms  '
+              'batch p50 %7.1f ms  p99 %7.1f ms  failed %d  dead-lettered %d%s' % (
+                  batch_size, throughput, statistics.median(result['record_ms']), p99,
+                  statistics.median(result['batch_ms']), percentile(result['batch_ms'], 0.99), result['failed'],
+                  result['dead_lettered'],
+                  '  Python peak %.1f MB' % (result['peak'] / 1048576.0) if result['peak'] is not None else ''))
+        print('           calls %s' % ', '.join('%s %d' % item for item in sorted(result['calls'].items())))
+        print('           recognition cache %s' % result['cache'])
+
+        stored = set(item['frame_id'] for item in frames_table.items.values())
+        timings, seen, queries = fetch(args, frames_table)
+        lost = len(stored - seen)
+        print('           framefetcher    %4d requests  p50 %6.2f ms  p99 %6.2f ms  %d queries  '
+              '%d of %d stored frames read back' % (
+                  len(timings), statistics.median(timings), percentile(timings, 0.99), queries,
+                  len(stored & seen), len(stored)))
+
+        if lost or records != len(frames):
+            print('           FAILED: %d frames processed of %d, %d stored frames not returned' % (
+                records, len(frames), lost))
+            ok = False
+        if args.max_p99_ms is not None and p99 > args.max_p99_ms:
+            print('           FAILED: record p99 %.1f ms is over %.1f ms' % (p99, args.max_p99_ms))
+            ok = False
+        if args.min_records_per_sec is not None and throughput < args.min_records_per_sec:
+            print('           FAILED: %.1f records/s is under %.1f' % (throughput, args.min_records_per_sec))
+            ok = False
+
+    print('max resident set size %.1f MB' % (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0))
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
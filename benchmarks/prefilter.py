@@ -0,0 +1,80 @@
+'''Per-frame cost and drop fraction of the video capture pre-filters.
+
+Runs each pre-filter over every capture_rate-th frame of the given videos. Without
+arguments it synthesizes two 640x480 sample clips: an idle scene with sensor
+noise, and the same scene with an object crossing it for a third of the clip.
+
+Usage: python benchmarks/prefilter.py [--capture-rate N] [video ...]'''
+from __future__ import print_function
+import argparse
+import os
+import tempfile
+
+import localaws
+
+localaws.use_client_path()
+
+import cv2
+import numpy
+
+import prefilter
+
+FILTER_SETS = [['motion'], ['face'], ['motion', 'face']]
+
+
+def synthesize(path, moving, frames=300):
+    rng = numpy.random.RandomState(1)
+    background = cv2.GaussianBlur(rng.randint(0, 256, (480, 640, 3)).astype(numpy.uint8), (31, 31), 0)
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), 30, (640, 480))
+    for index in range(frames):
+        noise = rng.randint(-3, 4, background.shape)
+        frame = numpy.clip(background.astype(numpy.int16) + noise, 0, 255).astype(numpy.uint8)
+        if moving and frames // 3 <= index < 2 * frames // 3:
+            x = (index - frames // 3) * 640 // (frames // 3)
+            cv2.rectangle(frame, (x, 150), (x + 80, 330), (40, 40, 200), -1)
+        writer.write(frame)
+    writer.release()
+    return path
+
+
+def read_frames(path, capture_rate):
+    cap = cv2.VideoCapture(path)
+    frames = []
+    frame_count = 0
+    while True:
+        ret, frame = cap.read()
+        if ret is False:
+            break
+        if frame_count % capture_rate == 0:
+            frames.append(frame)
+        frame_count += 1
+    cap.release()
+    return frames
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--capture-rate', type=int, default=1)
+    parser.add_argument('videos', nargs='*')
+    args = parser.parse_args()
+
+    videos = args.videos
+    if not videos:
+        tmp_dir = tempfile.mkdtemp()
+        videos = [synthesize(os.path.join(tmp_dir, 'idle.avi'), False),
+                  synthesize(os.path.join(tmp_dir, 'motion.avi'), True)]
+
+    for video in videos:
+        frames = read_frames(video, args.capture_rate)
+        print('%s: %d sampled frames' % (os.path.basename(video), len(frames)))
+        for names in FILTER_SETS:
+            # max_idle_secs is disabled so the benchmark measures motion alone.
+            chain = prefilter.build_chain(names, motion_max_idle_secs=float('inf'))
+            kept = sum(1 for frame in frames if chain.accept(frame))
+            cost = sum(stats['ms_per_frame'] * stats['evaluated'] for stats in chain.stats().values()) / max(len(frames), 1)
+            print('  %-12s kept %4d  dropped %5.1f%%  %6.2f ms/frame' % (
+                '+'.join(names), kept, 100.0 * (len(frames) - kept) / max(len(frames), 1), cost))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+'''Times a 1,000-frame Frame Fetcher page with and without the signed URL cache.
+
+Fills a local EnrichedFrame table and fetches the same page several times
+through framefetcher.handler, as a polling dashboard would. The first request
+of each run signs every URL; later requests reuse them when the cache is on.
+The CloudFront modes sign with an RSA key generated on the spot when the
+cryptography package is installed. Without it they use an HMAC stand-in, which
+is much cheaper than RSA, so their timings only show the signing calls saved.
+
+Usage: python benchmarks/presign.py [frames] [requests]'''
+from __future__ import print_function
+import hashlib
+import hmac
+import json
+import os
+import statistics
+import sys
+import time
+import uuid
+from decimal import Decimal
+
+import localaws
+
+localaws.use_fake_credentials()
+localaws.use_lambda_path('framefetcher')
+
+import warmruntime
+import framefetcher
+import framequery
+import urlsigner
+
+GSI = 'processed_year_month-processed_timestamp-index'
+
+
+def fill(table, frames, end_ts):
+    for i in range(frames):
+        ts = end_ts - i * 0.5
+        frame_id = str(uuid.uuid4())
+        table.items[(frame_id,)] = {
+            'frame_id': frame_id,
+            'processed_timestamp': Decimal(str(ts)),
+            'approx_capture_timestamp': Decimal(str(ts - 1)),
+            'processed_year_month': framequery.month_of(ts),
+            's3_bucket': 'local-bucket',
+            's3_key': 'frames/2026/10/18/09/%s.jpg' % frame_id,
+            'camera_id': 'camera-0'
+        }
+
+
+def cloudfront_signer():
+    try:
+        from cryptography.hazmat.backends import default_backend
+        from cryptography.hazmat.primitives import serialization
+        from cryptography.hazmat.primitives.asymmetric import rsa
+    except ImportError:
+        secret = os.urandom(32)
+        return 'HMAC stand-in', lambda message: hmac.new(secret, message, hashlib.sha256).digest()
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048, backend=default_backend())
+    pem = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.TraditionalOpenSSL,
+                            serialization.NoEncryption())
+    return 'RSA 2048', urlsigner.rsa_signer(pem)
+
+
+def run(table, params, requests, mode, cache_size, signer):
+    warmruntime.reset()
+    #The result cache would answer repeated requests without signing anything
+    config = dict(warmruntime.load_config('framefetcher-params.json'), max_page_size=1000,
+                  pre_signed_url_cache_size=cache_size, result_cache_size=0)
+    warmruntime.set_config('framefetcher-params.json', config)
+    warmruntime.cached('framefetcher.table', lambda: table)
+    if mode != 's3':
+        warmruntime.cached('framefetcher.signer', lambda: urlsigner.UrlSigner(
+            mode, config['s3_pre_signed_url_expiry'], cache_size=cache_size,
+            cloudfront_domain='d111111abcdef8.cloudfront.net', key_pair_id='K2JCJMDEHXQW5F', signer=signer))
+
+    timings, bodies = [], set()
+    sys.stdout, real_stdout = open(os.devnull, 'w'), sys.stdout
+    try:
+        for _ in range(requests):
+            start = time.perf_counter()
+            response = framefetcher.handler({'httpMethod': 'GET', 'queryStringParameters': params}, None)
+            timings.append((time.perf_counter() - start) * 1000)
+            if response['statusCode'] != '200':
+                raise ValueError(response['body'])
+            bodies.add(response['body'])
+    finally:
+        sys.stdout = real_stdout
+    frames = len(json.loads(response['body']))
+    stats = warmruntime.cached('framefetcher.signer', lambda: None).stats
+    print('%-17s cache %-4s %4d frames  first %7.1f ms  later %7.1f ms (median)  signed %5d  identical bodies %s' % (
+        mode, 'on' if cache_size else 'off', frames, timings[0], statistics.median(timings[1:]),
+        stats['signed'], 'yes' if len(bodies) == 1 else 'no'))
+
+
+def main():
+    frames = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    requests = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+    os.chdir(localaws.CONFIG_DIR)
+    end_ts = time.time() - 3600
+    table = localaws.LocalDynamoTable('EnrichedFrame', ['frame_id'], latency=0.0,
+                                      indexes={GSI: ('processed_year_month', 'processed_timestamp')})
+    fill(table, frames, end_ts)
+    params = {'from': str(end_ts - frames), 'to': str(end_ts), 'limit': str(frames)}
+
+    signer_name, signer = cloudfront_signer()
+    print('CloudFront signatures: %s' % signer_name)
+    for mode in urlsigner.SIGNING_MODES:
+        for cache_size in (0, 10000):
+            run(table, params, requests, mode, cache_size, signer)
+
+
+if __name__ == '__main__':
+    main()
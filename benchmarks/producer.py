@@ -0,0 +1,63 @@
+'''Compares one PutRecord per frame with the batching KinesisProducer against a local Kinesis stream.
+
+Usage: python benchmarks/producer.py [frames] [cameras] [shards] [latency_ms]'''
+from __future__ import print_function
+import os
+import sys
+import time
+
+import localaws
+
+localaws.use_client_path()
+
+from producer import KinesisProducer, partition_key_for
+
+
+def run_put_record(frames, cameras, shards, latency):
+    stream = localaws.LocalKinesis(shards, latency)
+    data = os.urandom(30 * 1024)
+    sent = failed = 0
+    start = time.perf_counter()
+    for frame_count in range(frames):
+        try:
+            stream.put_record(StreamName='FrameStream', Data=data, PartitionKey='partitionkey')
+            sent += 1
+        except Exception:
+            failed += 1
+    elapsed = time.perf_counter() - start
+    print('put_record   %7.0f records/s  sent %5d  failed %5d  requests %5d  shard records %s' % (
+        sent / elapsed, sent, failed, stream.requests, [len(shard) for shard in stream.shards]))
+
+
+def run_producer(frames, cameras, shards, latency):
+    stream = localaws.LocalKinesis(shards, latency)
+    kinesis_producer = KinesisProducer(stream, 'FrameStream', linger_secs=0.05)
+    data = os.urandom(30 * 1024)
+    start = time.perf_counter()
+    for frame_count in range(frames):
+        kinesis_producer.put(data, partition_key_for(frame_count % cameras))
+    kinesis_producer.close()
+    elapsed = time.perf_counter() - start
+    stats = kinesis_producer.stats.snapshot()
+    print('put_records  %7.0f records/s  sent %5d  failed %5d  requests %5d  shard records %s' % (
+        stats['records_sent'] / elapsed, stats['records_sent'], stats['records_failed'],
+        stream.requests, [len(shard) for shard in stream.shards]))
+    print('             retried %d, throttled %d, latency p50 %.1f ms, p99 %.1f ms' % (
+        stats['records_retried'], stats['throttled'],
+        stats.get('latency_p50', 0) * 1000, stats.get('latency_p99', 0) * 1000))
+
+
+def main():
+    frames = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    cameras = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    shards = int(sys.argv[3]) if len(sys.argv) > 3 else 4
+    latency = float(sys.argv[4]) / 1000 if len(sys.argv) > 4 else 0.02
+
+    print('%d frames of 30 KB from %d cameras, %d shards, %.0f ms per request' % (
+        frames, cameras, shards, latency * 1000))
+    run_put_record(frames, cameras, shards, latency)
+    run_producer(frames, cameras, shards, latency)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+'''Rekognition calls saved by the recognition result cache, and faces it would miss.
+
+Feeds frames from --cameras static cameras through imageprocessor.handler
+against a stubbed Rekognition that finds a face exactly in the frames that
+show one. Each camera sends its scene with a little sensor noise, and now
+and then a person about 40 x 50 pixels walks through it for a few frames.
+Compares searching every frame with the cache using content, dhash and phash
+keys, and with two containers sharing results through a local DynamoDB
+stand-in.
+
+Reports Rekognition calls, the cache's hit rate, and frames whose reused
+result was wrong: a person in the frame but no match (missed), or a match
+with nobody there (false).
+
+Usage: python benchmarks/recognitioncache.py [--frames N] [--cameras N] [--batch N]'''
+from __future__ import print_function
+import argparse
+import base64
+import hashlib
+import io
+import json
+import os
+import sys
+import time
+
+import numpy as np
+from PIL import Image
+
+import localaws
+
+localaws.use_fake_credentials()
+localaws.use_lambda_path('imageprocessor')
+
+import frameformat
+import imageprocessor
+import resultcache
+import warmruntime
+
+
+def jpeg(pixels):
+    output = io.BytesIO()
+    Image.fromarray(pixels).save(output, format='JPEG', quality=85)
+    return output.getvalue()
+
+
+def camera_frames(rng, camera_id, count, person_every, person_frames):
+    '''(camera_id, jpeg, has_person) of a static scene with noise and someone passing now and then.'''
+    scene = rng.randint(0, 255, (240, 320, 3)).astype(np.uint8)
+    scene = np.array(Image.fromarray(scene).resize((32, 24)).resize((320, 240), Image.BILINEAR)).astype(int)
+    face = rng.randint(20, 90, (50, 40, 3))
+    face[10:18, 8:16] = face[10:18, 24:32] = 230
+    frames = []
+    for index in range(count):
+        pixels = scene + rng.randint(-3, 4, scene.shape)
+        step = index % person_every
+        has_person = index >= person_every and step < person_frames
+        if has_person:
+            x = 40 + step * (200 // person_frames)
+            pixels[120:170, x:x + 40] = face
+        frames.append((camera_id, jpeg(np.clip(pixels, 0, 255).astype(np.uint8)), has_person))
+    return frames
+
+
+def event_for(frames):
+    event = localaws.kinesis_event(len(frames))
+    for frame_count, (record, (camera_id, image_bytes, _)) in enumerate(zip(event['Records'], frames)):
+        data = frameformat.encode_frame(image_bytes, time.time(), frame_count, camera_id)
+        record['kinesis']['data'] = base64.b64encode(data).decode('ascii')
+        record['kinesis']['partitionKey'] = camera_id
+    return event
+
+
+class ScoredCache(resultcache.RecognitionCache):
+    '''Counts frames whose answer disagrees with whether someone was in them.'''
+
+    def __init__(self, truth, *args, **kwargs):
+        resultcache.RecognitionCache.__init__(self, *args, **kwargs)
+        self.truth = truth
+        self.stats.update({'missed': 0, 'false': 0})
+
+    def search(self, image_bytes, *args, **kwargs):
+        response = resultcache.RecognitionCache.search(self, image_bytes, *args, **kwargs)
+        has_person = self.truth[hashlib.sha1(image_bytes).digest()]
+        matched = bool(response.get('FaceMatches'))
+        if has_person and not matched:
+            self._count('missed')
+        elif matched and not has_person:
+            self._count('false')
+        return response
+
+
+def run(name, args, events, truth, overrides, containers=1):
+    warmruntime.reset()
+    config = dict(warmruntime.load_config('imageprocessor-params.json'))
+    config.update(overrides)
+    warmruntime.set_config('imageprocessor-params.json', config)
+
+    def search(request):
+        image_bytes = base64.b64decode(json.loads(request.body)['Image']['Bytes'])
+        return localaws.face_match_response() if truth[hashlib.sha1(image_bytes).digest()] else {'FaceMatches': []}
+
+    responder = localaws.StubResponder(
+        {'rekognition.SearchFacesByImage': search},
+        latency={'rekognition.SearchFacesByImage': args.search_latency / 1000.0, '*': 0.002})
+    responder.install(warmruntime.session())
+
+    shared = localaws.LocalDynamoDB(latency=args.ddb_latency / 1000.0) if config['ddb_recognition_cache_table'] else None
+    if shared is not None:
+        shared.create_table(config['ddb_recognition_cache_table'], ('cache_key',))
+    contexts = []
+    sys.stdout, real_stdout = open(os.devnull, 'w'), sys.stdout
+    try:
+        for _ in range(containers):
+            ctx = imageprocessor.build_context()
+            hash_size = config['recognition_cache_hash_size']
+            ctx['results'] = ScoredCache(
+                truth,
+                resultcache.LocalResultStore(config['recognition_cache_size']),
+                resultcache.DynamoResultStore(shared, config['ddb_recognition_cache_table'],
+                                              hash_bits=hash_size * hash_size) if shared else None,
+                hash_mode=config['recognition_cache_hash'],
+                hash_size=hash_size,
+                max_distance=config['recognition_cache_max_distance'],
+                ttl_secs=config['recognition_cache_ttl_secs'])
+            contexts.append(ctx)
+
+        start = time.perf_counter()
+        for index, event in enumerate(events):
+            # Batches go to the containers in turn, as Lambda spreads shards over them
+            warmruntime._objects['imageprocessor.context'] = contexts[index % containers]
+            imageprocessor.handler(event, None)
+        elapsed = time.perf_counter() - start
+    finally:
+        sys.stdout = real_stdout
+
+    stats = dict((key, sum(ctx['results'].stats[key] for ctx in contexts)) for key in contexts[0]['results'].stats)
+    hits = stats['local_hits'] + stats['shared_hits']
+    frames = sum(len(event['Records']) for event in events)
+    print('%-22s %5d frames  %6.1f ms per frame  Rekognition calls %5d  hit rate %3.0f%% (%4d shared)  '
+          'missed %3d  false %3d' % (
+              name, frames, elapsed * 1000 / frames, responder.calls.get('rekognition.SearchFacesByImage', 0),
+              100.0 * hits / max(1, stats['lookups']), stats['shared_hits'], stats['missed'], stats['false']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Recognition result cache benchmark.')
+    parser.add_argument('--frames', type=int, default=100, help='Frames per camera.')
+    parser.add_argument('--cameras', type=int, default=4)
+    parser.add_argument('--batch', type=int, default=20, help='Records per Kinesis batch.')
+    parser.add_argument('--person-every', type=int, default=25, help='Frames between people walking by.')
+    parser.add_argument('--person-frames', type=int, default=5, help='Frames a person stays in view.')
+    parser.add_argument('--search-latency', type=float, default=120.0, help='Simulated Rekognition latency, ms.')
+    parser.add_argument('--ddb-latency', type=float, default=5.0, help='Simulated DynamoDB latency, ms.')
+    args = parser.parse_args()
+
+    os.chdir(localaws.CONFIG_DIR)
+    rng = np.random.RandomState(7)
+    per_camera = [camera_frames(rng, 'camera-%d' % camera, args.frames, args.person_every, args.person_frames)
+                  for camera in range(args.cameras)]
+    # Interleave the cameras, as their records arrive on the stream
+    frames = [frame for group in zip(*per_camera) for frame in group]
+    truth = dict((hashlib.sha1(image_bytes).digest(), has_person) for _, image_bytes, has_person in frames)
+    events = [event_for(frames[i:i + args.batch]) for i in range(0, len(frames), args.batch)]
+
+    base = {'max_concurrency': 1, 'archive_matches_only': True, 'recognition_cache_ttl_secs': 60,
+            'recognition_cache_size': 1024, 'recognition_cache_hash': 'phash', 'recognition_cache_hash_size': 16,
+            'recognition_cache_max_distance': 8, 'ddb_recognition_cache_table': ''}
+    run('no cache', args, events, truth, dict(base, recognition_cache_ttl_secs=0))
+    run('content', args, events, truth, dict(base, recognition_cache_hash='content'))
+    run('dhash 8x8, 4 bits', args, events, truth,
+        dict(base, recognition_cache_hash='dhash', recognition_cache_hash_size=8, recognition_cache_max_distance=4))
+    run('phash 16x16, 8 bits', args, events, truth, base)
+    run('phash, 2 containers', args, events, truth, base, containers=2)
+    run('phash, 2 shared', args, events, truth, dict(base, ddb_recognition_cache_table='RecognitionCache'),
+        containers=2)
+
+
+if __name__ == '__main__':
+    main()
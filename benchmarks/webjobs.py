@@ -0,0 +1,148 @@
+'''Web tier responsiveness with compare requests run inline and as background jobs.
+
+Imports the web app with S3 and Rekognition answered by StubResponder and
+sends --users compare requests at once through a pool of --threads web
+server threads, as a threaded gunicorn worker would serve them:
+
+inline - Each request uploads the image to S3 and searches the collection
+    before it answers, as /compare did before jobs.
+jobs - Each request queues a job on the app's job queue and answers at once.
+    The user then polls /jobs/<id> every --poll seconds until it is done.
+    Rekognition gets the image bytes, so nothing is uploaded.
+
+While the compares run, a user loads the home page every 50 ms. Reports how
+long users waited for their result, how long the home page took, and how
+many S3 uploads were made.
+
+Usage: python benchmarks/webjobs.py [--users N] [--threads N] [--workers N] [--poll S]'''
+from __future__ import print_function
+import argparse
+import io
+import math
+import os
+import re
+import statistics
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import localaws
+
+localaws.use_fake_credentials()
+localaws.use_app_path()
+
+import boto3
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[max(0, int(math.ceil(len(values) * fraction)) - 1)]
+
+
+class WebServer(object):
+    '''Runs every request on one of threads threads, like a threaded gunicorn worker.'''
+
+    def __init__(self, app, threads):
+        self.client = app.test_client()
+        self.pool = ThreadPoolExecutor(max_workers=threads)
+
+    def request(self, fn):
+        return self.pool.submit(fn, self.client).result()
+
+
+def inline_compare(application, image_bytes):
+    '''The compare request as it was: upload to S3, then search the uploaded image.'''
+    def handle(client):
+        image_key = '%s.jpg' % uuid.uuid4()
+        application.s3_client.upload_fileobj(io.BytesIO(image_bytes), application.s3_bucket_name, image_key)
+        application.rekognition_client.search_faces_by_image(
+            CollectionId=application.rekognition_collection_name,
+            Image={'S3Object': {'Bucket': application.s3_bucket_name, 'Name': image_key}})
+    return handle
+
+
+def job_compare(server, image_bytes, poll):
+    def post(client):
+        return client.post('/compare', data={'image_to_compare': (io.BytesIO(image_bytes), 'probe.jpg')},
+                           content_type='multipart/form-data').get_data(as_text=True)
+    page = server.request(post)
+    job_id = re.search(r'/jobs/([0-9a-f-]+)', page).group(1)
+    while True:
+        state = server.request(lambda client: client.get('/jobs/%s' % job_id).get_json())['state']
+        if state in ('done', 'failed'):
+            return state
+        time.sleep(poll)
+
+
+def run(name, args, server, responder, user):
+    calls_before = dict(responder.calls)
+    waits, home, done = [], [], threading.Event()
+
+    def browse():
+        while not done.is_set():
+            start = time.time()
+            server.request(lambda client: client.get('/'))
+            home.append(time.time() - start)
+            time.sleep(0.05)
+
+    def compare():
+        start = time.time()
+        user()
+        waits.append(time.time() - start)
+
+    browser = threading.Thread(target=browse)
+    browser.start()
+    start = time.time()
+    users = [threading.Thread(target=compare) for _ in range(args.users)]
+    for thread in users:
+        thread.start()
+    for thread in users:
+        thread.join()
+    elapsed = time.time() - start
+    done.set()
+    browser.join()
+    uploads = responder.calls.get('s3.PutObject', 0) - calls_before.get('s3.PutObject', 0)
+    print('%-6s %4d users  all done in %5.2f s  result wait p50 %6.0f ms  p99 %6.0f ms  '
+          'home page p50 %6.0f ms  max %6.0f ms  S3 uploads %4d' % (
+              name, args.users, elapsed, statistics.median(waits) * 1000, percentile(waits, 0.99) * 1000,
+              statistics.median(home) * 1000, max(home) * 1000, uploads))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Web job queue benchmark.')
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--threads', type=int, default=8, help='Web server threads.')
+    parser.add_argument('--workers', type=int, default=8, help='Job queue workers.')
+    parser.add_argument('--poll', type=float, default=0.5, help='Seconds between job status requests.')
+    parser.add_argument('--upload-latency', type=float, default=80.0, help='Simulated S3 upload latency, ms.')
+    parser.add_argument('--search-latency', type=float, default=300.0, help='Simulated Rekognition latency, ms.')
+    args = parser.parse_args()
+
+    boto3.setup_default_session()
+    responder = localaws.StubResponder(
+        {'rekognition.SearchFacesByImage': localaws.face_match_response(), 's3.PutObject': b''},
+        latency={'rekognition.SearchFacesByImage': args.search_latency / 1000.0,
+                 's3.PutObject': args.upload_latency / 1000.0})
+    responder.install(boto3.DEFAULT_SESSION)
+
+    os.chdir(localaws.ROOT_DIR)
+    sys.stdout, real_stdout = open(os.devnull, 'w'), sys.stdout
+    try:
+        import application
+    finally:
+        sys.stdout = real_stdout
+    application.config['job_workers'] = args.workers
+    application.config['job_queue_size'] = args.users
+    application.application.config['LOGIN_DISABLED'] = True
+    application.application.config['WTF_CSRF_ENABLED'] = False
+
+    image_bytes = b'\xff\xd8' + os.urandom(200000)
+    server = WebServer(application.application, args.threads)
+    run('inline', args, server, responder, lambda: server.request(inline_compare(application, image_bytes)))
+    run('jobs', args, server, responder, lambda: job_compare(server, image_bytes, args.poll))
+
+
+if __name__ == '__main__':
+    main()
@@ -3,6 +3,8 @@
 #     http://aws.amazon.com/asl/
 # or in the "license" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions and limitations under the License.
 import os
+import sys
+import base64
 import shutil
 import zipfile
 import time
@@ -11,7 +13,7 @@ import boto3
 import botocore
 from botocore.exceptions import ClientError
 import json
-from subprocess import call
+from subprocess import call, check_call
 import http.server
 import socketserver
 
@@ -94,6 +96,18 @@ def packagelambda(* functions):
         zipf = zipfile.ZipFile("%s.zip" % function, "w", zipfile.ZIP_DEFLATED)
         
         write_dir_to_zip("../lambda/%s/" % function, zipf)
+        write_dir_to_zip("../lambda/common/", zipf)
+
+        #Dependencies listed in lambda/<function>/requirements.txt, as wheels for the Lambda runtime
+        requirements = "../lambda/%s/requirements.txt" % function
+        if os.path.exists(requirements):
+            deps_dir = "%s-deps" % function
+            if os.path.exists(deps_dir):
+                shutil.rmtree(deps_dir)
+            check_call([sys.executable, "-m", "pip", "install", "-r", requirements, "-t", deps_dir,
+                        "--platform", "manylinux2014_x86_64", "--implementation", "cp", "--python-version", "3.7",
+                        "--only-binary=:all:", "--upgrade"])
+            write_dir_to_zip(deps_dir, zipf)
         zipf.write("../config/%s-params.json" % function, "%s-params.json" % function)
 
         zipf.close()
@@ -170,16 +184,161 @@ def deploylambda(* functions, **kwargs):
     return
 
 @task()
-def videocapture(capturerate="30",clientdir="client"):
-    '''Run the video capture client with built-in camera. Default capture rate is 1 every 30 frames.'''
+def videocapture(capturerate="30",clientdir="client",*sources,**kwargs):
+    '''Run the video capture client. Default is the built-in camera and a capture rate of 1 every 30 frames.'''
     os.chdir(clientdir)
-    
-    call(["python", "video_cap.py", capturerate])
+
+    args = ["python", "video_cap.py", capturerate]
+    args += ["--source=%s" % source for source in sources]
+    if kwargs.get("headless", "no").lower() in ("yes", "true", "1"):
+        args.append("--headless")
+    if "profile" in kwargs:
+        args.append("--profile=%s" % kwargs["profile"])
+
+    call(args)
 
     os.chdir("..")
 
     return
 
+@task()
+def buildfaceindex(output="client/faceindex", embedder="sface", model_path=None, global_params_path="config/global-params.json"):
+    '''Build the local face index used by the video capture client's watchlist pre-filter from the enrolled watchlist images.'''
+    if embedder == "sface" and not model_path:
+        raise ValueError("buildfaceindex needs the SFace ONNX model path, e.g. \"buildfaceindex[client/faceindex,sface,face_recognition_sface_2021dec.onnx]\".")
+    sys.path.append(os.path.abspath("client"))
+    import cv2
+    import numpy
+    import facematch
+    import prefilter
+
+    global_params_dict = read_json(global_params_path)
+    table = boto3.resource('dynamodb').Table(global_params_dict["ddb_input_image_table"])
+    s3 = boto3.client('s3')
+
+    detector = prefilter.FaceFilter(width=640)
+    faces = []
+    scan_kwargs = {}
+    while True:
+        response = table.scan(**scan_kwargs)
+        for item in response["Items"]:
+            if int(item["ID"]) == 0 or "ImageURL" not in item:
+                continue #Watchlist version stamp
+            image_key = item["ImageURL"].split(".amazonaws.com/", 1)[-1]
+            body = s3.get_object(Bucket=global_params_dict["s3_bucket"], Key=image_key)["Body"].read()
+            image = cv2.imdecode(numpy.frombuffer(body, numpy.uint8), cv2.IMREAD_COLOR)
+            boxes = detector.detect(image) if image is not None else []
+            if not boxes:
+                print("No face found for watchlist entry %s, skipping." % item["ID"])
+                continue
+            box = max(boxes, key=lambda box: box[2] * box[3])
+            faces.append((str(int(item["ID"])), facematch.crop_face(image, box)))
+        if "LastEvaluatedKey" not in response:
+            break
+        scan_kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+    index = facematch.FaceIndex.build(faces, facematch.build_embedder(embedder, model_path))
+    index.save(output)
+    print("Saved %d watchlist faces to %s.npy/.json" % (len(index), output))
+
+    return
+
+@task()
+def enrollwatchlist(manifest, workers=None, journal=None, global_params_path="config/global-params.json"):
+    '''Enroll everyone in a ZIP or CSV manifest in the watchlist. Running it again resumes where it stopped.'''
+    sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+    import enrollment
+
+    global_params_dict = read_json(global_params_path)
+    workers = int(workers or global_params_dict.get("enrollment_workers", 8))
+    client_config = enrollment.client_config(max_pool_connections=workers + 2)
+    s3 = boto3.client('s3', config=client_config)
+    enroller = enrollment.Enroller(
+        s3,
+        boto3.client('rekognition', config=client_config),
+        boto3.resource('dynamodb', config=client_config).Table(global_params_dict["ddb_input_image_table"]),
+        global_params_dict["s3_bucket"],
+        global_params_dict["rekognition_col_name"],
+        key_prefix=global_params_dict.get("enrollment_key_prefix", "watchlist/"),
+        max_workers=workers,
+        version_every_secs=global_params_dict.get("enrollment_version_every_secs", 5),
+        index_faces_tps=global_params_dict.get("enrollment_index_faces_tps", 50))
+
+    entries = enrollment.read_manifest(manifest, s3)
+    journal = journal or manifest + ".journal"
+    print("Enrolling %d people from %s with %d workers, journal %s." % (len(entries), manifest, workers, journal))
+    progress = enroller.run(entries, journal_path=journal, report=print)
+    for error in progress.errors:
+        print("Failed: %s: %s" % (error["image"], error["error"]))
+
+    return
+
+@task()
+def replaydeadletters(stream_name="FrameStream", include_permanent="no", image_processor_params_path="config/imageprocessor-params.json"):
+    '''Put frames that Image Processor could not process back on the Kinesis stream, and delete their dead-letter objects.'''
+    img_processor_params_dict = read_json(image_processor_params_path)
+    bucket = img_processor_params_dict["s3_bucket"]
+    prefix = img_processor_params_dict["s3_key_dead_letter_root"]
+    replay_permanent = include_permanent.lower() in ("yes", "true", "1")
+
+    s3 = boto3.client('s3')
+    kinesis = boto3.client('kinesis')
+
+    replayed = kept = 0
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            body = s3.get_object(Bucket=bucket, Key=obj["Key"])["Body"].read().decode('utf-8')
+            entries = [json.loads(line) for line in body.splitlines() if line.strip()]
+            #Invalid images and similar errors fail again on replay; keep them for inspection.
+            permanent = [entry for entry in entries if not entry.get("retryable", True)]
+            if replay_permanent:
+                permanent = []
+            pending = [entry for entry in entries if entry not in permanent]
+
+            for attempt in range(5):
+                if not pending:
+                    break
+                failed = []
+                for i in range(0, len(pending), 500):
+                    batch = pending[i:i + 500]
+                    response = kinesis.put_records(StreamName=stream_name, Records=[
+                        {'Data': base64.b64decode(entry["data"]), 'PartitionKey': entry["partition_key"] or "replay"}
+                        for entry in batch])
+                    failed += [entry for entry, result in zip(batch, response["Records"]) if "ErrorCode" in result]
+                replayed += len(pending) - len(failed)
+                pending = failed
+                if pending:
+                    time.sleep(0.5 * (2 ** attempt))
+
+            if pending or permanent:
+                #Rewrite the object with what is left, so a later run does not replay records twice.
+                print("Keeping %s: %d records not replayed, %d with permanent errors." % (obj["Key"], len(pending), len(permanent)))
+                s3.put_object(Bucket=bucket, Key=obj["Key"],
+                              Body='\n'.join(json.dumps(entry) for entry in permanent + pending).encode('utf-8'))
+                kept += 1
+            else:
+                s3.delete_object(Bucket=bucket, Key=obj["Key"])
+
+    print("Replayed %d records to %s; kept %d dead-letter objects." % (replayed, stream_name, kept))
+
+    return
+
+@task()
+def benchmark(name="coldstart", *args):
+    '''Run a benchmark from the benchmarks directory against local AWS stand-ins. Default is the cold/warm start benchmark.'''
+    call(["python", "benchmarks/%s.py" % name] + list(args))
+
+    return
+
+@task()
+def perfcheck(min_records_per_sec="10", max_p99_ms="2000"):
+    '''Fail if the end-to-end pipeline benchmark falls below conservative throughput and latency limits.'''
+    #Small enough to run before every merge; the limits leave room for slow or busy machines
+    check_call(["python", "benchmarks/pipeline.py", "--batch-sizes", "10", "--frames", "80", "--no-memory",
+                "--min-records-per-sec", min_records_per_sec, "--max-p99-ms", max_p99_ms])
+
+    return
+
 @task()
 def deletedata(global_params_path="config/global-params.json", cfn_params_path="config/cfn-params.json", image_processor_params_path="config/imageprocessor-params.json"):
     '''DELETE ALL collected frames and metadata in Amazon S3 and Amazon DynamoDB. Use with caution!'''
@@ -0,0 +1,348 @@
+import os
+import queue
+import sys
+import threading
+import time
+from collections import deque
+from multiprocessing import Pool, shared_memory
+
+import cv2
+import numpy
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda', 'common'))
+import frameformat
+from producer import partition_key_for
+from sampler import FixedSampler
+from encoding import PROFILES
+
+
+def open_source(source):
+    '''Opens a camera index ("0"), RTSP/HTTP URL or video file with OpenCV.'''
+    source = str(source)
+    return cv2.VideoCapture(int(source) if source.isdigit() else source)
+
+
+def camera_id_for(source, index):
+    '''Short camera id for a source. Camera indexes keep their number; URLs and files get "camN".'''
+    source = str(source)
+    return source if source.isdigit() else 'cam{}'.format(index)
+
+
+class CameraStats(object):
+    '''Per-camera frame counters.'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.captured = 0
+        self.sampled = 0
+        self.filtered = 0
+        self.encoded = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def increment(self, name, count=1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + count)
+
+
+class FrameQueue(object):
+    '''Bounded queue that drops its oldest frame when a new one arrives while it is full.'''
+
+    def __init__(self, maxsize, stats):
+        self._frames = deque()
+        self._maxsize = maxsize
+        self._cond = threading.Condition()
+        self._stats = stats
+        self._closed = False
+
+    def put(self, item):
+        with self._cond:
+            if len(self._frames) >= self._maxsize:
+                self._frames.popleft()
+                self._stats.increment('dropped')
+            self._frames.append(item)
+            self._cond.notify()
+
+    def get(self):
+        '''Returns the oldest frame, or None once the queue is closed and empty.'''
+        with self._cond:
+            while not self._frames and not self._closed:
+                self._cond.wait()
+            return self._frames.popleft() if self._frames else None
+
+    def __len__(self):
+        with self._cond:
+            return len(self._frames)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+
+class SharedFrameBuffers(object):
+    '''Fixed set of shared-memory slots that hand raw frames to encoder processes without pickling them.'''
+
+    def __init__(self, slot_count):
+        self._slots = [None] * slot_count
+        self._free = deque(range(slot_count))
+        self._cond = threading.Condition()
+
+    def acquire(self, nbytes, stop_event):
+        '''Returns a free slot index and its shared memory, waiting for one if all are busy.'''
+        with self._cond:
+            while not self._free:
+                if stop_event.is_set():
+                    return None, None
+                self._cond.wait(0.1)
+            index = self._free.popleft()
+            shm = self._slots[index]
+            if shm is None or shm.size < nbytes:
+                if shm is not None:
+                    shm.close()
+                    shm.unlink()
+                shm = self._slots[index] = shared_memory.SharedMemory(create=True, size=nbytes)
+            return index, shm
+
+    def release(self, index):
+        with self._cond:
+            self._free.append(index)
+            self._cond.notify()
+
+    def close(self):
+        with self._cond:
+            for shm in self._slots:
+                if shm is not None:
+                    shm.close()
+                    shm.unlink()
+            self._slots = [None] * len(self._slots)
+
+
+# Shared memory blocks attached by this encoder process, by name.
+_attached = {}
+
+def _attach(name):
+    shm = _attached.get(name)
+    if shm is None:
+        shm = _attached[name] = shared_memory.SharedMemory(name=name)
+        try:
+            # The parent owns the block; stop this process from unlinking it at exit.
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        except Exception:
+            pass
+    return shm
+
+def encode_shared_frame(shm_name, shape, dtype, capture_ts, frame_count, camera_id, profile):
+    '''Encodes a frame held in shared memory as a Kinesis record, using an EncodingProfile. Runs in an encoder process.'''
+    shm = _attach(shm_name)
+    frame = numpy.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    buff = profile.encode(frame)
+    return frameformat.encode_frame(buff, capture_ts, frame_count, camera_id)
+
+
+class CameraReader(threading.Thread):
+    '''Reads one source and queues the frames its sampler picks and its pre-filter passes.'''
+
+    def __init__(self, source, camera_id, sampler, queue_size, stop_event, prefilter=None):
+        super(CameraReader, self).__init__(name='camera-{}'.format(camera_id))
+        self.daemon = True
+        self.source = source
+        self.camera_id = camera_id
+        self.sampler = sampler
+        self.stats = CameraStats()
+        self.queue = FrameQueue(queue_size, self.stats)
+        self.prefilter = prefilter
+        self.latest_frame = None
+        self._stop_event = stop_event
+
+    def run(self):
+        cap = open_source(self.source)
+        if not cap.isOpened():
+            print('Could not open source "{}".'.format(self.source))
+        frame_count = 0
+        try:
+            while not self._stop_event.is_set():
+                ret, frame = cap.read()
+                if ret is False:
+                    break
+                capture_ts = time.time()
+                self.stats.increment('captured')
+                self.latest_frame = frame
+
+                if self.sampler.should_sample(frame_count):
+                    self.stats.increment('sampled')
+                    if self.prefilter is None:
+                        active = None
+                    else:
+                        active = self.prefilter.accept(frame)
+                    if active is False:
+                        self.stats.increment('filtered')
+                    else:
+                        self.queue.put((capture_ts, frame_count, frame))
+                    self.sampler.update(active)
+                frame_count += 1
+        finally:
+            cap.release()
+            self.queue.close()
+
+
+class CaptureDaemon(object):
+    '''Captures from several cameras, RTSP streams or files at once and sends sampled frames to Kinesis.
+
+    Each source has its own reader thread and a bounded queue that drops the
+    oldest frame when encoding falls behind. sampler_factory, if given, is
+    called once per source to build its sampler (see sampler.py); by default
+    every capture_rate-th frame is sampled. prefilter_factory, if given, is
+    called once per source to build the pre-filter (see prefilter.py) that
+    sampled frames must pass before they are queued. JPEG encoding, with
+    encoding_profile (see encoding.py), runs in a process pool; frames reach it
+    through shared memory instead of being pickled. Encoded frames are handed to
+    the Kinesis producer by a thread of their own, so a send that blocks does
+    not hold up the pool's result callbacks.'''
+
+    def __init__(self, sources, kinesis_producer, capture_rate=30, queue_size=4, workers=3,
+                 headless=False, stats_interval=10.0, prefilter_factory=None, sampler_factory=None,
+                 encoding_profile=None):
+        self.kinesis_producer = kinesis_producer
+        self.encoding_profile = encoding_profile or PROFILES['original']
+        self.headless = headless
+        self.stats_interval = stats_interval
+        self.workers = workers
+        self._stop_event = threading.Event()
+        if sampler_factory is None:
+            sampler_factory = lambda: FixedSampler(capture_rate)
+        self.readers = [
+            CameraReader(source, camera_id_for(source, index), sampler_factory(), queue_size, self._stop_event,
+                         prefilter_factory() if prefilter_factory else None)
+            for index, source in enumerate(sources)
+        ]
+        self._buffers = SharedFrameBuffers(workers * 2)
+        self._dispatchers = []
+        self._pool = None
+        self._encoded = queue.Queue()
+        self._forwarder = threading.Thread(target=self._forward, name='kinesis-forward')
+        self._forwarder.daemon = True
+
+    def run(self):
+        '''Runs until every source ends, "q" is pressed or the process is interrupted.'''
+        self._pool = Pool(processes=self.workers)
+        self._forwarder.start()
+        for reader in self.readers:
+            dispatcher = threading.Thread(target=self._dispatch, args=(reader,), name='dispatch-{}'.format(reader.camera_id))
+            dispatcher.daemon = True
+            self._dispatchers.append(dispatcher)
+            reader.start()
+            dispatcher.start()
+
+        last_report = time.time()
+        try:
+            while any(reader.is_alive() for reader in self.readers):
+                if self.headless:
+                    time.sleep(0.1)
+                elif self._show_frames():
+                    break
+                if time.time() - last_report >= self.stats_interval:
+                    self.print_stats()
+                    last_report = time.time()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+        self.print_stats()
+
+    def stop(self):
+        self._stop_event.set()
+        for reader in self.readers:
+            reader.join()
+        for dispatcher in self._dispatchers:
+            dispatcher.join()
+        self._pool.close()
+        self._pool.join()
+        self._buffers.close()
+        self._encoded.put(None)
+        self._forwarder.join()
+        self.kinesis_producer.flush()
+        if not self.headless:
+            cv2.destroyAllWindows()
+
+    def _show_frames(self):
+        '''Displays the latest frame of every camera. Returns True when "q" is pressed.'''
+        for reader in self.readers:
+            if reader.latest_frame is not None:
+                cv2.imshow('camera {}'.format(reader.camera_id), reader.latest_frame)
+        return cv2.waitKey(1) & 0xFF == ord('q')
+
+    def _forward(self):
+        '''Puts encoded frames to the Kinesis producer until stop() queues None.'''
+        while True:
+            item = self._encoded.get()
+            if item is None:
+                return
+            try:
+                self.kinesis_producer.put(*item)
+            except Exception as e:
+                print('Could not send frame: {}'.format(e))
+
+    def _dispatch(self, reader):
+        partition_key = partition_key_for(reader.camera_id)
+        pending = []
+        while True:
+            item = reader.queue.get()
+            if item is None:
+                break
+            capture_ts, frame_count, frame = item
+
+            index, shm = self._buffers.acquire(frame.nbytes, self._stop_event)
+            if index is None:
+                break
+            numpy.ndarray(frame.shape, dtype=frame.dtype, buffer=shm.buf)[...] = frame
+
+            def sent(frame_package, index=index):
+                self._buffers.release(index)
+                reader.stats.increment('encoded')
+                #Runs on the pool's only result thread; sending could block it, so it is queued
+                self._encoded.put((frame_package, partition_key))
+
+            def failed(error, index=index):
+                self._buffers.release(index)
+                reader.stats.increment('failed')
+                print(error)
+
+            pending.append(self._pool.apply_async(
+                encode_shared_frame,
+                (shm.name, frame.shape, frame.dtype.str, capture_ts, frame_count, reader.camera_id,
+                 self.encoding_profile),
+                callback=sent, error_callback=failed))
+            pending = [result for result in pending if not result.ready()]
+
+        for result in pending:
+            result.wait()
+
+    def stats(self):
+        '''Per-camera counters: frames captured, sampled, filtered, encoded, dropped, failed and sent.'''
+        stats = {}
+        for reader in self.readers:
+            stats[reader.camera_id] = {
+                'source': str(reader.source),
+                'captured': reader.stats.captured,
+                'sampled': reader.stats.sampled,
+                'filtered': reader.stats.filtered,
+                'encoded': reader.stats.encoded,
+                'dropped': reader.stats.dropped,
+                'failed': reader.stats.failed,
+                'sent': self.kinesis_producer.stats.sent_for(partition_key_for(reader.camera_id)),
+                'queued': len(reader.queue),
+                'interval': reader.sampler.interval,
+            }
+            if reader.prefilter is not None:
+                stats[reader.camera_id]['prefilter'] = reader.prefilter.stats()
+        return stats
+
+    def print_stats(self):
+        for camera_id, stats in sorted(self.stats().items()):
+            print('camera {camera_id}: captured {captured}, sampled {sampled}, filtered {filtered}, encoded {encoded}, '
+                  'dropped {dropped}, failed {failed}, sent {sent}, queued {queued}, sampling every {interval:.0f} frames'.format(camera_id=camera_id, **stats))
+            for name, filter_stats in sorted(stats.get('prefilter', {}).items()):
+                print('  {} filter: evaluated {evaluated}, dropped {dropped} ({drop_fraction:.0%}), '
+                      '{ms_per_frame:.2f} ms/frame'.format(name, **filter_stats))
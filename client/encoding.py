@@ -0,0 +1,113 @@
+import cv2
+
+import frameformat
+
+# Kinesis record limit, less the frame header
+MAX_JPEG_BYTES = 1024 * 1024 - frameformat.HEADER.size
+
+# Rekognition needs faces of at least about 40x40 pixels; do not crop tighter than this.
+MIN_CROP_SIZE = 160
+
+_face_detector = None
+
+
+def face_detector():
+    '''The Haar cascade face detector of this process, built on first use.'''
+    global _face_detector
+    if _face_detector is None:
+        import prefilter
+        _face_detector = prefilter.FaceFilter()
+    return _face_detector
+
+
+class EncodingProfile(object):
+    '''How a captured frame is turned into the JPEG sent to Kinesis, S3 and Rekognition.
+
+    Frames larger than max_width x max_height are scaled down, keeping their
+    aspect ratio. With grayscale, one channel is encoded instead of three. With
+    face_crop, only the region around the detected faces (grown by crop_margin
+    of its size) is sent; frames without faces are sent whole. If a JPEG would
+    not fit in a Kinesis record, it is encoded again at lower quality.'''
+
+    def __init__(self, name='custom', max_width=None, max_height=None, quality=95, grayscale=False,
+                 face_crop=False, crop_margin=0.25):
+        self.name = name
+        self.max_width = max_width
+        self.max_height = max_height
+        self.quality = quality
+        self.grayscale = grayscale
+        self.face_crop = face_crop
+        self.crop_margin = crop_margin
+
+    def __repr__(self):
+        return ('EncodingProfile(name={!r}, max_width={!r}, max_height={!r}, quality={!r}, grayscale={!r}, '
+                'face_crop={!r})').format(self.name, self.max_width, self.max_height, self.quality,
+                                          self.grayscale, self.face_crop)
+
+    def crop(self, frame, faces=None):
+        '''The part of frame around faces ((x, y, w, h) boxes); detected when not given.'''
+        if faces is None:
+            faces = face_detector().detect(frame)
+        if not len(faces):
+            return frame
+        left = min(x for x, _, _, _ in faces)
+        top = min(y for _, y, _, _ in faces)
+        right = max(x + w for x, _, w, _ in faces)
+        bottom = max(y + h for _, y, _, h in faces)
+        margin_x = max(int((right - left) * self.crop_margin), (MIN_CROP_SIZE - (right - left)) // 2)
+        margin_y = max(int((bottom - top) * self.crop_margin), (MIN_CROP_SIZE - (bottom - top)) // 2)
+        return frame[max(0, top - margin_y):bottom + margin_y, max(0, left - margin_x):right + margin_x]
+
+    def resize(self, frame):
+        height, width = frame.shape[:2]
+        scale = 1.0
+        if self.max_width and width > self.max_width:
+            scale = min(scale, self.max_width / float(width))
+        if self.max_height and height > self.max_height:
+            scale = min(scale, self.max_height / float(height))
+        if scale >= 1.0:
+            return frame
+        size = (max(1, int(width * scale)), max(1, int(height * scale)))
+        return cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+
+    def prepare(self, frame, faces=None):
+        '''The frame as it will be encoded: cropped, scaled and converted.'''
+        if self.face_crop:
+            frame = self.crop(frame, faces)
+        frame = self.resize(frame)
+        if self.grayscale and frame.ndim == 3:
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        return frame
+
+    def encode(self, frame, faces=None):
+        '''JPEG bytes of frame, as a numpy buffer.'''
+        frame = self.prepare(frame, faces)
+        quality = self.quality
+        while True:
+            retval, buff = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, quality])
+            if not retval:
+                raise ValueError('Could not encode frame with profile {}.'.format(self.name))
+            if len(buff) <= MAX_JPEG_BYTES or quality <= 30:
+                return buff
+            quality -= 10
+
+
+PROFILES = {
+    # cv2.imencode defaults, as sent before profiles existed
+    'original': EncodingProfile('original'),
+    'hd': EncodingProfile('hd', max_width=1280, max_height=720, quality=85),
+    'balanced': EncodingProfile('balanced', max_width=960, max_height=540, quality=80),
+    'compact': EncodingProfile('compact', max_width=640, max_height=360, quality=70),
+    'gray': EncodingProfile('gray', max_width=960, max_height=540, quality=80, grayscale=True),
+    'faces': EncodingProfile('faces', quality=85, face_crop=True),
+}
+
+
+def build_profile(name='original', **overrides):
+    '''A copy of the named profile with the given settings changed. None values are ignored.'''
+    if name not in PROFILES:
+        raise ValueError('Unknown encoding profile "{}". Choose from: {}.'.format(name, ', '.join(sorted(PROFILES))))
+    base = PROFILES[name]
+    settings = dict((key, value) for key, value in vars(base).items() if key != 'name')
+    settings.update((key, value) for key, value in overrides.items() if value is not None)
+    return EncodingProfile(name, **settings)
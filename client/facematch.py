@@ -0,0 +1,171 @@
+import json
+import threading
+
+import cv2
+import numpy
+
+
+class PixelEmbedder(object):
+    '''Embeds a face crop as its histogram-equalized, mean-centered grayscale pixels.
+
+    Needs nothing but OpenCV. It only tells apart faces seen from a similar
+    angle and light, so use a low threshold with it and let Rekognition decide.'''
+
+    name = 'pixels'
+
+    def __init__(self, size=32):
+        self.size = size
+        self.dim = size * size
+
+    def embed(self, crops):
+        '''Embeddings of BGR or grayscale face crops, one L2-normalized row per crop.'''
+        rows = numpy.empty((len(crops), self.dim), dtype=numpy.float32)
+        for i, crop in enumerate(crops):
+            if crop.ndim == 3:
+                crop = cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY)
+            crop = cv2.equalizeHist(cv2.resize(crop, (self.size, self.size), interpolation=cv2.INTER_AREA))
+            rows[i] = crop.reshape(-1)
+        rows -= rows.mean(axis=1, keepdims=True)
+        return normalize(rows)
+
+
+class SFaceEmbedder(object):
+    '''Embeds face crops with OpenCV's SFace recognition model (an ONNX file, e.g. face_recognition_sface_2021dec.onnx).'''
+
+    name = 'sface'
+
+    def __init__(self, model_path):
+        if not hasattr(cv2, 'FaceRecognizerSF'):
+            raise ValueError('The installed OpenCV build has no FaceRecognizerSF; the sface embedder is unavailable.')
+        self.recognizer = cv2.FaceRecognizerSF.create(model_path, '')
+        self.dim = 128
+        self._lock = threading.Lock()
+
+    def embed(self, crops):
+        rows = numpy.empty((len(crops), self.dim), dtype=numpy.float32)
+        for i, crop in enumerate(crops):
+            if crop.ndim == 2:
+                crop = cv2.cvtColor(crop, cv2.COLOR_GRAY2BGR)
+            with self._lock:
+                rows[i] = self.recognizer.feature(cv2.resize(crop, (112, 112))).reshape(-1)
+        return normalize(rows)
+
+
+EMBEDDERS = {
+    PixelEmbedder.name: PixelEmbedder,
+    SFaceEmbedder.name: SFaceEmbedder,
+}
+
+
+def build_embedder(name, model_path=None):
+    if name not in EMBEDDERS:
+        raise ValueError('Unknown embedder "{}". Choose from: {}.'.format(name, ', '.join(sorted(EMBEDDERS))))
+    if name == SFaceEmbedder.name:
+        if not model_path:
+            raise ValueError('The sface embedder needs a model path.')
+        return SFaceEmbedder(model_path)
+    return EMBEDDERS[name]()
+
+
+def normalize(rows):
+    norms = numpy.linalg.norm(rows, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return rows / norms
+
+
+def crop_face(frame, box, margin=0.1):
+    '''The (x, y, w, h) box of frame, grown by margin of its size on every side.'''
+    x, y, w, h = box
+    dx, dy = int(w * margin), int(h * margin)
+    return frame[max(0, y - dy):y + h + dy, max(0, x - dx):x + w + dx]
+
+
+class FaceIndex(object):
+    '''Enrolled face embeddings, one L2-normalized row per face, with their ExternalImageIds.
+
+    Saved as <path>.npy (the float32 matrix) and <path>.json (ids and the
+    embedder that produced them). load() memory-maps the matrix by default, so
+    several capture processes share one copy of a large index.'''
+
+    def __init__(self, external_image_ids, embeddings, embedder_name):
+        self.external_image_ids = list(external_image_ids)
+        self.embeddings = embeddings
+        self.embedder_name = embedder_name
+        if len(self.external_image_ids) != len(embeddings):
+            raise ValueError('Got {} ids for {} embeddings.'.format(len(self.external_image_ids), len(embeddings)))
+
+    def __len__(self):
+        return len(self.external_image_ids)
+
+    @classmethod
+    def build(cls, faces, embedder):
+        '''Builds an index from (ExternalImageId, face crop) pairs.'''
+        faces = list(faces)
+        embeddings = embedder.embed([crop for _, crop in faces]) if faces else \
+            numpy.empty((0, embedder.dim), dtype=numpy.float32)
+        return cls([external_image_id for external_image_id, _ in faces], embeddings, embedder.name)
+
+    def save(self, path):
+        numpy.save(path + '.npy', numpy.ascontiguousarray(self.embeddings, dtype=numpy.float32))
+        with open(path + '.json', 'w') as meta_file:
+            json.dump({'embedder': self.embedder_name, 'external_image_ids': self.external_image_ids}, meta_file)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        with open(path + '.json', 'r') as meta_file:
+            meta = json.load(meta_file)
+        embeddings = numpy.load(path + '.npy', mmap_mode='r' if mmap else None)
+        return cls(meta['external_image_ids'], embeddings, meta['embedder'])
+
+    def scores(self, queries):
+        '''Cosine similarity of every query row with every enrolled face, shape (queries, faces).'''
+        return numpy.dot(queries, numpy.asarray(self.embeddings).T)
+
+    def best(self, queries):
+        '''(ExternalImageId, similarity) of the closest enrolled face for each query row.'''
+        if not len(self) or not len(queries):
+            return [(None, -1.0)] * len(queries)
+        scores = self.scores(queries)
+        best = scores.argmax(axis=1)
+        return [(self.external_image_ids[j], float(scores[i, j])) for i, j in enumerate(best)]
+
+
+class PreMatcher(object):
+    '''Finds faces in frames and scores them against a FaceIndex.
+
+    detector is anything with detect(frame) -> [(x, y, w, h)], such as
+    prefilter.FaceFilter. A frame is a candidate for Rekognition when one of its
+    faces is at least threshold similar to an enrolled face.'''
+
+    def __init__(self, detector, embedder, index, threshold=0.5, margin=0.1):
+        if index.embedder_name != embedder.name:
+            raise ValueError('The face index was built with the "{}" embedder, not "{}".'.format(
+                index.embedder_name, embedder.name))
+        self.detector = detector
+        self.embedder = embedder
+        self.index = index
+        self.threshold = threshold
+        self.margin = margin
+
+    def crops(self, frame):
+        return [crop_face(frame, box, self.margin) for box in self.detector.detect(frame)]
+
+    def match_batch(self, frames):
+        '''For each frame, the (ExternalImageId, similarity) of its faces that reach the threshold.
+
+        The faces of all frames are embedded and scored together.'''
+        crops, owners = [], []
+        for i, frame in enumerate(frames):
+            frame_crops = self.crops(frame)
+            crops.extend(frame_crops)
+            owners.extend([i] * len(frame_crops))
+        results = [[] for _ in frames]
+        if crops:
+            for owner, (external_image_id, score) in zip(owners, self.index.best(self.embedder.embed(crops))):
+                if score >= self.threshold:
+                    results[owner].append((external_image_id, score))
+        return results
+
+    def match(self, frame):
+        return self.match_batch([frame])[0]
+
@@ -0,0 +1,185 @@
+import threading
+import time
+
+import cv2
+
+import facematch
+
+
+class FilterStats(object):
+    '''Counts and time spent by one pre-filter.'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.evaluated = 0
+        self.passed = 0
+        self.seconds = 0.0
+
+    def record(self, passed, seconds):
+        with self._lock:
+            self.evaluated += 1
+            self.passed += 1 if passed else 0
+            self.seconds += seconds
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'evaluated': self.evaluated,
+                'passed': self.passed,
+                'dropped': self.evaluated - self.passed,
+                'drop_fraction': (self.evaluated - self.passed) / float(self.evaluated) if self.evaluated else 0.0,
+                'ms_per_frame': self.seconds * 1000 / self.evaluated if self.evaluated else 0.0,
+            }
+
+
+def downscale_gray(frame, width):
+    '''Grayscale copy of frame scaled to width pixels, keeping the aspect ratio.'''
+    height = max(1, int(frame.shape[0] * width / float(frame.shape[1])))
+    small = cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+    if small.ndim == 3:
+        small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+    return small
+
+
+class MotionFilter(object):
+    '''Passes frames that differ enough from the last frame it passed.
+
+    Frames are compared as blurred grayscale thumbnails width pixels wide. A
+    frame passes when more than min_changed_fraction of its pixels changed by
+    more than pixel_threshold. A frame also passes if none has for
+    max_idle_secs, so a still but occupied scene is still checked now and then.'''
+
+    name = 'motion'
+
+    def __init__(self, width=160, pixel_threshold=25, min_changed_fraction=0.01, max_idle_secs=30.0):
+        self.width = width
+        self.pixel_threshold = pixel_threshold
+        self.min_changed_fraction = min_changed_fraction
+        self.max_idle_secs = max_idle_secs
+        self.stats = FilterStats()
+        self.last_changed_fraction = 0.0
+        self._reference = None
+        self._last_passed = 0.0
+
+    def changed_fraction(self, frame):
+        '''Fraction of thumbnail pixels that changed since the last passed frame, and the thumbnail itself.'''
+        small = cv2.GaussianBlur(downscale_gray(frame, self.width), (5, 5), 0)
+        if self._reference is None or self._reference.shape != small.shape:
+            return 1.0, small
+        diff = cv2.absdiff(small, self._reference)
+        changed = cv2.countNonZero(cv2.threshold(diff, self.pixel_threshold, 255, cv2.THRESH_BINARY)[1])
+        return changed / float(small.size), small
+
+    def accept(self, frame):
+        start = time.perf_counter()
+        fraction, small = self.changed_fraction(frame)
+        self.last_changed_fraction = fraction
+        now = time.time()
+        passed = fraction >= self.min_changed_fraction or now - self._last_passed >= self.max_idle_secs
+        if passed:
+            # Compare later frames with this one, so slow drifts (lighting) add up until they pass.
+            self._last_passed = now
+            self._reference = small
+        self.stats.record(passed, time.perf_counter() - start)
+        return passed
+
+
+class FaceFilter(object):
+    '''Passes frames in which a local OpenCV Haar cascade finds at least one face.'''
+
+    name = 'face'
+
+    def __init__(self, width=320, scale_factor=1.1, min_neighbors=5, min_size=20, cascade_path=None):
+        if not hasattr(cv2, 'CascadeClassifier'):
+            raise ValueError('The installed OpenCV build has no CascadeClassifier; the face filter is unavailable.')
+        if cascade_path is None:
+            cascade_path = cv2.data.haarcascades + 'haarcascade_frontalface_default.xml'
+        self.classifier = cv2.CascadeClassifier(cascade_path)
+        if self.classifier.empty():
+            raise ValueError('Could not load face cascade "{}".'.format(cascade_path))
+        self.width = width
+        self.scale_factor = scale_factor
+        self.min_neighbors = min_neighbors
+        self.min_size = min_size
+        self.stats = FilterStats()
+        self.last_face_count = 0
+
+    def detect(self, frame):
+        '''Face boxes as (x, y, w, h) in the coordinates of frame.'''
+        small = downscale_gray(frame, min(self.width, frame.shape[1]))
+        scale = frame.shape[1] / float(small.shape[1])
+        faces = self.classifier.detectMultiScale(
+            small, scaleFactor=self.scale_factor, minNeighbors=self.min_neighbors,
+            minSize=(self.min_size, self.min_size))
+        return [tuple(int(v * scale) for v in face) for face in faces]
+
+    def accept(self, frame):
+        start = time.perf_counter()
+        self.last_face_count = len(self.detect(frame))
+        passed = self.last_face_count > 0
+        self.stats.record(passed, time.perf_counter() - start)
+        return passed
+
+
+class WatchlistFilter(object):
+    '''Passes frames with a face that resembles an enrolled watchlist face.
+
+    Faces found by a FaceFilter are embedded and scored against a local index
+    (see facematch.py and "pynt buildfaceindex"). Frames without faces, or whose
+    faces are all below threshold, are not sent to Rekognition. The sface
+    embedder is the default; the pixels embedder has only been measured on
+    synthetic crops, so it must be asked for by name.'''
+
+    name = 'watchlist'
+
+    def __init__(self, index_path='faceindex', threshold=0.5, embedder='sface', model_path=None, width=320):
+        self.detector = FaceFilter(width=width)
+        self.matcher = facematch.PreMatcher(
+            self.detector, facematch.build_embedder(embedder, model_path),
+            facematch.FaceIndex.load(index_path), threshold=float(threshold))
+        self.stats = FilterStats()
+        self.last_candidates = []
+
+    def accept(self, frame):
+        start = time.perf_counter()
+        self.last_candidates = self.matcher.match(frame)
+        passed = len(self.last_candidates) > 0
+        self.stats.record(passed, time.perf_counter() - start)
+        return passed
+
+
+FILTERS = {
+    MotionFilter.name: MotionFilter,
+    FaceFilter.name: FaceFilter,
+    WatchlistFilter.name: WatchlistFilter,
+}
+
+
+class FilterChain(object):
+    '''Runs pre-filters in order; a frame is kept only if every filter passes it.
+
+    Put cheap filters first: later filters only see frames the earlier ones passed.'''
+
+    def __init__(self, filters):
+        self.filters = list(filters)
+
+    def accept(self, frame):
+        for frame_filter in self.filters:
+            if not frame_filter.accept(frame):
+                return False
+        return True
+
+    def stats(self):
+        return dict((frame_filter.name, frame_filter.stats.snapshot()) for frame_filter in self.filters)
+
+
+def build_chain(names, **options):
+    '''Builds a FilterChain from filter names, e.g. ["motion", "face"]. options are passed to matching filters.'''
+    filters = []
+    for name in names:
+        if name not in FILTERS:
+            raise ValueError('Unknown pre-filter "{}". Choose from: {}.'.format(name, ', '.join(sorted(FILTERS))))
+        filter_options = dict((key[len(name) + 1:], value) for key, value in options.items()
+                              if key.startswith(name + '_'))
+        filters.append(FILTERS[name](**filter_options))
+    return FilterChain(filters)
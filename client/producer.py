@@ -0,0 +1,218 @@
+import random
+import threading
+import time
+from collections import deque
+
+# Kinesis PutRecords limits
+MAX_RECORDS_PER_REQUEST = 500
+MAX_BYTES_PER_REQUEST = 5 * 1024 * 1024
+MAX_BYTES_PER_RECORD = 1024 * 1024
+
+
+def partition_key_for(camera_id):
+    '''Partition key for a camera. Frames from one camera share a shard; different cameras spread across shards.'''
+    return 'camera-{}'.format(camera_id)
+
+
+class ProducerStats(object):
+    '''Throughput and latency counters for a KinesisProducer.'''
+
+    def __init__(self, latency_window=1000):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.records_put = 0
+        self.records_sent = 0
+        self.records_failed = 0
+        self.records_retried = 0
+        self.throttled = 0
+        self.requests = 0
+        self.bytes_sent = 0
+        self.sent_by_key = {}
+        self._latencies = deque(maxlen=latency_window)
+
+    def record_sent(self, partition_key, size, latency):
+        with self._lock:
+            self.records_sent += 1
+            self.bytes_sent += size
+            self.sent_by_key[partition_key] = self.sent_by_key.get(partition_key, 0) + 1
+            self._latencies.append(latency)
+
+    def sent_for(self, partition_key):
+        '''Number of records acknowledged by Kinesis for one partition key.'''
+        with self._lock:
+            return self.sent_by_key.get(partition_key, 0)
+
+    def increment(self, name, count=1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + count)
+
+    def snapshot(self):
+        '''Returns the counters as a dict. Latencies are in seconds, from put() to acknowledgement.'''
+        with self._lock:
+            elapsed = max(time.time() - self.started, 1e-9)
+            latencies = sorted(self._latencies)
+            snapshot = {
+                'records_put': self.records_put,
+                'records_sent': self.records_sent,
+                'records_failed': self.records_failed,
+                'records_retried': self.records_retried,
+                'throttled': self.throttled,
+                'requests': self.requests,
+                'bytes_sent': self.bytes_sent,
+                'records_per_sec': self.records_sent / elapsed,
+                'bytes_per_sec': self.bytes_sent / elapsed,
+            }
+        if latencies:
+            snapshot['latency_p50'] = latencies[len(latencies) // 2]
+            snapshot['latency_p99'] = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+            snapshot['latency_max'] = latencies[-1]
+        return snapshot
+
+
+class KinesisProducer(object):
+    '''Buffers records and sends them to a Kinesis stream with PutRecords.
+
+    A batch is sent as soon as it reaches max_records or max_batch_bytes, or
+    once its oldest record has waited linger_secs. Records rejected by Kinesis
+    (e.g. ProvisionedThroughputExceededException) are retried on their own with
+    exponential backoff and jitter, up to max_retries times.'''
+
+    def __init__(self, kinesis_client, stream_name, max_records=MAX_RECORDS_PER_REQUEST,
+                 max_batch_bytes=MAX_BYTES_PER_REQUEST, linger_secs=0.2, max_retries=5,
+                 backoff_secs=0.1, max_backoff_secs=2.0):
+        self.kinesis_client = kinesis_client
+        self.stream_name = stream_name
+        self.max_records = min(max_records, MAX_RECORDS_PER_REQUEST)
+        self.max_batch_bytes = min(max_batch_bytes, MAX_BYTES_PER_REQUEST)
+        self.linger_secs = linger_secs
+        self.max_retries = max_retries
+        self.backoff_secs = backoff_secs
+        self.max_backoff_secs = max_backoff_secs
+        self.stats = ProducerStats()
+
+        self._buffer = []
+        self._buffer_bytes = 0
+        self._in_flight = 0
+        self._cond = threading.Condition()
+        self._send_lock = threading.Lock()
+        self._closed = False
+        self._thread = threading.Thread(target=self._linger_loop, name='kinesis-producer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, data, partition_key):
+        '''Queues one record. Sends the current batch first if the record would not fit in it.'''
+        size = len(data) + len(partition_key.encode('utf-8'))
+        if size > MAX_BYTES_PER_RECORD:
+            raise ValueError('Record of {} bytes exceeds the Kinesis 1 MB record limit.'.format(size))
+
+        batch = None
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('Producer is closed.')
+            if self._buffer and self._buffer_bytes + size > self.max_batch_bytes:
+                batch = self._take_batch()
+            self._buffer.append(({'Data': data, 'PartitionKey': partition_key}, size, time.time()))
+            self._buffer_bytes += size
+            self.stats.increment('records_put')
+            if batch is None and len(self._buffer) >= self.max_records:
+                batch = self._take_batch()
+            self._cond.notify()
+
+        if batch:
+            self._send(batch)
+
+    def pending(self):
+        '''Number of records buffered or being sent.'''
+        with self._cond:
+            return len(self._buffer) + self._in_flight
+
+    def flush(self):
+        '''Sends everything buffered so far and waits for it to be acknowledged.'''
+        with self._cond:
+            batch = self._take_batch()
+        if batch:
+            self._send(batch)
+        # Wait for batches already handed to other threads.
+        with self._cond:
+            while self._in_flight:
+                self._cond.wait()
+
+    def close(self):
+        '''Flushes and stops the linger thread.'''
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+        self.flush()
+
+    def _take_batch(self):
+        # Caller holds self._cond
+        batch = self._buffer
+        self._in_flight += len(batch)
+        self._buffer = []
+        self._buffer_bytes = 0
+        return batch
+
+    def _linger_loop(self):
+        while True:
+            with self._cond:
+                if self._closed:
+                    return
+                if not self._buffer:
+                    self._cond.wait()
+                    continue
+                wait = self._buffer[0][2] + self.linger_secs - time.time()
+                if wait > 0:
+                    self._cond.wait(wait)
+                    continue
+                batch = self._take_batch()
+            self._send(batch)
+
+    def _send(self, batch):
+        with self._send_lock:
+            try:
+                self._send_with_retries(batch)
+            finally:
+                with self._cond:
+                    self._in_flight -= len(batch)
+                    self._cond.notify_all()
+
+    def _send_with_retries(self, batch):
+        attempt = 0
+        while batch:
+            self.stats.increment('requests')
+            try:
+                response = self.kinesis_client.put_records(
+                    StreamName=self.stream_name,
+                    Records=[entry for entry, size, queued_at in batch]
+                )
+                results = response['Records']
+            except Exception as e:
+                print('PutRecords failed: {}'.format(e))
+                if 'ProvisionedThroughputExceeded' in str(e):
+                    self.stats.increment('throttled', len(batch))
+                results = [{'ErrorCode': type(e).__name__}] * len(batch)
+
+            failed = []
+            now = time.time()
+            for (entry, size, queued_at), result in zip(batch, results):
+                if 'ErrorCode' in result:
+                    if result['ErrorCode'] == 'ProvisionedThroughputExceededException':
+                        self.stats.increment('throttled')
+                    failed.append((entry, size, queued_at))
+                else:
+                    self.stats.record_sent(entry['PartitionKey'], size, now - queued_at)
+
+            if not failed:
+                return
+            if attempt >= self.max_retries:
+                print('Dropping {} records after {} retries.'.format(len(failed), attempt))
+                self.stats.increment('records_failed', len(failed))
+                return
+
+            # Full jitter backoff, then retry only the failed records.
+            attempt += 1
+            self.stats.increment('records_retried', len(failed))
+            time.sleep(random.uniform(0, min(self.max_backoff_secs, self.backoff_secs * (2 ** attempt))))
+            batch = failed
@@ -0,0 +1,89 @@
+import threading
+import time
+
+
+class FixedSampler(object):
+    '''Samples every interval-th frame.'''
+
+    def __init__(self, interval):
+        self.interval = max(1, int(interval))
+
+    def should_sample(self, frame_count):
+        return frame_count % self.interval == 0
+
+    def update(self, active):
+        pass
+
+
+class ProducerPressure(object):
+    '''Reports downstream lag: a deep producer queue, or Kinesis throttling seen in the last hold_secs.'''
+
+    def __init__(self, kinesis_producer, queue_high_water=200, hold_secs=2.0):
+        self.kinesis_producer = kinesis_producer
+        self.queue_high_water = queue_high_water
+        self.hold_secs = hold_secs
+        self._lock = threading.Lock()
+        self._throttled = kinesis_producer.stats.throttled
+        self._throttled_at = 0.0
+
+    def __call__(self):
+        now = time.time()
+        with self._lock:
+            throttled = self.kinesis_producer.stats.throttled
+            if throttled != self._throttled:
+                self._throttled = throttled
+                self._throttled_at = now
+            recently_throttled = now - self._throttled_at < self.hold_secs
+        return recently_throttled or self.kinesis_producer.pending() > self.queue_high_water
+
+
+class AdaptiveSampler(object):
+    '''Picks the sampling interval (sample every N frames) from scene activity and downstream lag.
+
+    After each sampled frame, update() is told whether the frame was active
+    (it passed the pre-filters; None when no pre-filter is configured):
+
+    - pressure() is true (producer backlog or throttling): the interval is
+      multiplied by backoff_gain, whatever the scene is doing.
+    - active frame: the interval is multiplied by activity_gain (< 1), so
+      short events are sampled densely.
+    - idle frame: the interval grows by idle_step frames.
+    - no activity signal: the interval moves idle_step frames back towards
+      base_interval.
+
+    The interval always stays between min_interval and max_interval.'''
+
+    def __init__(self, base_interval, min_interval=5, max_interval=90, activity_gain=0.5,
+                 idle_step=5, backoff_gain=2.0, pressure=None):
+        self.min_interval = max(1, min_interval)
+        self.max_interval = max(self.min_interval, max_interval)
+        self.base_interval = self._clamp(base_interval)
+        self.activity_gain = activity_gain
+        self.idle_step = idle_step
+        self.backoff_gain = backoff_gain
+        self.pressure = pressure
+        self.interval = self.base_interval
+        self._last_sampled = None
+
+    def _clamp(self, interval):
+        return min(self.max_interval, max(self.min_interval, interval))
+
+    def should_sample(self, frame_count):
+        if self._last_sampled is None or frame_count - self._last_sampled >= int(round(self.interval)):
+            self._last_sampled = frame_count
+            return True
+        return False
+
+    def update(self, active):
+        if self.pressure is not None and self.pressure():
+            interval = self.interval * self.backoff_gain
+        elif active is None:
+            if self.interval > self.base_interval:
+                interval = max(self.base_interval, self.interval - self.idle_step)
+            else:
+                interval = min(self.base_interval, self.interval + self.idle_step)
+        elif active:
+            interval = self.interval * self.activity_gain
+        else:
+            interval = self.interval + self.idle_step
+        self.interval = self._clamp(interval)
@@ -3,61 +3,70 @@
 #     http://aws.amazon.com/asl/
 # or in the "license" file accompanying this file. This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, express or implied. See the License for the specific language governing permissions and limitations under the License.
 
+import os
 import sys
-import pickle
+import argparse
 import datetime
-import cv2
+import functools
 import boto3
-import time
-from multiprocessing import Pool
 import pytz
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda', 'common'))
+import frameformat
+from producer import KinesisProducer, partition_key_for
+from capturedaemon import CaptureDaemon
+import prefilter
+import encoding
+from sampler import AdaptiveSampler, ProducerPressure
+
 kinesis_client = boto3.client("kinesis")
 rekog_client = boto3.client("rekognition")
 
+kinesis_stream_name = "FrameStream"
 camera_index = 0 # 0 is usually the built-in webcam
 capture_rate = 30 # Frame capture rate.. every X frames. Positive integer.
 rekog_max_labels = 123
 rekog_min_conf = 50.0
 
+producer = None
+
+def get_producer():
+    '''Returns this process's Kinesis producer, creating it on first use.'''
+    global producer
+    if producer is None:
+        producer = KinesisProducer(kinesis_client, kinesis_stream_name)
+    return producer
+
+def capture_timestamp():
+    '''Current UTC time in seconds since the epoch.'''
+    utc_dt = pytz.utc.localize(datetime.datetime.now())
+    return (utc_dt - datetime.datetime(1970, 1, 1, tzinfo=pytz.utc)).total_seconds()
+
 #Send frame to Kinesis stream
-def encode_and_send_frame(frame, frame_count, enable_kinesis=True, enable_rekog=False, write_file=False):
+def encode_and_send_frame(frame, frame_count, enable_kinesis=True, enable_rekog=False, write_file=False, camera_id=camera_index, profile=None):
     try:
-        #convert opencv Mat to jpg image
+        #convert opencv Mat to jpg image, see encoding.py for the profiles
         #print "----FRAME---"
-        retval, buff = cv2.imencode(".jpg", frame)
+        buff = (profile or encoding.PROFILES['original']).encode(frame)
 
-        img_bytes = bytearray(buff)
-
-        utc_dt = pytz.utc.localize(datetime.datetime.now())
-        now_ts_utc = (utc_dt - datetime.datetime(1970, 1, 1, tzinfo=pytz.utc)).total_seconds()
-
-        frame_package = {
-            'ApproximateCaptureTime' : now_ts_utc,
-            'FrameCount' : frame_count,
-            'ImageBytes' : img_bytes
-        }
+        #Header + raw JPEG, see lambda/common/frameformat.py
+        frame_package = frameformat.encode_frame(buff, capture_timestamp(), frame_count, camera_id)
 
         if write_file:
             print("Writing file img_{}.jpg".format(frame_count))
-            target = open("img_{}.jpg".format(frame_count), 'w')
-            target.write(img_bytes)
+            target = open("img_{}.jpg".format(frame_count), 'wb')
+            target.write(buff)
             target.close()
 
         #put encoded image in kinesis stream
         if enable_kinesis:
-            print("Sending image to Kinesis")
-            response = kinesis_client.put_record(
-                StreamName="FrameStream",
-                Data=pickle.dumps(frame_package),
-                PartitionKey="partitionkey"
-            )
-            print(response)
+            print("Queueing image for Kinesis")
+            get_producer().put(frame_package, partition_key_for(camera_id))
 
         if enable_rekog:
             response = rekog_client.detect_labels(
                 Image={
-                    'Bytes': img_bytes
+                    'Bytes': buff.tobytes()
                 },
                 MaxLabels=rekog_max_labels,
                 MinConfidence=rekog_min_conf
@@ -70,36 +79,104 @@ def encode_and_send_frame(frame, frame_count, enable_kinesis=True, enable_rekog=
 
 def main():
 
-    argv_len = len(sys.argv)
-
-    if argv_len > 1 and sys.argv[1].isdigit():
-        capture_rate = int(sys.argv[1])
-
-    cap = cv2.VideoCapture(0) #Use 0 for built-in camera. Use 1, 2, etc. for attached cameras.
-    pool = Pool(processes=3)
-
-    frame_count = 0
-    while True:
-        # Capture frame-by-frame
-        ret, frame = cap.read()
-        #cv2.resize(frame, (640, 360));
-
-        if ret is False:
-            break
-
-        if frame_count % capture_rate == 0:
-            result = pool.apply_async(encode_and_send_frame, (frame, frame_count, True, False, False,))
-
-        frame_count += 1
-
-        # Display the resulting frame
-        cv2.imshow('frame', frame)
-        if cv2.waitKey(1) & 0xFF == ord('q'):
-            break
-
-    # When everything done, release the capture
-    cap.release()
-    cv2.destroyAllWindows()
+    parser = argparse.ArgumentParser(description='Capture video frames and send them to the Kinesis frame stream.')
+    parser.add_argument('capture_rate', nargs='?', type=int, default=capture_rate,
+                        help='Send every Nth frame of each source. Default: %(default)s.')
+    parser.add_argument('--source', action='append', dest='sources',
+                        help='Camera index, RTSP/HTTP URL or video file. Repeat for several sources. Default: camera 0.')
+    parser.add_argument('--headless', action='store_true', help='Do not open preview windows.')
+    parser.add_argument('--queue-size', type=int, default=4,
+                        help='Frames buffered per source before the oldest is dropped. Default: %(default)s.')
+    parser.add_argument('--workers', type=int, default=3, help='JPEG encoder processes. Default: %(default)s.')
+    parser.add_argument('--stats-interval', type=float, default=10.0,
+                        help='Seconds between per-camera stats reports. Default: %(default)s.')
+    parser.add_argument('--prefilter', default='',
+                        help='Comma-separated pre-filters a sampled frame must pass before it is sent: '
+                             'motion, face, watchlist. Example: --prefilter motion,face')
+    parser.add_argument('--motion-min-changed', type=float, default=0.01,
+                        help='Fraction of pixels that must change for the motion filter to pass a frame. Default: %(default)s.')
+    parser.add_argument('--motion-max-idle', type=float, default=30.0,
+                        help='Seconds after which the motion filter passes a frame even without motion. Default: %(default)s.')
+    parser.add_argument('--watchlist-index', default='faceindex',
+                        help='Watchlist filter: face index built with "pynt buildfaceindex", without the .npy/.json '
+                             'extension. Default: %(default)s.')
+    parser.add_argument('--watchlist-threshold', type=float, default=0.5,
+                        help='Watchlist filter: cosine similarity to an enrolled face at which a frame is sent. '
+                             'Default: %(default)s.')
+    parser.add_argument('--watchlist-embedder', default='sface',
+                        help='Watchlist filter: face embedding, sface or pixels. Must match the index. The pixels '
+                             'embedder has not been validated on real faces. Default: %(default)s.')
+    parser.add_argument('--watchlist-model', default=None,
+                        help='Watchlist filter: ONNX model file for the sface embedder. Required with it.')
+    parser.add_argument('--profile', default='original',
+                        help='JPEG encoding profile: ' + ', '.join(sorted(encoding.PROFILES)) + '. Default: %(default)s.')
+    parser.add_argument('--max-width', type=int, help='Scale frames down to at most this width. Overrides the profile.')
+    parser.add_argument('--max-height', type=int, help='Scale frames down to at most this height. Overrides the profile.')
+    parser.add_argument('--jpeg-quality', type=int, help='JPEG quality, 1-100. Overrides the profile.')
+    parser.add_argument('--grayscale', action='store_true', default=None, help='Send grayscale frames.')
+    parser.add_argument('--face-crop', action='store_true', default=None,
+                        help='Send only the region around detected faces; frames without faces are sent whole.')
+    parser.add_argument('--adaptive', action='store_true',
+                        help='Adapt the capture rate to scene activity (needs --prefilter) and to Kinesis backlog/throttling.')
+    parser.add_argument('--min-rate', type=int, default=5,
+                        help='Adaptive mode: densest sampling, every Nth frame. Default: %(default)s.')
+    parser.add_argument('--max-rate', type=int, default=90,
+                        help='Adaptive mode: sparsest sampling, every Nth frame. Default: %(default)s.')
+    parser.add_argument('--activity-gain', type=float, default=0.5,
+                        help='Adaptive mode: interval multiplier after an active frame. Default: %(default)s.')
+    parser.add_argument('--idle-step', type=float, default=5,
+                        help='Adaptive mode: frames added to the interval after an idle frame. Default: %(default)s.')
+    parser.add_argument('--backoff-gain', type=float, default=2.0,
+                        help='Adaptive mode: interval multiplier while Kinesis lags or throttles. Default: %(default)s.')
+    parser.add_argument('--queue-high-water', type=int, default=200,
+                        help='Adaptive mode: producer backlog, in records, that counts as lag. Default: %(default)s.')
+    args = parser.parse_args()
+
+    prefilter_factory = None
+    prefilter_names = [name.strip() for name in args.prefilter.split(',') if name.strip()]
+    if prefilter_names:
+        prefilter_factory = functools.partial(
+            prefilter.build_chain, prefilter_names,
+            motion_min_changed_fraction=args.motion_min_changed,
+            motion_max_idle_secs=args.motion_max_idle,
+            watchlist_index_path=args.watchlist_index,
+            watchlist_threshold=args.watchlist_threshold,
+            watchlist_embedder=args.watchlist_embedder,
+            watchlist_model_path=args.watchlist_model)
+        prefilter_factory()  # Fail fast on unknown names and missing index files
+
+    kinesis_producer = get_producer()
+
+    sampler_factory = None
+    if args.adaptive:
+        pressure = ProducerPressure(kinesis_producer, queue_high_water=args.queue_high_water)
+        sampler_factory = functools.partial(
+            AdaptiveSampler, max(1, args.capture_rate),
+            min_interval=args.min_rate, max_interval=args.max_rate,
+            activity_gain=args.activity_gain, idle_step=args.idle_step,
+            backoff_gain=args.backoff_gain, pressure=pressure)
+
+    encoding_profile = encoding.build_profile(
+        args.profile, max_width=args.max_width, max_height=args.max_height, quality=args.jpeg_quality,
+        grayscale=args.grayscale, face_crop=args.face_crop)
+    print('Encoding frames with {}'.format(encoding_profile))
+
+    daemon = CaptureDaemon(
+        args.sources or [str(camera_index)],
+        kinesis_producer,
+        capture_rate=max(1, args.capture_rate),
+        queue_size=args.queue_size,
+        workers=args.workers,
+        headless=args.headless,
+        stats_interval=args.stats_interval,
+        prefilter_factory=prefilter_factory,
+        sampler_factory=sampler_factory,
+        encoding_profile=encoding_profile
+    )
+    daemon.run()
+
+    kinesis_producer.close()
+    print(kinesis_producer.stats.snapshot())
     return
 
 if __name__ == '__main__':
@@ -0,0 +1,375 @@
+'''Watchlist enrollment, one person at a time or in bulk from a manifest.
+
+Enrolling a person stores their photo in S3, indexes the face in the
+Rekognition collection and writes their Name and Message to the watchlist
+table. A person's ID is derived from the photo itself (see watchlist_id), so
+two enrollments can never be given the same ID. Running a manifest again
+skips everyone who is already enrolled. A journal of finished entries makes
+that skip free of AWS calls.
+
+Manifests are ZIP archives or CSV files:
+
+ZIP - Images, optionally with a manifest.csv inside. Without one, each image
+    enrolls a person named after the file (jane_doe.jpg -> "jane doe").
+CSV - Columns image, name and message. image is a path relative to the CSV
+    file, or an s3:// URI.'''
+import csv
+import hashlib
+import io
+import json
+import os
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+from boto3.dynamodb.conditions import Attr
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+# Item in the watchlist table whose Version is bumped whenever the watchlist changes.
+# The Image Processor Lambda drops its cached watchlist metadata when it sees a new version.
+WATCHLIST_VERSION_ID = 0
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+# IDs are 52 bits of the image hash with bit 52 set, so they stay exact as JavaScript
+# numbers and never meet the version stamp or the enrollment times used as IDs before.
+ID_BITS = 52
+
+ENROLLED = 'enrolled'
+SKIPPED = 'skipped'
+FAILED = 'failed'
+
+
+def client_config(max_pool_connections=10):
+    '''Botocore config for enrollment clients: a connection per worker, and retries with backoff
+    for the throttling that Enroller's IndexFaces pacing does not prevent.'''
+    return Config(max_pool_connections=max_pool_connections, retries={'mode': 'standard', 'max_attempts': 10})
+
+
+def watchlist_id(image_bytes):
+    '''The watchlist ID of a photo: the same photo always gets the same ID.'''
+    digest = int(hashlib.sha256(image_bytes).hexdigest()[:ID_BITS // 4], 16)
+    return digest | (1 << ID_BITS)
+
+
+def bump_version(table):
+    '''Marks the watchlist as changed so cached copies of it are reloaded. Returns the new version.'''
+    response = table.update_item(
+        Key={'ID': WATCHLIST_VERSION_ID},
+        UpdateExpression='ADD Version :one',
+        ExpressionAttributeValues={':one': 1},
+        ReturnValues='UPDATED_NEW'
+    )
+    return int(response['Attributes']['Version'])
+
+
+class Entry(object):
+    '''One person to enroll. load() returns the image bytes; source identifies the image in progress reports.'''
+
+    def __init__(self, source, name, message, load):
+        self.source = source
+        self.name = name
+        self.message = message
+        self.load = load
+
+    @property
+    def extension(self):
+        extension = os.path.splitext(self.source)[1].lower()
+        return extension if extension in IMAGE_EXTENSIONS else '.jpg'
+
+
+def _name_from_file(path):
+    return os.path.splitext(os.path.basename(path))[0].replace('_', ' ').strip()
+
+
+def _s3_loader(s3_client, uri):
+    bucket, _, key = uri[len('s3://'):].partition('/')
+    return lambda: s3_client.get_object(Bucket=bucket, Key=key)['Body'].read()
+
+
+def _file_loader(path):
+    def load():
+        with open(path, 'rb') as image_file:
+            return image_file.read()
+    return load
+
+
+def _rows_to_entries(rows, resolve):
+    entries = []
+    for line, row in enumerate(rows, 2):
+        image = (row.get('image') or '').strip()
+        if not image:
+            raise ValueError('Manifest line {} has no image.'.format(line))
+        name = (row.get('name') or '').strip() or _name_from_file(image)
+        entries.append(Entry(image, name, (row.get('message') or '').strip(), resolve(image)))
+    return entries
+
+
+def read_zip(path, s3_client=None):
+    archive = zipfile.ZipFile(path)
+    lock = threading.Lock()
+
+    def member_loader(member):
+        def load():
+            #ZipFile reads are not thread-safe
+            with lock:
+                return archive.read(member)
+        return load
+
+    names = archive.namelist()
+    manifest = next((name for name in names if os.path.basename(name) == 'manifest.csv'), None)
+    if manifest is not None:
+        base = os.path.dirname(manifest)
+        rows = csv.DictReader(io.StringIO(archive.read(manifest).decode('utf-8-sig')))
+
+        def resolve(image):
+            if image.startswith('s3://'):
+                return _s3_loader(s3_client, image)
+            member = '/'.join(part for part in (base, image) if part)
+            if member not in names:
+                raise ValueError('Image {} is not in the archive.'.format(image))
+            return member_loader(member)
+        return _rows_to_entries(rows, resolve)
+
+    return [Entry(name, _name_from_file(name), '', member_loader(name)) for name in sorted(names)
+            if name.lower().endswith(IMAGE_EXTENSIONS) and not os.path.basename(name).startswith('.')]
+
+
+def read_csv(path, s3_client=None, allow_files=True):
+    base = os.path.dirname(os.path.abspath(path))
+
+    def resolve(image):
+        if image.startswith('s3://'):
+            return _s3_loader(s3_client, image)
+        if not allow_files:
+            raise ValueError('Images of an uploaded CSV manifest must be s3:// URIs, not {}.'.format(image))
+        return _file_loader(os.path.join(base, image))
+
+    with open(path, 'r', encoding='utf-8-sig', newline='') as manifest_file:
+        return _rows_to_entries(csv.DictReader(manifest_file), resolve)
+
+
+def read_manifest(path, s3_client=None, allow_files=True):
+    '''The entries of a ZIP or CSV manifest. allow_files=False rejects CSV rows that name local files.'''
+    if zipfile.is_zipfile(path):
+        return read_zip(path, s3_client)
+    return read_csv(path, s3_client, allow_files)
+
+
+class Progress(object):
+    '''Counts of a bulk run, safe to read from other threads.'''
+
+    def __init__(self, total):
+        self.total = total
+        self.started = time.time()
+        self.finished = None
+        self.counts = {ENROLLED: 0, SKIPPED: 0, FAILED: 0}
+        self.errors = []
+        self._lock = threading.Lock()
+
+    def add(self, entry, status, error=None):
+        with self._lock:
+            self.counts[status] += 1
+            if error is not None:
+                self.errors.append({'image': entry.source, 'error': str(error)})
+
+    @property
+    def done(self):
+        return sum(self.counts.values())
+
+    def snapshot(self):
+        with self._lock:
+            elapsed = (self.finished or time.time()) - self.started
+            done = sum(self.counts.values())
+            rate = done / elapsed if elapsed > 0 else 0.0
+            return dict(self.counts, total=self.total, done=done, finished=self.finished is not None,
+                        images_per_sec=round(rate, 2),
+                        eta_secs=round((self.total - done) / rate) if rate and self.finished is None else None,
+                        errors=list(self.errors[-20:]))
+
+    def __str__(self):
+        state = self.snapshot()
+        line = '{done}/{total}: enrolled {enrolled}, skipped {skipped}, failed {failed}, {images_per_sec} images/s'.format(
+            **state)
+        if state['eta_secs'] is not None:
+            line += ', about {} s left'.format(state['eta_secs'])
+        return line
+
+
+class Enroller(object):
+    '''Enrolls people in the watchlist, many at a time.
+
+    Each enrollment is: claim the photo's ID with a conditional write, store the
+    photo in S3 under key_prefix, index the face, then write the table item.
+    An ID that already has a FaceId, or that another enrollment holds, is
+    skipped, so submitting a photo twice indexes it once. If a step fails, the
+    photo, the indexed face and the claim are removed again; a claim left by a
+    process that died expires after claim_secs. During a run, the watchlist
+    version is bumped every version_every_secs while there are new people, and
+    at its end, not once per person.
+
+    IndexFaces calls are spaced to at most index_faces_tps per second across
+    all workers, so a run stays under the Rekognition quota instead of being
+    throttled and retried.'''
+
+    def __init__(self, s3_client, rekognition_client, table, bucket, collection_id, key_prefix='watchlist/',
+                 max_workers=8, version_every_secs=5.0, index_faces_tps=None, claim_secs=300):
+        self.s3_client = s3_client
+        self.rekognition_client = rekognition_client
+        self.table = table
+        self.bucket = bucket
+        self.collection_id = collection_id
+        self.key_prefix = key_prefix
+        self.max_workers = max_workers
+        self.version_every_secs = version_every_secs
+        self.index_faces_tps = index_faces_tps
+        self.claim_secs = claim_secs
+        self._next_index = 0.0
+        self._pace_lock = threading.Lock()
+
+    def _pace(self):
+        if not self.index_faces_tps:
+            return
+        with self._pace_lock:
+            now = time.time()
+            wait = self._next_index - now
+            self._next_index = max(now, self._next_index) + 1.0 / self.index_faces_tps
+        if wait > 0:
+            time.sleep(wait)
+
+    def _claim(self, person_id):
+        '''Claims an ID for this enrollment. Returns False if it is enrolled or being enrolled already.'''
+        now = int(time.time())
+        try:
+            self.table.put_item(
+                Item={'ID': person_id, 'ClaimedUntil': now + self.claim_secs},
+                ConditionExpression=Attr('ID').not_exists() | (
+                    Attr('FaceId').not_exists() & Attr('ClaimedUntil').lt(now))
+            )
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            return False
+
+    def _undo(self, person_id, image_key, face_id):
+        '''Removes what a failed enrollment left behind, so the photo can be enrolled again.'''
+        try:
+            if face_id is not None:
+                self.rekognition_client.delete_faces(CollectionId=self.collection_id, FaceIds=[face_id])
+            if image_key is not None:
+                self.s3_client.delete_object(Bucket=self.bucket, Key=image_key)
+            self.table.delete_item(Key={'ID': person_id}, ConditionExpression=Attr('FaceId').not_exists())
+        except Exception as e:
+            print('Could not clean up the enrollment of ID {}: {}'.format(person_id, e))
+
+    def enroll(self, entry):
+        '''Enrolls one person. Returns (status, ID); raises ValueError for a photo without a face.'''
+        image_bytes = entry.load()
+        person_id = watchlist_id(image_bytes)
+        if not self._claim(person_id):
+            return SKIPPED, person_id
+
+        image_key = face_id = None
+        try:
+            image_key = '{}{}{}'.format(self.key_prefix, person_id, entry.extension)
+            self.s3_client.put_object(Bucket=self.bucket, Key=image_key, Body=image_bytes)
+            self._pace()
+            response = self.rekognition_client.index_faces(
+                CollectionId=self.collection_id,
+                Image={'S3Object': {'Bucket': self.bucket, 'Name': image_key}},
+                ExternalImageId=str(person_id),
+                MaxFaces=1,
+                QualityFilter='AUTO',
+                DetectionAttributes=['DEFAULT'],
+            )
+            if not response['FaceRecords']:
+                raise ValueError('No face found in {}.'.format(entry.source))
+            face_id = response['FaceRecords'][0]['Face']['FaceId']
+
+            self.table.put_item(
+                Item={
+                    'ID': person_id,
+                    'Name': entry.name,
+                    'Message': entry.message,
+                    'ImageURL': 'https://{}.s3.amazonaws.com/{}'.format(self.bucket, image_key),
+                    'FaceId': face_id,
+                }
+            )
+        except Exception:
+            self._undo(person_id, image_key, face_id)
+            raise
+        return ENROLLED, person_id
+
+    def run(self, entries, journal_path=None, progress=None, report=None, report_secs=5.0):
+        '''Enrolls every entry with max_workers threads and returns the Progress.
+
+        Entries recorded as done in journal_path are skipped without loading
+        them; finished entries are appended to it. report, if given, is called
+        with the Progress every report_secs and at the end.'''
+        done = set()
+        if journal_path and os.path.exists(journal_path):
+            with open(journal_path, 'r') as journal:
+                done = set(json.loads(line)['image'] for line in journal if line.strip())
+        progress = progress or Progress(len(entries))
+        journal = open(journal_path, 'a') if journal_path else None
+        lock = threading.Lock()
+        state = {'unbumped': 0, 'reported': time.time()}
+        stopped = threading.Event()
+
+        def bump():
+            with lock:
+                unbumped, state['unbumped'] = state['unbumped'], 0
+            if unbumped:
+                try:
+                    bump_version(self.table)
+                except Exception as e:
+                    with lock:
+                        state['unbumped'] += unbumped
+                    print('Could not bump the watchlist version: {}'.format(e))
+
+        def bump_periodically():
+            #New people reach Image Processor within seconds, not only at the end of a long run
+            while not stopped.wait(self.version_every_secs):
+                bump()
+
+        def finish(entry, status, person_id=None, error=None):
+            progress.add(entry, status, error)
+            with lock:
+                if journal is not None and status != FAILED:
+                    journal.write(json.dumps({'image': entry.source, 'id': person_id, 'status': status}) + '\n')
+                    journal.flush()
+                if status == ENROLLED:
+                    state['unbumped'] += 1
+                if report is not None and time.time() - state['reported'] >= report_secs:
+                    state['reported'] = time.time()
+                    report(progress)
+
+        def work(entry):
+            if entry.source in done:
+                finish(entry, SKIPPED)
+                return
+            try:
+                status, person_id = self.enroll(entry)
+                finish(entry, status, person_id)
+            except Exception as e:
+                finish(entry, FAILED, error=e)
+
+        bumper = threading.Thread(target=bump_periodically, daemon=True)
+        bumper.start()
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                list(executor.map(work, entries))
+        finally:
+            stopped.set()
+            bumper.join()
+            if state['unbumped']:
+                bump_version(self.table)
+            if journal is not None:
+                journal.close()
+            progress.finished = time.time()
+            if report is not None:
+                report(progress)
+        return progress
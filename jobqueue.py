@@ -0,0 +1,150 @@
+'''Background jobs for the web app.
+
+Requests that wait on S3 and Rekognition, such as enrolling or comparing a
+face, are queued as jobs instead of running in the request. A fixed pool of
+worker threads takes jobs off the queue. The browser gets a job id at once
+and asks for the job's status until it is done, so a slow AWS call never
+holds a web server thread.
+
+Queue backends have two methods: put(job_id), which raises queue.Full when
+no more jobs fit, and get(timeout), which returns a job id or None after
+timeout seconds. LocalQueue keeps job ids in memory, which suits the single
+instance the app runs on. Finished jobs are kept for result_ttl seconds so
+their results can be picked up.'''
+import collections
+import queue
+import threading
+import time
+import uuid
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class LocalQueue(object):
+    '''In-process queue backend holding at most max_size waiting jobs.'''
+
+    def __init__(self, max_size=200):
+        self._queue = queue.Queue(max_size)
+
+    def put(self, job_id):
+        self._queue.put_nowait(job_id)
+
+    def get(self, timeout):
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def size(self):
+        return self._queue.qsize()
+
+
+class Job(object):
+    '''A queued call of fn(*args). owner is whoever may see its status and result.'''
+
+    def __init__(self, kind, owner, fn, args):
+        self.id = str(uuid.uuid4())
+        self.kind = kind
+        self.owner = owner
+        self.fn = fn
+        self.args = args
+        self.state = QUEUED
+        self.result = None
+        self.error = None
+        self.queued = time.time()
+        self.started = None
+        self.finished = None
+
+    def status(self):
+        now = time.time()
+        status = {'id': self.id, 'kind': self.kind, 'state': self.state,
+                  'waited_secs': round((self.started or now) - self.queued, 3)}
+        if self.started is not None:
+            status['run_secs'] = round((self.finished or now) - self.started, 3)
+        if self.state == FAILED:
+            status['error'] = self.error
+        return status
+
+
+class JobQueue(object):
+    '''Runs queued jobs on worker threads and keeps their results.
+
+    submit() raises queue.Full when the backend is full; the caller should ask
+    the client to come back later. Jobs are looked up by id; finished ones are
+    dropped result_ttl seconds after they end.'''
+
+    def __init__(self, workers=8, backend=None, result_ttl=300, poll_secs=1.0):
+        self.workers = workers
+        self.backend = backend or LocalQueue()
+        self.result_ttl = result_ttl
+        self.poll_secs = poll_secs
+        self._jobs = {}
+        self._finished = collections.deque()
+        self._lock = threading.Lock()
+        self._threads = []
+        self.stats = {'submitted': 0, 'rejected': 0, 'done': 0, 'failed': 0}
+
+    def start(self):
+        with self._lock:
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._run, name='jobqueue-worker-%d' % len(self._threads))
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+        return self
+
+    def _expire(self, now):
+        while self._finished and now - self._finished[0][0] >= self.result_ttl:
+            self._jobs.pop(self._finished.popleft()[1], None)
+
+    def submit(self, kind, owner, fn, *args):
+        job = Job(kind, owner, fn, args)
+        with self._lock:
+            self._expire(time.time())
+            self._jobs[job.id] = job
+        try:
+            self.backend.put(job.id)
+        except queue.Full:
+            with self._lock:
+                del self._jobs[job.id]
+                self.stats['rejected'] += 1
+            raise
+        with self._lock:
+            self.stats['submitted'] += 1
+        return job
+
+    def get(self, job_id, owner=None):
+        '''The job with this id, or None if there is none or it belongs to someone else.'''
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None or job.owner != owner:
+            return None
+        return job
+
+    def _run(self):
+        while True:
+            job_id = self.backend.get(self.poll_secs)
+            if job_id is None:
+                continue
+            with self._lock:
+                job = self._jobs.get(job_id)
+            if job is None:
+                continue
+            job.started = time.time()
+            job.state = RUNNING
+            try:
+                job.result = job.fn(*job.args)
+                job.state = DONE
+            except Exception as e:
+                print('Job {} ({}) failed: {}'.format(job.id, job.kind, e))
+                job.error = str(e)
+                job.state = FAILED
+            job.finished = time.time()
+            #Drop the arguments, which may hold a whole image
+            job.args = ()
+            with self._lock:
+                self.stats[job.state] += 1
+                self._finished.append((job.finished, job.id))
@@ -0,0 +1,73 @@
+'''Binary envelope for video frames sent through the Kinesis frame stream.
+
+A frame is a fixed 44-byte big-endian header followed by the raw JPEG bytes:
+
+    offset  size  field
+    0       4     magic, b"RVAF"
+    4       1     format version (currently 1)
+    5       1     flags (reserved, 0)
+    6       2     reserved (0)
+    8       8     approximate capture time, UTC seconds since the epoch (double)
+    16      8     frame count (unsigned)
+    24      16    camera id, UTF-8, NUL padded
+    40      4     payload length in bytes (unsigned)
+    44      n     JPEG payload
+'''
+import collections
+import pickle
+import struct
+
+MAGIC = b'RVAF'
+VERSION = 1
+HEADER = struct.Struct('>4sBBHdQ16sI')
+HEADER_SIZE = HEADER.size
+CAMERA_ID_SIZE = 16
+
+Frame = collections.namedtuple('Frame', ['capture_ts', 'frame_count', 'camera_id', 'payload', 'version'])
+
+
+class FrameFormatError(ValueError):
+    '''Raised when a record is not a valid frame.'''
+    pass
+
+
+def encode_frame(payload, capture_ts, frame_count, camera_id='0'):
+    '''Returns the binary frame for a JPEG payload. payload may be any bytes-like object.'''
+    camera_id_bytes = str(camera_id).encode('utf-8')
+    if len(camera_id_bytes) > CAMERA_ID_SIZE:
+        raise FrameFormatError('Camera id "%s" is longer than %d bytes.' % (camera_id, CAMERA_ID_SIZE))
+
+    payload = memoryview(payload).cast('B')
+    header = HEADER.pack(MAGIC, VERSION, 0, 0, float(capture_ts), int(frame_count),
+                         camera_id_bytes, payload.nbytes)
+    return b''.join((header, payload))
+
+
+def decode_frame(data, allow_pickle=False):
+    '''Parses a frame without copying its payload. Frame.payload is a memoryview into data.
+
+    With allow_pickle, records written by older clients (a pickled dict) are
+    also accepted. Only enable that for streams written by trusted producers.'''
+    view = memoryview(data)
+
+    if view[:4] == MAGIC:
+        if view.nbytes < HEADER_SIZE:
+            raise FrameFormatError('Frame is shorter than its header.')
+
+        magic, version, flags, reserved, capture_ts, frame_count, camera_id, payload_len = \
+            HEADER.unpack_from(view)
+        if version != VERSION:
+            raise FrameFormatError('Unsupported frame format version %d.' % version)
+        if HEADER_SIZE + payload_len != view.nbytes:
+            raise FrameFormatError('Frame payload length %d does not match record size %d.'
+                                   % (payload_len, view.nbytes - HEADER_SIZE))
+
+        return Frame(capture_ts, frame_count, camera_id.rstrip(b'\0').decode('utf-8'),
+                     view[HEADER_SIZE:], version)
+
+    if allow_pickle:
+        frame_package = pickle.loads(data)
+        return Frame(frame_package['ApproximateCaptureTime'], frame_package['FrameCount'],
+                     str(frame_package.get('CameraId', '0')), memoryview(frame_package['ImageBytes']), 0)
+
+    raise FrameFormatError('Record is not a binary frame.')
@@ -0,0 +1,86 @@
+'''Content and perceptual hashes of JPEG frames.
+
+content_hash() matches byte-identical frames only. dhash() is a 64-bit
+difference hash that also matches re-encoded or slightly noisy frames of the
+same scene; compare two of them with hamming(). phash() is a DCT hash that
+changes less with small brightness changes, at a few times the cost. Both
+need Pillow, which is not part of the Lambda runtime but is installed into
+the Image Processor package by packagelambda; has_perceptual() tells whether
+it is available.'''
+import hashlib
+import io
+import math
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+DHASH_SIZE = 8
+
+
+def has_perceptual():
+    return Image is not None
+
+
+def content_hash(image_bytes):
+    '''Hex SHA-256 of the encoded image.'''
+    return hashlib.sha256(image_bytes).hexdigest()
+
+
+def dhash(image_bytes, size=DHASH_SIZE):
+    '''Difference hash of the image as an int of size * size bits.'''
+    if Image is None:
+        raise ValueError('Perceptual hashing needs Pillow, which is not installed')
+    image = Image.open(io.BytesIO(image_bytes))
+    image.draft('L', (size * 4, size * 4))  #Lets the JPEG decoder downscale while decoding
+    pixels = list(image.convert('L').resize((size + 1, size), Image.BILINEAR).getdata())
+    value = 0
+    for row in range(size):
+        for col in range(size):
+            left = pixels[row * (size + 1) + col]
+            right = pixels[row * (size + 1) + col + 1]
+            value = (value << 1) | (1 if left > right else 0)
+    return value
+
+
+def _dct_rows(size, scale):
+    '''Cosines of the first size DCT-II coefficients over size * scale samples.'''
+    samples = size * scale
+    return [[math.cos(math.pi * (2 * x + 1) * u / (2.0 * samples)) for x in range(samples)] for u in range(size)]
+
+
+_DCT_TABLES = {}
+
+
+def phash(image_bytes, size=DHASH_SIZE, scale=4):
+    '''DCT hash of the image as an int of size * size bits.
+
+    The image is shrunk to size * scale pixels square, and each bit tells
+    whether one of the size * size lowest-frequency DCT coefficients is above
+    their median.'''
+    if Image is None:
+        raise ValueError('Perceptual hashing needs Pillow, which is not installed')
+    samples = size * scale
+    table = _DCT_TABLES.get((size, scale))
+    if table is None:
+        table = _DCT_TABLES.setdefault((size, scale), _dct_rows(size, scale))
+    image = Image.open(io.BytesIO(image_bytes))
+    image.draft('L', (samples * 2, samples * 2))
+    pixels = list(image.convert('L').resize((samples, samples), Image.BILINEAR).getdata())
+    rows = [pixels[y * samples:(y + 1) * samples] for y in range(samples)]
+    #Separable DCT, keeping only the low frequencies of each pass
+    row_coefficients = [[sum(c * p for c, p in zip(cosines, row)) for cosines in table] for row in rows]
+    coefficients = [sum(table[v][y] * row_coefficients[y][u] for y in range(samples))
+                    for v in range(size) for u in range(size)]
+    #The DC term is the mean brightness; leave it out of the median
+    median = sorted(coefficients[1:])[len(coefficients) // 2 - 1]
+    value = 0
+    for coefficient in coefficients:
+        value = (value << 1) | (1 if coefficient > median else 0)
+    return value
+
+
+def hamming(a, b):
+    '''Number of differing bits between two dhash or phash values.'''
+    return bin(a ^ b).count('1')
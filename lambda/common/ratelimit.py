@@ -0,0 +1,54 @@
+import threading
+import time
+
+
+class TokenBucket(object):
+    '''Thread-safe token bucket: rate tokens per second, holding at most capacity tokens.'''
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(1.0, rate))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def set_rate(self, rate):
+        '''Changes the refill rate. Tokens already in the bucket are kept.'''
+        with self._lock:
+            self._refill(time.monotonic())
+            self.rate = float(rate)
+
+    def available(self):
+        '''Number of whole tokens that can be taken right now.'''
+        with self._lock:
+            self._refill(time.monotonic())
+            return int(self._tokens)
+
+    def try_acquire(self, tokens=1):
+        '''Takes tokens if they are available. Returns False without waiting otherwise.'''
+        with self._lock:
+            self._refill(time.monotonic())
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return True
+            return False
+
+    def acquire(self, tokens=1, timeout=None):
+        '''Waits until tokens are available and takes them. Returns False if timeout (seconds) runs out first.'''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return True
+                wait = (tokens - self._tokens) / self.rate
+            if deadline is not None:
+                if now + wait > deadline:
+                    return False
+            time.sleep(wait)
@@ -0,0 +1,215 @@
+'''Cache of Rekognition face search results keyed by a hash of the searched image.
+
+Static cameras send the same scene over and over, and people compare the
+same photo more than once. RecognitionCache answers a search from an earlier
+result when the image hashes to within max_distance bits of one searched
+before, in the same scope (a camera, or the compare page), against the same
+collection and watchlist version. Enrolling someone bumps the version, which
+leaves every earlier result unused.
+
+Hashes are phash (default), dhash or content. phash changes by dozens of bits
+when a face-sized object enters a static scene, while sensor noise changes a
+few; dhash is cheaper but barely notices a small face. Both need Pillow, and
+RecognitionCache refuses them without it. The content hash matches
+byte-identical images only and needs nothing.
+
+Results are kept in a LocalResultStore, and optionally in a
+DynamoResultStore shared by every container. The DynamoDB table's hash key
+is "cache_key" (S) and its TTL attribute is "expires_at". Near matches are
+found there by splitting the hash into max_distance + 1 bands that are each
+stored as a key: two hashes within max_distance bits share at least one band.'''
+from __future__ import print_function
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from botocore.exceptions import ClientError
+
+import framehash
+
+HASH_MODES = ('phash', 'dhash', 'content')
+
+# BatchWriteItem limit, and with it the most bands a shared result can be stored under
+MAX_BANDS = 25
+
+
+def image_hash(image_bytes, mode='phash', size=16):
+    if mode == 'phash':
+        return framehash.phash(image_bytes, size)
+    if mode == 'dhash':
+        return framehash.dhash(image_bytes, size)
+    return framehash.content_hash(image_bytes)
+
+
+def distance(a, b):
+    if isinstance(a, int) and isinstance(b, int):
+        return framehash.hamming(a, b)
+    return 0 if a == b else None
+
+
+class LocalResultStore(object):
+    '''In-memory LRU of search results. Entries expire at the time they were put with.'''
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, namespace, image_hash, max_distance, now):
+        with self._lock:
+            entry = self._entries.get((namespace, image_hash))
+            if entry is not None and entry[1] > now:
+                self._entries.move_to_end((namespace, image_hash))
+                return entry[0]
+            if max_distance <= 0 or not isinstance(image_hash, int):
+                return None
+            best = None
+            for (entry_namespace, entry_hash), (response, expires_at) in self._entries.items():
+                if entry_namespace != namespace or expires_at <= now:
+                    continue
+                bits = distance(entry_hash, image_hash)
+                if bits is not None and bits <= max_distance and (best is None or bits < best[0]):
+                    best = (bits, (entry_namespace, entry_hash), response)
+            if best is None:
+                return None
+            self._entries.move_to_end(best[1])
+            return best[2]
+
+    def put(self, namespace, image_hash, response, expires_at):
+        with self._lock:
+            self._entries[(namespace, image_hash)] = (response, expires_at)
+            self._entries.move_to_end((namespace, image_hash))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class DynamoResultStore(object):
+    '''Search results in a DynamoDB table, shared by every container and instance.
+
+    Failures to read or write the table are printed and treated as misses,
+    so the cache never stops a search.'''
+
+    def __init__(self, dynamodb, table_name, hash_bits=256):
+        self.dynamodb = dynamodb
+        self.table_name = table_name
+        self.hash_bits = hash_bits
+
+    def _keys(self, namespace, image_hash, max_distance):
+        if not isinstance(image_hash, int) or max_distance <= 0:
+            return ['{}#x#{:x}'.format(namespace, image_hash) if isinstance(image_hash, int)
+                    else '{}#c#{}'.format(namespace, image_hash)]
+        bands = min(max_distance + 1, MAX_BANDS)
+        width = -(-self.hash_bits // bands)
+        return ['{}#{}#{:x}'.format(namespace, band, (image_hash >> (band * width)) & ((1 << width) - 1))
+                for band in range(bands)]
+
+    def get(self, namespace, image_hash, max_distance, now):
+        keys = self._keys(namespace, image_hash, max_distance)
+        try:
+            response = self.dynamodb.batch_get_item(RequestItems={
+                self.table_name: {'Keys': [{'cache_key': key} for key in keys]}
+            })
+        except ClientError as e:
+            print('Recognition cache table unavailable: {}'.format(e))
+            return None
+        best = None
+        for item in response.get('Responses', {}).get(self.table_name, []):
+            if int(item['expires_at']) <= now:
+                continue
+            stored_hash = int(item['image_hash'], 16) if isinstance(image_hash, int) else item['image_hash']
+            bits = distance(stored_hash, image_hash)
+            if bits is not None and bits <= max_distance and (best is None or bits < best[0]):
+                best = (bits, item['response'])
+        return json.loads(best[1]) if best is not None else None
+
+    def put(self, namespace, image_hash, response, expires_at, max_distance):
+        stored_hash = '{:x}'.format(image_hash) if isinstance(image_hash, int) else image_hash
+        body = json.dumps(response)
+        requests = [{'PutRequest': {'Item': {
+            'cache_key': key,
+            'image_hash': stored_hash,
+            'response': body,
+            'expires_at': int(expires_at)
+        }}} for key in self._keys(namespace, image_hash, max_distance)]
+        try:
+            #Unprocessed items are left out; the cache only misses them
+            self.dynamodb.batch_write_item(RequestItems={self.table_name: requests})
+        except ClientError as e:
+            print('Could not store recognition result: {}'.format(e))
+
+
+class RecognitionCache(object):
+    '''Answers face searches of near-identical images from earlier results.
+
+    search() calls search_fn() on a miss and stores its response for
+    ttl_secs. With ttl_secs 0 every search goes through. A hit in the shared
+    store is copied to the local one.'''
+
+    def __init__(self, local=None, shared=None, hash_mode='phash', hash_size=16, max_distance=8, ttl_secs=60):
+        if hash_mode != 'content' and not framehash.has_perceptual():
+            raise ValueError('Recognition cache hash "{}" needs Pillow, which is not installed; '
+                             'package it or set the hash to "content".'.format(hash_mode))
+        self.local = local if local is not None else LocalResultStore()
+        self.shared = shared
+        self.hash_mode = hash_mode
+        self.hash_size = hash_size
+        self.max_distance = max_distance if hash_mode != 'content' else 0
+        self.ttl_secs = ttl_secs
+        self._lock = threading.Lock()
+        self.stats = {'lookups': 0, 'local_hits': 0, 'shared_hits': 0, 'misses': 0, 'unhashable': 0}
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def hit_rate(self):
+        hits = self.stats['local_hits'] + self.stats['shared_hits']
+        return hits / float(self.stats['lookups']) if self.stats['lookups'] else 0.0
+
+    def search(self, image_bytes, collection_id, scope, version, search_fn, now=None):
+        '''The search response for image_bytes, from the cache or from search_fn().'''
+        if self.ttl_secs <= 0:
+            return search_fn()
+        now = time.time() if now is None else now
+        try:
+            frame_hash = image_hash(image_bytes, self.hash_mode, self.hash_size)
+        except Exception as e:
+            #Not an image Pillow can read; let Rekognition decide what it is
+            print('Could not hash image for the recognition cache: {}'.format(e))
+            self._count('unhashable')
+            return search_fn()
+        namespace = '{}#{}#{}'.format(collection_id, scope, version)
+        self._count('lookups')
+
+        response = self.local.get(namespace, frame_hash, self.max_distance, now)
+        if response is not None:
+            self._count('local_hits')
+            return response
+        if self.shared is not None:
+            response = self.shared.get(namespace, frame_hash, self.max_distance, now)
+            if response is not None:
+                self._count('shared_hits')
+                self.local.put(namespace, frame_hash, response, now + self.ttl_secs)
+                return response
+
+        self._count('misses')
+        response = dict(search_fn())
+        response.pop('ResponseMetadata', None)
+        expires_at = now + self.ttl_secs
+        self.local.put(namespace, frame_hash, response, expires_at)
+        if self.shared is not None:
+            self.shared.put(namespace, frame_hash, response, expires_at, self.max_distance)
+        return response
+
+    def clear(self):
+        '''Forgets the local results (the shared table is left alone).'''
+        self.local.clear()
+
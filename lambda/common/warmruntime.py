@@ -0,0 +1,104 @@
+from __future__ import print_function
+import json
+import threading
+
+import boto3
+from botocore.config import Config
+
+# State kept for the lifetime of a Lambda container. Everything here is built
+# on first use and reused by later invocations of the same container.
+_lock = threading.RLock()
+_session = None
+_clients = {}
+_resources = {}
+_configs = {}
+_timezones = {}
+_objects = {}
+
+
+def session():
+    '''Returns the boto3 session shared by every client in this container.'''
+    global _session
+    with _lock:
+        if _session is None:
+            _session = boto3.session.Session()
+        return _session
+
+
+def client_config(max_pool_connections=10, max_attempts=None):
+    '''Returns the botocore config used for warm clients.
+
+    max_attempts caps the total attempts botocore makes per call, for callers
+    that do their own retrying. None keeps botocore's default retries.'''
+    kwargs = {}
+    if max_attempts is not None:
+        kwargs['retries'] = {'mode': 'standard', 'total_max_attempts': max_attempts}
+    return Config(
+        max_pool_connections=max_pool_connections,
+        tcp_keepalive=True,
+        **kwargs
+    )
+
+
+def get_client(service_name, max_pool_connections=10, max_attempts=None):
+    '''Returns a cached low-level client. Its HTTP connection pool is kept between invocations.'''
+    key = (service_name, max_pool_connections, max_attempts)
+    with _lock:
+        if key not in _clients:
+            _clients[key] = session().client(service_name,
+                                             config=client_config(max_pool_connections, max_attempts))
+        return _clients[key]
+
+
+def get_resource(service_name, max_pool_connections=10):
+    '''Returns a cached service resource.'''
+    key = (service_name, max_pool_connections)
+    with _lock:
+        if key not in _resources:
+            _resources[key] = session().resource(service_name, config=client_config(max_pool_connections))
+        return _resources[key]
+
+
+def load_config(path):
+    '''Loads a JSON params file once per container. Callers must not modify the result.'''
+    with _lock:
+        if path not in _configs:
+            with open(path, 'r') as conf_file:
+                _configs[path] = json.loads(conf_file.read())
+        return _configs[path]
+
+
+def set_config(path, config):
+    '''Replaces the cached contents of a params file. Used by benchmarks to try other settings.'''
+    with _lock:
+        _configs[path] = config
+
+
+def get_timezone(name):
+    '''Returns a cached pytz timezone.'''
+    tz = _timezones.get(name)
+    if tz is None:
+        # pytz is only packaged with the functions that need it.
+        from pytz import timezone
+        tz = _timezones[name] = timezone(name)
+    return tz
+
+
+def cached(key, factory):
+    '''Returns the object stored under key, building it with factory() on first use.'''
+    with _lock:
+        if key not in _objects:
+            _objects[key] = factory()
+        return _objects[key]
+
+
+def reset():
+    '''Drops all cached state, as if the container had just started. Used by tests and benchmarks.'''
+    global _session
+    with _lock:
+        _session = None
+        _clients.clear()
+        _resources.clear()
+        _configs.clear()
+        _timezones.clear()
+        _objects.clear()
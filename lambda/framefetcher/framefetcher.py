@@ -1,12 +1,16 @@
 from __future__ import print_function
 
-import boto3
-from boto3.dynamodb.conditions import Key, Attr
-import datetime
 import time
 import json
 import decimal
-from datetime import timedelta
+import warmruntime
+import framequery
+import urlsigner
+import responsecache
+
+#Frames are written to DynamoDB at the end of their Image Processor batch, so a range
+#is only treated as complete once it ended this long ago.
+CLOSED_RANGE_LAG_SECS = 300
 
 
 class DecimalEncoder(json.JSONEncoder):
@@ -19,80 +23,155 @@ class DecimalEncoder(json.JSONEncoder):
         return super(DecimalEncoder, self).default(o)
 
 def load_config():
+    '''Load configuration from file. The file is read once per container.'''
+    return warmruntime.load_config('framefetcher-params.json')
+
+def build_signer(config, s3_client):
+    mode = config.get('url_signing', 's3')
+    signer = None
+    if mode != 's3':
+        #The CloudFront private key is kept in an SSM SecureString parameter, not in the package
+        parameter = warmruntime.get_client('ssm').get_parameter(
+            Name=config['cloudfront_private_key_parameter'], WithDecryption=True)
+        signer = urlsigner.rsa_signer(parameter['Parameter']['Value'])
+    return urlsigner.UrlSigner(
+        mode,
+        int(config['s3_pre_signed_url_expiry']),
+        margin_secs=int(config.get('pre_signed_url_margin_secs', 300)),
+        bucket_secs=int(config.get('pre_signed_url_bucket_secs', 300)),
+        cache_size=int(config.get('pre_signed_url_cache_size', 10000)),
+        s3_client=s3_client,
+        cloudfront_domain=config.get('cloudfront_domain'),
+        key_pair_id=config.get('cloudfront_key_pair_id'),
+        signer=signer
+    )
+
+def response_headers(headers=None):
+    response_headers = {
+        'Content-Type': 'application/json',
+        'Access-Control-Allow-Origin': "*",
+        'Access-Control-Expose-Headers': 'X-Next-Cursor, ETag'
+    }
+    response_headers.update(headers or {})
+    return response_headers
 
-    with open('framefetcher-params.json', 'r') as conf_file:
-        conf_json = conf_file.read()
-        return json.loads(conf_json)
-
-def respond(err, res=None):
+def respond(err, res=None, headers=None, body=None):
+    '''body is JSON that was already serialized, used instead of res.'''
+    if body is None and not err:
+        body = json.dumps(res, cls=DecimalEncoder)
     return {
         'statusCode': '400' if err else '200',
-        'body': err.message if err else json.dumps(res, cls=DecimalEncoder),
-        'headers': {
-            'Content-Type': 'application/json',
-            'Access-Control-Allow-Origin': "*"
-        },
+        'body': str(err) if err else body,
+        'headers': response_headers(headers),
+    }
+
+def not_modified(headers):
+    return {
+        'statusCode': '304',
+        'body': '',
+        'headers': response_headers(headers),
     }
 
 
+def build_page(runner, signer, serializer, query, key, newest_ts, now):
+    '''Runs the query and returns the page as a responsecache.CachedPage.
+
+    newest_ts is the newest frame in the range, read before the query, or None.'''
+
+    #Month partitions in the time range are queried in parallel and merged newest first
+    #(or oldest first with order=asc), see framequery.py
+    items, next_query = runner.run(query)
+
+    # Note the following. 
+    # (1) even if the url expires in days or weeks, the presigned 
+    # url is usable only if the temporary IAM credentials that generated 
+    # it haven't expired. These are the credentials assumed by this lambda function.
+    # (2) Your bucket policy needs to allow "read" access to "authenticated AWS users"
+    # (3) Ensure this Lambda function's role has S3FullAccess policy attached to it. 
+    #URLs are cached per object and reused across requests, see urlsigner.py
+    valid_until = None
+    for item in items:
+        url, expires_at = signer.sign(item["s3_bucket"], item["s3_key"], now)
+        item['s3_presigned_url'] = url
+        valid_until = expires_at if valid_until is None else min(valid_until, expires_at)
+
+    print('Fetched {} frames from {} partitions.'.format(len(items), len(query.positions)))
+
+    if newest_ts is None and items:
+        newest_ts = max(item['processed_timestamp'] for item in items)
+    #The body stays a plain list of frames; the cursor for the next page goes in a header.
+    cursor = framequery.encode_cursor(next_query) if next_query else None
+    headers = {'X-Next-Cursor': cursor} if cursor else {}
+    return responsecache.CachedPage(
+        serializer.body(items, query.fields),
+        responsecache.etag(key, newest_ts, len(items), valid_until, cursor),
+        headers, newest_ts, valid_until, now)
+
 def fetch_frames(event, context):
 
-    #Initialize clients
-    dynamodb = boto3.resource('dynamodb')
-    s3_client = boto3.client('s3')
+    #Initialize clients. They are built once per container and reused.
+    dynamodb = warmruntime.get_resource('dynamodb')
+    s3_client = warmruntime.get_client('s3')
     
     #Load config
     config = load_config()
 
-    ddb_table = dynamodb.Table(config['ddb_table'])
-    ddb_gsi_name = config['ddb_gsi_name']
-    fetch_horizon_hrs = float(config['fetch_horizon_hrs'])
-    fetch_limit = config['fetch_limit']
+    ddb_table = warmruntime.cached('framefetcher.table', lambda: dynamodb.Table(config['ddb_table']))
+    runner = warmruntime.cached('framefetcher.runner', lambda: framequery.FrameQueryRunner(
+        ddb_table,
+        config['ddb_gsi_name'],
+        max_workers=int(config.get('max_partition_queries', 8)),
+        max_query_pages=int(config.get('max_query_pages', 10))
+    ))
+    signer = warmruntime.cached('framefetcher.signer', lambda: build_signer(config, s3_client))
+    serializer = warmruntime.cached('framefetcher.serializer', lambda: responsecache.FrameSerializer(
+        int(config.get('serialized_frame_cache_size', 10000))))
+    results = warmruntime.cached('framefetcher.results', lambda: responsecache.ResultCache(
+        ttl_secs=float(config.get('result_cache_ttl_secs', 2)),
+        max_age_secs=float(config.get('result_cache_max_age_secs', 60)),
+        margin_secs=signer.margin_secs,
+        size=int(config.get('result_cache_size', 256))
+    ))
 
     #Process "GET" request
     if event['httpMethod'] == "GET":
-        now = datetime.datetime.now()
-        year = now.strftime("%Y")
-        mon = now.strftime("%m")
-
-        ts_at_fetch_horizon = time.time() - (fetch_horizon_hrs * 60 * 60)
-
-        ddb_resp = ddb_table.query(
-            IndexName=ddb_gsi_name,
-            
-            KeyConditionExpression=Key('processed_year_month').eq(year + mon) 
-            & Key('processed_timestamp').gt(decimal.Decimal(ts_at_fetch_horizon)),
-            Limit=fetch_limit,
-            ScanIndexForward=False #Sort descendingly -- show most recent captured frames first.
-        )
-
-        for item in ddb_resp["Items"]:
-
-            s3_key = item["s3_key"]
-            s3_bucket = item["s3_bucket"]
-            # Note the following. 
-            # (1) even if the url expires in days or weeks, the presigned 
-            # url is usable only if the temporary IAM credentials that generated 
-            # it haven't expired. These are the credentials assumed by this lambda function.
-            # (2) Your bucket policy needs to allow "read" access to "authenticated AWS users"
-            # (3) Ensure this Lambda function's role has S3FullAccess policy attached to it. 
-            s3_presigned_url_expiry = config["s3_pre_signed_url_expiry"]
-
-            s3_presigned_url = s3_client.generate_presigned_url(
-                ClientMethod='get_object',
-                Params={
-                    'Bucket' : s3_bucket,
-                    'Key' : s3_key
-                },
-                ExpiresIn=s3_presigned_url_expiry
-            )
-
-            item['s3_presigned_url'] = s3_presigned_url
-        
-        print (ddb_resp)
-
-        return respond(None, ddb_resp["Items"])
+        try:
+            query = framequery.parse_query(event.get('queryStringParameters'), time.time(), config)
+        except framequery.QueryError as e:
+            return respond(e)
+
+        params = event.get('queryStringParameters') or {}
+        key = responsecache.request_key(params)
+        #A live request has no fixed end: new frames can show up in its range at any time.
+        live = not params.get('to') and not params.get('cursor')
+        now = time.time()
+
+        #Polls that arrive within the TTL are answered from memory. After it, a live page is
+        #reused if the newest frame in its range is still the same, which reads one item.
+        page = results.get(key, now)
+        if page is None:
+            stale = results.stale(key, now)
+            newest_ts = None
+            if live and (stale is not None or query.cameras or query.ascending):
+                #Otherwise the first frame of the page is the newest one
+                newest_ts = runner.newest_timestamp(query)
+            if stale is not None and live and newest_ts == stale.newest_ts:
+                page = results.revalidated(key, stale, now)
+            else:
+                page = results.put(key, build_page(runner, signer, serializer, query, key, newest_ts, now))
+
+        headers = dict(page.headers, ETag=page.etag)
+        if live:
+            headers['Cache-Control'] = 'no-cache'
+        elif page.valid_until is not None and query.end_ts < now - CLOSED_RANGE_LAG_SECS:
+            #Nothing new can appear in a range that ended in the past, so the page may be cached
+            #for as long as all its URLs stay valid.
+            headers['Cache-Control'] = 'private, max-age={}'.format(int(page.valid_until - signer.margin_secs - now))
+
+        request_headers = dict((name.lower(), value) for name, value in (event.get('headers') or {}).items())
+        if responsecache.etag_matches(request_headers.get('if-none-match'), page.etag):
+            return not_modified(headers)
+        return respond(None, headers=headers, body=page.body)
 
 def handler(event, context):
     return fetch_frames(event, context)
-    
\ No newline at end of file
@@ -0,0 +1,265 @@
+from __future__ import print_function
+import base64
+import datetime
+import decimal
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from boto3.dynamodb.conditions import Key, Attr
+
+# Attributes every query reads: the table and index keys (for cursors) and the S3 location (for pre-signed URLs).
+REQUIRED_FIELDS = ('frame_id', 'processed_timestamp', 'processed_year_month', 's3_bucket', 's3_key')
+ALLOWED_FIELDS = REQUIRED_FIELDS + ('approx_capture_timestamp', 'camera_id')
+
+# Image Processor names partitions after the month in its configured timezone, which is at most
+# 14 hours away from UTC. Partitions are listed for a range widened by that much.
+PARTITION_SLACK_SECS = 14 * 60 * 60
+
+CURSOR_VERSION = 1
+
+
+class QueryError(ValueError):
+    '''An invalid request. Its message is returned to the caller with status 400.'''
+
+
+class FrameQuery(object):
+    '''A request for frames processed between start_ts and end_ts, optionally from some cameras only.'''
+
+    def __init__(self, start_ts, end_ts, cameras=None, limit=3, fields=None, ascending=False, positions=None):
+        self.start_ts = start_ts
+        self.end_ts = end_ts
+        self.cameras = cameras or []
+        self.limit = limit
+        self.fields = fields
+        self.ascending = ascending
+        # Partition name -> ExclusiveStartKey, None to start at the beginning, or False when done.
+        self.positions = positions if positions is not None else \
+            dict((partition, None) for partition in partitions_between(start_ts, end_ts))
+
+
+def month_of(ts):
+    return datetime.datetime.utcfromtimestamp(ts).strftime('%Y%m')
+
+
+def partitions_between(start_ts, end_ts):
+    '''The processed_year_month values that may hold frames processed between the timestamps.'''
+    partitions = []
+    month = datetime.datetime.utcfromtimestamp(max(0, start_ts - PARTITION_SLACK_SECS)).replace(day=1)
+    last = month_of(end_ts + PARTITION_SLACK_SECS)
+    while True:
+        partitions.append(month.strftime('%Y%m'))
+        if partitions[-1] >= last:
+            return partitions
+        month = (month + datetime.timedelta(days=32)).replace(day=1)
+
+
+def _parse_float(params, name, default):
+    value = params.get(name)
+    if value in (None, ''):
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        raise QueryError('"{}" must be a number of seconds since the epoch.'.format(name))
+
+
+def parse_query(params, now, config):
+    '''Builds a FrameQuery from API Gateway queryStringParameters (which may be None).
+
+    Parameters: from, to (seconds since the epoch), camera (comma-separated ids),
+    limit, fields (comma-separated attributes), order (asc or desc) and cursor.
+    A cursor carries the range, cameras and order of the query that returned it.'''
+    params = params or {}
+    max_page_size = int(config.get('max_page_size', 100))
+    try:
+        limit = int(params.get('limit') or config['fetch_limit'])
+    except ValueError:
+        raise QueryError('"limit" must be a whole number.')
+    if not 1 <= limit <= max_page_size:
+        raise QueryError('"limit" must be between 1 and {}.'.format(max_page_size))
+
+    fields = None
+    if params.get('fields'):
+        requested = [field.strip() for field in params['fields'].split(',') if field.strip()]
+        unknown = [field for field in requested if field not in ALLOWED_FIELDS]
+        if unknown:
+            raise QueryError('Unknown fields: {}. Choose from: {}.'.format(
+                ', '.join(unknown), ', '.join(ALLOWED_FIELDS)))
+        fields = list(REQUIRED_FIELDS) + [field for field in requested if field not in REQUIRED_FIELDS]
+
+    if params.get('cursor'):
+        query = decode_cursor(params['cursor'])
+        query.limit = limit
+        query.fields = fields
+        return query
+
+    end_ts = _parse_float(params, 'to', now)
+    start_ts = _parse_float(params, 'from', end_ts - float(config['fetch_horizon_hrs']) * 60 * 60)
+    if start_ts > end_ts:
+        raise QueryError('"from" must not be after "to".')
+    order = params.get('order', 'desc')
+    if order not in ('asc', 'desc'):
+        raise QueryError('"order" must be asc or desc.')
+    cameras = [camera.strip() for camera in (params.get('camera') or '').split(',') if camera.strip()]
+
+    query = FrameQuery(start_ts, end_ts, cameras, limit, fields, order == 'asc')
+    max_partitions = int(config.get('max_partitions', 24))
+    if len(query.positions) > max_partitions:
+        raise QueryError('The time range spans more than {} months.'.format(max_partitions))
+    return query
+
+
+def _to_json(value):
+    if isinstance(value, decimal.Decimal):
+        return str(value)
+    return value
+
+
+def encode_cursor(query):
+    '''An opaque, URL-safe token for the next page of query.'''
+    positions = {}
+    for partition, position in query.positions.items():
+        if position:
+            position = dict((name, _to_json(value)) for name, value in position.items())
+        positions[partition] = position
+    state = {
+        'v': CURSOR_VERSION,
+        'from': query.start_ts,
+        'to': query.end_ts,
+        'cameras': query.cameras,
+        'asc': query.ascending,
+        'positions': positions
+    }
+    return base64.urlsafe_b64encode(json.dumps(state, separators=(',', ':')).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    try:
+        state = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+        if state.get('v') != CURSOR_VERSION:
+            raise ValueError('unknown cursor version')
+        positions = {}
+        for partition, position in state['positions'].items():
+            if position:
+                position = dict(position, processed_timestamp=decimal.Decimal(position['processed_timestamp']))
+            positions[partition] = position
+        return FrameQuery(state['from'], state['to'], state['cameras'], ascending=state['asc'], positions=positions)
+    except (ValueError, KeyError, TypeError, AttributeError, decimal.InvalidOperation):
+        raise QueryError('Invalid cursor.')
+
+
+def _item_key(item):
+    return {
+        'frame_id': item['frame_id'],
+        'processed_year_month': item['processed_year_month'],
+        'processed_timestamp': item['processed_timestamp']
+    }
+
+
+class FrameQueryRunner(object):
+    '''Runs a FrameQuery against the processed_year_month / processed_timestamp index.
+
+    Every month partition in the range is queried in parallel, and the results
+    are merged in timestamp order. Each partition is read until it yields limit
+    items or runs out, for at most max_query_pages requests. When that cap is hit,
+    only items that are certainly in order are returned. The rest are left to
+    the next page.'''
+
+    def __init__(self, table, index_name, max_workers=8, max_query_pages=10):
+        self.table = table
+        self.index_name = index_name
+        self.max_workers = max_workers
+        self.max_query_pages = max_query_pages
+
+    def _query_kwargs(self, query, partition):
+        kwargs = {
+            'IndexName': self.index_name,
+            'KeyConditionExpression': Key('processed_year_month').eq(partition) & Key('processed_timestamp').between(
+                decimal.Decimal(str(query.start_ts)), decimal.Decimal(str(query.end_ts))),
+            'ScanIndexForward': query.ascending,
+            'Limit': query.limit
+        }
+        if query.cameras:
+            kwargs['FilterExpression'] = Attr('camera_id').is_in(query.cameras) if len(query.cameras) > 1 \
+                else Attr('camera_id').eq(query.cameras[0])
+        if query.fields:
+            names = dict(('#f{}'.format(i), field) for i, field in enumerate(query.fields))
+            kwargs['ProjectionExpression'] = ', '.join(sorted(names))
+            kwargs['ExpressionAttributeNames'] = names
+        return kwargs
+
+    def _read_partition(self, query, partition):
+        '''Returns (items, LastEvaluatedKey or None when the partition is exhausted).'''
+        kwargs = self._query_kwargs(query, partition)
+        start_key = query.positions[partition]
+        items = []
+        for _ in range(self.max_query_pages):
+            if start_key:
+                kwargs['ExclusiveStartKey'] = start_key
+            response = self.table.query(**kwargs)
+            items.extend(response['Items'])
+            start_key = response.get('LastEvaluatedKey')
+            if not start_key or len(items) >= query.limit:
+                break
+        return items, start_key
+
+    def newest_timestamp(self, query):
+        '''The processed_timestamp of the newest frame in the query's range, from any camera,
+        or None. Reads one item of the newest partition that has frames.'''
+        for partition in sorted(query.positions, reverse=True):
+            response = self.table.query(
+                IndexName=self.index_name,
+                KeyConditionExpression=Key('processed_year_month').eq(partition) & Key('processed_timestamp').between(
+                    decimal.Decimal(str(query.start_ts)), decimal.Decimal(str(query.end_ts))),
+                ScanIndexForward=False,
+                Limit=1,
+                ProjectionExpression='processed_timestamp'
+            )
+            if response['Items']:
+                return response['Items'][0]['processed_timestamp']
+        return None
+
+    def run(self, query):
+        '''Returns (items, query for the next page or None).'''
+        partitions = [partition for partition, position in sorted(query.positions.items()) if position is not False]
+        if not partitions:
+            return [], None
+        if len(partitions) == 1:
+            results = [self._read_partition(query, partitions[0])]
+        else:
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(partitions))) as executor:
+                results = list(executor.map(lambda partition: self._read_partition(query, partition), partitions))
+
+        merged = []
+        frontier = None
+        for partition, (items, last_key) in zip(partitions, results):
+            merged.extend((item['processed_timestamp'], item['frame_id'], partition, item) for item in items)
+            if last_key is not None:
+                #Unread items of this partition lie beyond its last evaluated timestamp.
+                ts = decimal.Decimal(last_key['processed_timestamp'])
+                if frontier is None:
+                    frontier = ts
+                else:
+                    frontier = min(frontier, ts) if query.ascending else max(frontier, ts)
+        merged.sort(key=lambda entry: (entry[0], entry[1]), reverse=not query.ascending)
+        if frontier is not None:
+            merged = [entry for entry in merged if (entry[0] <= frontier if query.ascending else entry[0] >= frontier)]
+        page = merged[:query.limit]
+
+        positions = dict(query.positions)
+        taken = {}
+        for _, _, partition, item in page:
+            taken.setdefault(partition, []).append(item)
+        for partition, (items, last_key) in zip(partitions, results):
+            partition_taken = taken.get(partition, [])
+            if len(partition_taken) < len(items):
+                if partition_taken:
+                    positions[partition] = _item_key(partition_taken[-1])
+            else:
+                positions[partition] = last_key if last_key is not None else False
+
+        next_query = None
+        if any(position is not False for position in positions.values()):
+            next_query = FrameQuery(query.start_ts, query.end_ts, query.cameras, query.limit, query.fields,
+                                    query.ascending, positions)
+        return [item for _, _, _, item in page], next_query
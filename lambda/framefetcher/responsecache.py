@@ -0,0 +1,145 @@
+from __future__ import print_function
+import collections
+import decimal
+import hashlib
+import json
+
+
+def _decimal_default(o):
+    if isinstance(o, decimal.Decimal):
+        return int(o) if o == o.to_integral_value() else float(o)
+    raise TypeError('Object of type {} is not JSON serializable'.format(type(o).__name__))
+
+
+def frame_json(item):
+    '''JSON of one frame item. Decimal attributes become ints or floats.'''
+    plain = {}
+    for name, value in item.items():
+        if type(value) is decimal.Decimal:
+            value = int(value) if value == value.to_integral_value() else float(value)
+        plain[name] = value
+    return json.dumps(plain, default=_decimal_default)
+
+
+class FrameSerializer(object):
+    '''Serializes pages of frames, keeping the JSON of each frame it has seen.
+
+    Frames do not change once stored, so a frame's JSON is reused for as long as
+    its signed URL and the requested fields stay the same. A page that gained
+    one new frame costs one frame_json() call. At most cache_size frames are kept.'''
+
+    def __init__(self, cache_size=10000):
+        self.cache_size = cache_size
+        self._fragments = collections.OrderedDict()
+        self.stats = {'hits': 0, 'encoded': 0}
+
+    def body(self, items, fields=None):
+        '''The JSON list of items, as json.dumps would write it.'''
+        fields = tuple(fields) if fields else None
+        parts = []
+        for item in items:
+            key = (item['frame_id'], item.get('s3_presigned_url'), fields)
+            fragment = self._fragments.get(key)
+            if fragment is None:
+                fragment = frame_json(item)
+                self.stats['encoded'] += 1
+                if self.cache_size:
+                    self._fragments[key] = fragment
+                    if len(self._fragments) > self.cache_size:
+                        self._fragments.popitem(last=False)
+            else:
+                self._fragments.move_to_end(key)
+                self.stats['hits'] += 1
+            parts.append(fragment)
+        return '[' + ', '.join(parts) + ']'
+
+
+def request_key(params):
+    '''Identifies a request by its query string parameters.'''
+    return tuple(sorted((name, value) for name, value in (params or {}).items() if value not in (None, '')))
+
+
+def etag(key, newest_ts, count, valid_until, cursor):
+    '''A weak ETag for a page: its request, its newest frame, its size, when its URLs
+    expire and where the next page starts. Polls that find no new frames get the same one.'''
+    digest = hashlib.sha1(json.dumps([key, str(newest_ts), count, valid_until, cursor]).encode('utf-8'))
+    return 'W/"{}"'.format(digest.hexdigest()[:20])
+
+
+def etag_matches(header, tag):
+    '''Whether an If-None-Match header value lists tag. Weak comparison, as RFC 7232 asks.'''
+    if not header:
+        return False
+    if header.strip() == '*':
+        return True
+    opaque = tag[2:] if tag.startswith('W/') else tag
+    for candidate in header.split(','):
+        candidate = candidate.strip()
+        if (candidate[2:] if candidate.startswith('W/') else candidate) == opaque:
+            return True
+    return False
+
+
+class CachedPage(object):
+
+    def __init__(self, body, tag, headers, newest_ts, valid_until, created):
+        self.body = body
+        self.etag = tag
+        self.headers = headers
+        self.newest_ts = newest_ts
+        self.valid_until = valid_until
+        self.created = created
+        self.checked = created
+
+
+class ResultCache(object):
+    '''Pages recently returned by this container, keyed by request_key().
+
+    A page is served as is for ttl_secs after it was built or last checked.
+    After that, a live page (one whose range ends now) may be reused once a
+    cheap check finds the newest frame unchanged, up to max_age_secs after it
+    was built. Pages are never served once their signed URLs come within
+    margin_secs of expiring. At most size pages are kept.'''
+
+    def __init__(self, ttl_secs=2, max_age_secs=60, margin_secs=300, size=256):
+        self.ttl_secs = ttl_secs
+        self.max_age_secs = max_age_secs
+        self.margin_secs = margin_secs
+        self.size = size
+        self._pages = collections.OrderedDict()
+        self.stats = {'hits': 0, 'revalidated': 0, 'misses': 0}
+
+    def _usable(self, page, now):
+        return page.valid_until is None or page.valid_until - self.margin_secs > now
+
+    def get(self, key, now):
+        '''A page that can be served without checking, or None.'''
+        page = self._pages.get(key)
+        if page is None or not self._usable(page, now) or page.checked + self.ttl_secs <= now:
+            return None
+        self._pages.move_to_end(key)
+        self.stats['hits'] += 1
+        return page
+
+    def stale(self, key, now):
+        '''A page past its TTL that may still be reused if the newest frame is unchanged, or None.'''
+        page = self._pages.get(key)
+        if page is None or not self._usable(page, now) or page.created + self.max_age_secs <= now:
+            return None
+        return page
+
+    def revalidated(self, key, page, now):
+        page.checked = now
+        self._pages.move_to_end(key)
+        self.stats['revalidated'] += 1
+        return page
+
+    def put(self, key, page):
+        self.stats['misses'] += 1
+        if not self.size or not self.ttl_secs:
+            return page
+        self._pages[key] = page
+        self._pages.move_to_end(key)
+        while len(self._pages) > self.size:
+            self._pages.popitem(last=False)
+        return page
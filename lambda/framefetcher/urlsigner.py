@@ -0,0 +1,113 @@
+from __future__ import print_function
+import collections
+import datetime
+import math
+
+try:
+    from urllib.parse import quote
+except ImportError:
+    from urllib import quote
+
+from botocore.signers import CloudFrontSigner
+
+SIGNING_MODES = ('s3', 'cloudfront', 'cloudfront-batch')
+
+
+def aligned_expiry(now, expiry_secs, bucket_secs):
+    '''The end of the time bucket in which now + expiry_secs falls.
+
+    URLs signed within the same bucket all expire at the same moment, so
+    repeated responses carry the same URLs and can be cached as a whole.'''
+    expires_at = now + expiry_secs
+    if bucket_secs:
+        expires_at = math.ceil(expires_at / float(bucket_secs)) * bucket_secs
+    return int(expires_at)
+
+
+def rsa_signer(private_key_pem):
+    '''A CloudFront RSA-SHA1 signing function. Needs the cryptography package,
+    which is not part of the Lambda runtime; add it in a layer to use CloudFront URLs.'''
+    try:
+        from cryptography.hazmat.backends import default_backend
+        from cryptography.hazmat.primitives import hashes, serialization
+        from cryptography.hazmat.primitives.asymmetric import padding
+    except ImportError:
+        raise ValueError('CloudFront URL signing needs the cryptography package, which is not installed')
+    if not isinstance(private_key_pem, bytes):
+        private_key_pem = private_key_pem.encode('ascii')
+    key = serialization.load_pem_private_key(private_key_pem, password=None, backend=default_backend())
+    return lambda message: key.sign(message, padding.PKCS1v15(), hashes.SHA1())
+
+
+class UrlSigner(object):
+    '''Signed GET URLs for frames, cached per bucket and key.
+
+    A URL is reused until margin_secs before it expires. Expiry times are
+    aligned to bucket_secs (see aligned_expiry), so a URL lives between
+    expiry_secs and expiry_secs + bucket_secs. At most cache_size URLs are
+    kept, least recently used first out; 0 disables the cache.
+
+    Modes:
+    s3 - an S3 pre-signed URL per frame.
+    cloudfront - a CloudFront canned-policy URL per frame.
+    cloudfront-batch - one CloudFront custom policy for every object of the
+        distribution, signed once per time bucket and appended to each frame's URL.'''
+
+    def __init__(self, mode, expiry_secs, margin_secs=300, bucket_secs=300, cache_size=10000,
+                 s3_client=None, cloudfront_domain=None, key_pair_id=None, signer=None):
+        if mode not in SIGNING_MODES:
+            raise ValueError('Unknown URL signing mode "{}". Choose from: {}.'.format(mode, ', '.join(SIGNING_MODES)))
+        if margin_secs >= expiry_secs:
+            raise ValueError('The pre-signed URL margin must be shorter than its expiry.')
+        if mode != 's3' and not (cloudfront_domain and key_pair_id and signer):
+            raise ValueError('CloudFront URL signing needs a domain, a key pair id and a private key.')
+        self.mode = mode
+        self.expiry_secs = expiry_secs
+        self.margin_secs = margin_secs
+        self.bucket_secs = bucket_secs
+        self.cache_size = cache_size
+        self.s3_client = s3_client
+        self.base_url = 'https://{}/'.format(cloudfront_domain) if cloudfront_domain else None
+        self.cloudfront = CloudFrontSigner(key_pair_id, signer) if mode != 's3' else None
+        self._urls = collections.OrderedDict()
+        self._batch = None  #(query string, expires_at) of the cloudfront-batch policy
+        self.stats = {'hits': 0, 'signed': 0, 'evicted': 0}
+
+    def _sign(self, bucket, key, now):
+        '''Returns (url, expiry time).'''
+        expires_at = aligned_expiry(now, self.expiry_secs, self.bucket_secs)
+        if self.mode == 's3':
+            return self.s3_client.generate_presigned_url(
+                ClientMethod='get_object',
+                Params={'Bucket': bucket, 'Key': key},
+                ExpiresIn=expires_at - int(now)
+            ), expires_at
+        url = self.base_url + quote(key)
+        if self.mode == 'cloudfront':
+            return self.cloudfront.generate_presigned_url(
+                url, date_less_than=datetime.datetime.utcfromtimestamp(expires_at)), expires_at
+        if self._batch is None or self._batch[1] - self.margin_secs <= now:
+            resource = self.base_url + '*'
+            policy = self.cloudfront.build_policy(resource, datetime.datetime.utcfromtimestamp(expires_at))
+            self._batch = (self.cloudfront.generate_presigned_url(resource, policy=policy).split('?', 1)[1],
+                           expires_at)
+        return '{}?{}'.format(url, self._batch[0]), self._batch[1]
+
+    def sign(self, bucket, key, now):
+        '''Returns (url, expiry time) of a signed URL for the object that stays
+        valid for at least margin_secs after now.'''
+        cache_key = (bucket, key)
+        entry = self._urls.get(cache_key)
+        if entry is not None and entry[1] - self.margin_secs > now:
+            self._urls.move_to_end(cache_key)
+            self.stats['hits'] += 1
+            return entry
+
+        entry = self._sign(bucket, key, now)
+        self.stats['signed'] += 1
+        if self.cache_size:
+            self._urls[cache_key] = entry
+            while len(self._urls) > self.cache_size:
+                self._urls.popitem(last=False)
+                self.stats['evicted'] += 1
+        return entry
@@ -0,0 +1,167 @@
+from __future__ import print_function
+import threading
+
+from ratelimit import TokenBucket
+
+# SNS PublishBatch limits
+MAX_ENTRIES_PER_BATCH = 10
+MAX_MESSAGE_BYTES = 256 * 1024
+
+
+def format_alert(alert, watchlist_item):
+    '''One line of an alert message, in the wording of the original single alerts.'''
+    if watchlist_item is None:
+        return '- A watchlist face ({}) was detected on camera {}. Click on {} to view the image'.format(
+            alert['external_image_id'], alert['camera_id'], alert['s3_url'])
+    return '- "{}" was detected. {}. Click on {} to view the image'.format(
+        watchlist_item.get('Name', alert['external_image_id']), watchlist_item.get('Message', ''), alert['s3_url'])
+
+
+class AlertNotSent(Exception):
+    '''The error recorded for a frame whose alert could not be sent. Replaying the frame sends it again.'''
+
+    code = 'AlertNotSent'
+    retryable = True
+
+
+class AlertAggregator(object):
+    '''Collects watchlist matches and sends them to SNS as digest messages.
+
+    Matches are added with add() from any thread. flush() turns everything
+    collected into digests of up to max_alerts_per_message matches and sends
+    them with PublishBatch. At most max_messages_per_minute digests go to the
+    topic. Nothing is kept after flush(), since a container can be recycled
+    between invocations: the matches over the limit, and those of digests SNS
+    did not accept, are returned to the caller instead.'''
+
+    def __init__(self, sns_client, topic_arn, max_alerts_per_message=20, max_messages_per_minute=10):
+        self.sns_client = sns_client
+        self.topic_arn = topic_arn
+        self.max_alerts_per_message = max(1, max_alerts_per_message)
+        self.rate_limit = TokenBucket(max_messages_per_minute / 60.0, max(1, max_messages_per_minute))
+        self._pending = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self.stats = {
+            'alerts': 0,
+            'alerts_sent': 0,
+            'messages': 0,
+            'requests': 0,
+            'failed_messages': 0,
+            'rate_limited': 0,
+        }
+
+    def add(self, external_image_id, camera_id, s3_url, detected_at, source=None):
+        '''Queues one match. detected_at is a localized datetime; source is handed back if the match is not sent.'''
+        with self._lock:
+            self._pending.append({
+                'external_image_id': external_image_id,
+                'camera_id': camera_id,
+                's3_url': s3_url,
+                'detected_at': detected_at,
+                'source': source
+            })
+            self.stats['alerts'] += 1
+
+    def discard(self, sources):
+        '''Drops the queued matches added with one of sources. Returns the matches dropped.'''
+        sources = set(id(source) for source in sources)
+        with self._lock:
+            dropped = [alert for alert in self._pending if id(alert['source']) in sources]
+            self._pending = [alert for alert in self._pending if id(alert['source']) not in sources]
+        return dropped
+
+    def collapsed(self):
+        '''Delivered matches that did not need a message of their own.'''
+        with self._lock:
+            return self.stats['alerts_sent'] - self.stats['messages']
+
+    def flush(self, lookup):
+        '''Publishes pending matches. lookup(ids) returns {ExternalImageId: watchlist item}.
+
+        Returns the matches that were not sent, because of the rate limit or
+        because publishing failed.'''
+        with self._flush_lock:
+            with self._lock:
+                alerts, self._pending = self._pending, []
+            if not alerts:
+                return []
+
+            if not self.topic_arn:
+                # No topic configured; nothing to send.
+                return []
+
+            digests = [alerts[i:i + self.max_alerts_per_message]
+                       for i in range(0, len(alerts), self.max_alerts_per_message)]
+            allowed = 0
+            while allowed < len(digests) and self.rate_limit.try_acquire():
+                allowed += 1
+            unsent = [alert for digest in digests[allowed:] for alert in digest]
+            if unsent:
+                with self._lock:
+                    self.stats['rate_limited'] += len(unsent)
+                print('Alert rate limit reached; {} matches not sent.'.format(len(unsent)))
+                digests = digests[:allowed]
+            if not digests:
+                return unsent
+
+            try:
+                watchlist = lookup(set(alert['external_image_id'] for digest in digests for alert in digest))
+            except Exception as e:
+                print('Failed to look up watchlist people for alerts: {}'.format(e))
+                return unsent + [alert for digest in digests for alert in digest]
+            entries = [self._entry(index, digest, watchlist) for index, digest in enumerate(digests)]
+            failed = self._publish(entries)
+
+            published = len(digests) - len(failed)
+            alerts_sent = sum(len(digest) for index, digest in enumerate(digests) if index not in failed)
+            unsent += [alert for index in sorted(failed) for alert in digests[index]]
+            with self._lock:
+                self.stats['messages'] += published
+                self.stats['alerts_sent'] += alerts_sent
+            print('Published {} alert digest(s) for {} matches; {} notifications collapsed so far.'.format(
+                published, alerts_sent, self.collapsed()))
+            return unsent
+
+    def _entry(self, index, digest, watchlist):
+        names = set()
+        lines = []
+        for alert in digest:
+            item = watchlist.get(alert['external_image_id'])
+            names.add(item.get('Name', alert['external_image_id']) if item else alert['external_image_id'])
+            lines.append('On {}...\n{}'.format(
+                alert['detected_at'].strftime('%x, %-I:%M %p %Z'), format_alert(alert, item)))
+
+        message = '\n\n'.join(lines)
+        if len(message.encode('utf-8')) > MAX_MESSAGE_BYTES:
+            message = message.encode('utf-8')[:MAX_MESSAGE_BYTES - 100].decode('utf-8', 'ignore') + '\n... (truncated)'
+
+        subject = 'Felon detected' if len(names) == 1 else '{} felons detected'.format(len(names))
+        return {'Id': str(index), 'Message': message, 'Subject': subject}
+
+    def _publish(self, entries):
+        '''Sends entries with PublishBatch. Returns the indexes of the entries that were not published.'''
+        failed = set()
+        for i in range(0, len(entries), MAX_ENTRIES_PER_BATCH):
+            batch = entries[i:i + MAX_ENTRIES_PER_BATCH]
+            with self._lock:
+                self.stats['requests'] += 1
+            try:
+                response = self.sns_client.publish_batch(TopicArn=self.topic_arn, PublishBatchRequestEntries=batch)
+            except Exception as e:
+                print('Failed to publish alerts: {}'.format(e))
+                with self._lock:
+                    self.stats['failed_messages'] += len(batch)
+                failed.update(int(entry['Id']) for entry in batch)
+                continue
+            #Entries missing from both lists count as failed, so their matches are not lost.
+            succeeded = set(int(success['Id']) for success in response.get('Successful', []))
+            for failure in response.get('Failed', []):
+                print('Failed to publish alert {}: {}'.format(failure.get('Id'), failure.get('Message')))
+            batch_failed = set(int(entry['Id']) for entry in batch) - succeeded
+            with self._lock:
+                self.stats['failed_messages'] += len(batch_failed)
+            failed |= batch_failed
+        if len(failed) < len(entries):
+            print("Successfully published alert message to SNS.")
+        return failed
@@ -0,0 +1,103 @@
+from __future__ import print_function
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import framehash
+
+
+class FrameArchiver(object):
+    '''Uploads frame images to S3 in the background and skips repeated frames.
+
+    archive() returns at once with the S3 key that holds the frame; the upload
+    runs on the archiver's own thread pool while the caller goes on with face
+    search. wait() must be called before the invocation ends.
+
+    A frame whose hash matches a frame archived from the same camera in the
+    last dedup_window_secs is not uploaded again; the earlier key is returned
+    instead. With hash_mode "content" only byte-identical frames match. With
+    "perceptual", frames whose difference hashes are at most max_distance bits
+    apart match, which also catches a static scene re-encoded with sensor noise.'''
+
+    def __init__(self, s3_client, bucket, max_workers=8, dedup_window_secs=300, hash_mode='content',
+                 max_distance=4, recent_per_camera=8):
+        if hash_mode == 'perceptual' and not framehash.has_perceptual():
+            raise ValueError('Archive dedup hash "perceptual" needs Pillow, which is not installed; '
+                             'package it or set the hash to "content".')
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.dedup_window_secs = dedup_window_secs
+        self.hash_mode = hash_mode
+        self.max_distance = max_distance
+        self.recent_per_camera = recent_per_camera
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._recent = {}
+        self._inflight = []
+        self._lock = threading.Lock()
+        self.stats = {
+            'frames': 0,
+            'uploads': 0,
+            'duplicates': 0,
+            'failed': 0,
+            'bytes_uploaded': 0,
+            'bytes_skipped': 0,
+        }
+
+    def _hash(self, image_bytes):
+        if self.hash_mode == 'perceptual':
+            return framehash.dhash(image_bytes)
+        return framehash.content_hash(image_bytes)
+
+    def _matches(self, a, b):
+        if self.hash_mode == 'perceptual':
+            return framehash.hamming(a, b) <= self.max_distance
+        return a == b
+
+    def archive(self, image_bytes, camera_id, s3_key, now=None):
+        '''Schedules the upload of a frame to s3_key. Returns the key the frame can be read from.'''
+        now = time.time() if now is None else now
+        frame_hash = self._hash(image_bytes) if self.dedup_window_secs > 0 else None
+
+        with self._lock:
+            self.stats['frames'] += 1
+            if frame_hash is not None:
+                recent = [entry for entry in self._recent.get(camera_id, []) if entry[2] > now]
+                self._recent[camera_id] = recent
+                for entry in reversed(recent):
+                    if self._matches(entry[0], frame_hash):
+                        self.stats['duplicates'] += 1
+                        self.stats['bytes_skipped'] += len(image_bytes)
+                        return entry[1]
+                recent.append((frame_hash, s3_key, now + self.dedup_window_secs))
+                del recent[:-self.recent_per_camera]
+            future = self._executor.submit(self._upload, image_bytes, s3_key)
+            self._inflight.append((future, camera_id, s3_key))
+        return s3_key
+
+    def _upload(self, image_bytes, s3_key):
+        self.s3_client.put_object(Bucket=self.bucket, Key=s3_key, Body=image_bytes)
+        with self._lock:
+            self.stats['uploads'] += 1
+            self.stats['bytes_uploaded'] += len(image_bytes)
+
+    def wait(self):
+        '''Waits for the scheduled uploads. Returns {s3_key: error} for the uploads that failed.'''
+        with self._lock:
+            inflight, self._inflight = self._inflight, []
+        failed = {}
+        for future, camera_id, s3_key in inflight:
+            try:
+                future.result()
+            except Exception as e:
+                print('Failed to archive frame {}: {}'.format(s3_key, e))
+                failed[s3_key] = e
+                with self._lock:
+                    self.stats['failed'] += 1
+                    #Do not let later frames point at an object that was never stored.
+                    self._recent[camera_id] = [entry for entry in self._recent.get(camera_id, [])
+                                               if entry[1] != s3_key]
+        return failed
+
+    def clear(self):
+        with self._lock:
+            self._recent.clear()
@@ -0,0 +1,90 @@
+from __future__ import print_function
+import json
+import time
+import uuid
+
+from botocore.exceptions import ClientError, ConnectionError as BotoConnectionError, HTTPClientError
+
+from recognition import THROTTLING_ERRORS, TRANSIENT_ERRORS
+
+# S3 and DynamoDB codes for throttles and service-side failures, besides Rekognition's
+SERVICE_TRANSIENT_ERRORS = (
+    'SlowDown',
+    'RequestTimeout',
+    'InternalError',
+    'Throttling',
+    'RequestLimitExceeded',
+)
+
+
+class FrameError(Exception):
+    '''A frame that failed outside Rekognition. retryable tells whether replaying the frame later may help.'''
+
+    def __init__(self, message, code=None, retryable=False):
+        Exception.__init__(self, message)
+        self.code = code
+        self.retryable = retryable
+
+
+def is_transient(error):
+    '''Whether error is a throttle, a timeout or a 5xx reply, which may not happen again on replay.'''
+    if isinstance(error, ClientError):
+        code = error.response.get('Error', {}).get('Code')
+        status = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode') or 0
+        return code in THROTTLING_ERRORS + TRANSIENT_ERRORS + SERVICE_TRANSIENT_ERRORS or status >= 500
+    #Connection failures and read timeouts
+    return isinstance(error, (BotoConnectionError, HTTPClientError))
+
+
+def dead_letter_entry(record, error):
+    '''The JSON line stored for one failed Kinesis record. It holds everything needed to put the record back.'''
+    kinesis = record['kinesis']
+    #Errors that do not say are only replayed when they look transient
+    retryable = getattr(error, 'retryable', None)
+    if retryable is None:
+        retryable = is_transient(error)
+    return {
+        'partition_key': kinesis.get('partitionKey'),
+        'sequence_number': kinesis.get('sequenceNumber'),
+        'data': kinesis['data'],
+        'error': str(error),
+        'error_code': getattr(error, 'code', None) or type(error).__name__,
+        'retryable': retryable,
+        'failed_at': time.time()
+    }
+
+
+class S3DeadLetterStore(object):
+    '''Stores Kinesis records that could not be processed in S3, one JSON Lines object per invocation.
+
+    Objects are written under <prefix>YYYY/MM/DD/HH/. Frames can be up to
+    1 MB, more than an SQS message holds, so S3 is used rather than SQS.
+    "pynt replaydeadletters" puts the records back on the stream.'''
+
+    def __init__(self, s3_client, bucket, prefix='deadletter/'):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.prefix = prefix
+        self.stats = {
+            'records': 0,
+            'objects': 0,
+            'failed': 0,
+        }
+
+    def put(self, failures):
+        '''Stores (record, error) pairs. Returns True if they were stored.'''
+        if not failures:
+            return True
+        body = '\n'.join(json.dumps(dead_letter_entry(record, error)) for record, error in failures)
+        key = '{}{}/{}.jsonl'.format(self.prefix, time.strftime('%Y/%m/%d/%H', time.gmtime()), uuid.uuid4())
+        try:
+            self.s3_client.put_object(Bucket=self.bucket, Key=key, Body=body.encode('utf-8'),
+                                      ContentType='application/x-ndjson')
+        except Exception as e:
+            print('Failed to store {} dead-letter records: {}'.format(len(failures), e))
+            self.stats['failed'] += len(failures)
+            return False
+        print('Stored {} failed records in s3://{}/{}'.format(len(failures), self.bucket, key))
+        self.stats['records'] += len(failures)
+        self.stats['objects'] += 1
+        return True
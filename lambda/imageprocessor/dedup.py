@@ -0,0 +1,122 @@
+from __future__ import print_function
+import threading
+import time
+from collections import OrderedDict
+
+from boto3.dynamodb.conditions import Attr
+from botocore.exceptions import ClientError
+
+
+class TTLCache(object):
+    '''In-memory LRU cache whose entries expire. Values are expiry timestamps.'''
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+
+    def get(self, key, now):
+        '''Returns the expiry of a live entry, or None.'''
+        expires_at = self._entries.get(key)
+        if expires_at is None:
+            return None
+        if expires_at <= now:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return expires_at
+
+    def put(self, key, expires_at):
+        self._entries[key] = expires_at
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def delete(self, key):
+        self._entries.pop(key, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        self._entries.clear()
+
+
+def dedup_key(external_image_id, camera_id):
+    return '{}#{}'.format(external_image_id, camera_id)
+
+
+class AlertDeduplicator(object):
+    '''Decides whether a watchlist match should raise an alert.
+
+    A person (ExternalImageId) seen by a camera alerts at most once per
+    cooldown_secs. Decisions are cached in memory; when a DynamoDB table is
+    given, a conditional write on it makes concurrent containers agree on who
+    alerts. The table's hash key is "dedup_key" and its TTL attribute is
+    "expires_at". Without a table, deduplication is per container.'''
+
+    def __init__(self, table=None, cooldown_secs=600, max_entries=1024):
+        self.table = table
+        self.cooldown_secs = cooldown_secs
+        self.cache = TTLCache(max_entries)
+        self._lock = threading.Lock()
+
+    def claim(self, external_image_id, camera_id, now=None):
+        '''Returns True if the caller should send the alert; False if it is a repeat within the cooldown.'''
+        now = time.time() if now is None else now
+        key = dedup_key(external_image_id, camera_id)
+        expires_at = int(now + self.cooldown_secs)
+
+        with self._lock:
+            if self.cache.get(key, now) is not None:
+                return False
+            if self.table is None:
+                self.cache.put(key, expires_at)
+                return True
+
+        claimed, expires_at = self._claim_in_table(key, now, expires_at)
+        with self._lock:
+            self.cache.put(key, expires_at)
+        return claimed
+
+    def _claim_in_table(self, key, now, expires_at):
+        try:
+            self.table.put_item(
+                Item={
+                    'dedup_key': key,
+                    'alerted_at': int(now),
+                    'expires_at': expires_at
+                },
+                ConditionExpression=Attr('dedup_key').not_exists() | Attr('expires_at').lte(int(now))
+            )
+            return True, expires_at
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                # Fail open: a duplicate alert is better than a missed one.
+                print('Alert dedup table unavailable, alerting: {}'.format(e))
+                return True, expires_at
+
+        # Another container alerted first. Cache its decision until it expires.
+        try:
+            item = self.table.get_item(Key={'dedup_key': key}, ConsistentRead=True).get('Item')
+            if item:
+                return False, int(item['expires_at'])
+        except ClientError as e:
+            print(e)
+        return False, expires_at
+
+    def release(self, external_image_id, camera_id):
+        '''Gives up a claim whose alert was not sent, so the next sighting alerts again.'''
+        key = dedup_key(external_image_id, camera_id)
+        with self._lock:
+            self.cache.delete(key)
+        if self.table is None:
+            return
+        try:
+            self.table.delete_item(Key={'dedup_key': key})
+        except ClientError as e:
+            print('Failed to release alert claim {}: {}'.format(key, e))
+
+    def clear(self):
+        '''Forgets the in-memory cache (the DynamoDB table is left alone).'''
+        with self._lock:
+            self.cache.clear()
@@ -0,0 +1,145 @@
+from __future__ import print_function
+import io
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from recognition import RekognitionError
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+LARGEST = 'largest'
+ALL = 'all'
+
+# Share of a face's width and height added on each side of its crop, so Rekognition sees the whole head
+CROP_MARGIN = 0.4
+
+
+def has_cropping():
+    '''Whether Pillow is available to crop faces.'''
+    return Image is not None
+
+
+def crop_boxes(face_details, width, height, max_faces, min_face_px, margin=CROP_MARGIN):
+    '''Pixel boxes (left, top, right, bottom) around the largest faces, at most max_faces of them.
+
+    Faces narrower or shorter than min_face_px pixels are left out. Returns the
+    boxes and the number of faces left out.'''
+    boxes = []
+    for face in face_details:
+        box = face['BoundingBox']
+        face_width, face_height = box['Width'] * width, box['Height'] * height
+        if min(face_width, face_height) < min_face_px:
+            continue
+        left, top = box['Left'] * width, box['Top'] * height
+        boxes.append((face_width * face_height, (
+            max(0, int(left - face_width * margin)),
+            max(0, int(top - face_height * margin)),
+            min(width, int(left + face_width * (1 + margin))),
+            min(height, int(top + face_height * (1 + margin)))
+        )))
+    boxes.sort(key=lambda entry: entry[0], reverse=True)
+    return [box for _, box in boxes[:max_faces]], len(face_details) - min(len(boxes), max_faces)
+
+
+def merge_matches(responses):
+    '''One FaceMatches list with the best match of each watchlist person over all responses.'''
+    best = {}
+    for response in responses:
+        for match in response.get('FaceMatches', []):
+            external_image_id = match['Face'].get('ExternalImageId')
+            if external_image_id not in best or match['Similarity'] > best[external_image_id]['Similarity']:
+                best[external_image_id] = match
+    return sorted(best.values(), key=lambda match: match['Similarity'], reverse=True)
+
+
+class FaceSearcher(object):
+    '''Searches a frame's faces in the watchlist collection.
+
+    search_faces_by_image only searches the largest face of an image, so in
+    mode "largest" a crowded frame matches one person at most. In mode "all",
+    search() finds the faces with one detect_faces call, crops up to max_faces
+    of them with Pillow and searches the crops in parallel, all through the
+    rate-limited caller. A frame with one face is searched whole, and a frame
+    with none is not searched. So is a frame whose faces are all too small to
+    crop, since search may still find the largest of them. The response looks like search_faces_by_image's,
+    with the matches of every face searched.'''
+
+    def __init__(self, caller, collection_id, threshold=40, mode=LARGEST, max_faces=5, min_face_px=24,
+                 max_workers=4, jpeg_quality=90):
+        if mode == ALL and not has_cropping():
+            raise ValueError('Face search mode "all" needs Pillow, which is not installed; '
+                             'package it or set the mode to "largest".')
+        self.caller = caller
+        self.collection_id = collection_id
+        self.threshold = threshold
+        self.mode = mode
+        self.max_faces = max_faces
+        self.min_face_px = min_face_px
+        self.jpeg_quality = jpeg_quality
+        self._executor = ThreadPoolExecutor(max_workers=max_workers) if mode == ALL else None
+        self._lock = threading.Lock()
+        self.stats = {
+            'frames': 0,
+            'faces': 0,
+            'searches': 0,
+            'skipped_faces': 0,
+            'faceless_crops': 0,
+        }
+
+    def _count(self, **counts):
+        with self._lock:
+            for name, count in counts.items():
+                self.stats[name] += count
+
+    def _search(self, image_bytes):
+        return self.caller.search_faces_by_image(
+            CollectionId=self.collection_id,
+            FaceMatchThreshold=self.threshold,
+            Image={
+                'Bytes': image_bytes
+            }
+        )
+
+    def _search_crop(self, image, box):
+        output = io.BytesIO()
+        image.crop(box).save(output, format='JPEG', quality=self.jpeg_quality)
+        try:
+            return self._search(output.getvalue())
+        except RekognitionError as e:
+            if e.code != 'InvalidParameterException':
+                raise
+            #detect_faces saw a face that search does not; the rest of the frame still counts
+            self._count(faceless_crops=1)
+            return {'FaceMatches': []}
+
+    def search(self, image_bytes):
+        '''The search_faces_by_image response of the frame, with every searched face's matches.'''
+        if self.mode == LARGEST:
+            self._count(frames=1, searches=1)
+            return self._search(image_bytes)
+
+        face_details = self.caller.detect_faces(Image={'Bytes': image_bytes}).get('FaceDetails', [])
+        if len(face_details) <= 1:
+            self._count(frames=1, faces=len(face_details), searches=len(face_details))
+            return self._search(image_bytes) if face_details else {'FaceMatches': []}
+
+        image = Image.open(io.BytesIO(image_bytes))
+        image.load()
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        boxes, skipped = crop_boxes(face_details, image.size[0], image.size[1], self.max_faces, self.min_face_px)
+        if not boxes:
+            self._count(frames=1, faces=len(face_details), searches=1, skipped_faces=skipped)
+            try:
+                return self._search(image_bytes)
+            except RekognitionError as e:
+                if e.code != 'InvalidParameterException':
+                    raise
+                #Too small for search as well; the frame has no face to match
+                return {'FaceMatches': []}
+        self._count(frames=1, faces=len(face_details), searches=len(boxes), skipped_faces=skipped)
+        responses = list(self._executor.map(lambda box: self._search_crop(image, box), boxes))
+        return {'FaceMatches': merge_matches(responses), 'SearchedFaces': len(boxes)}
@@ -0,0 +1,118 @@
+from __future__ import print_function
+import random
+import threading
+import time
+
+# BatchWriteItem limit
+MAX_ITEMS_PER_REQUEST = 25
+
+
+class BatchWriter(object):
+    '''Writes items to one DynamoDB table with BatchWriteItem, 25 at a time.
+
+    put() may be called from any thread; a full batch is written by the
+    thread that filled it. flush() writes whatever is left and must be called
+    before the invocation ends. Unprocessed items are retried with full-jitter
+    exponential backoff, up to max_retries times. discard() takes back items
+    put since the last flush; key_names are the table's key attributes.'''
+
+    def __init__(self, dynamodb, table_name, max_retries=8, backoff_secs=0.05, max_backoff_secs=2.0,
+                 key_names=('frame_id',)):
+        self.dynamodb = dynamodb
+        self.table_name = table_name
+        self.key_names = key_names
+        self.max_retries = max_retries
+        self.backoff_secs = backoff_secs
+        self.max_backoff_secs = max_backoff_secs
+        self._items = []
+        self._failed = []
+        self._written = []
+        self._lock = threading.Lock()
+        self.stats = {
+            'items': 0,
+            'written': 0,
+            'requests': 0,
+            'retried': 0,
+            'failed': 0,
+            'discarded': 0,
+        }
+
+    def put(self, item):
+        with self._lock:
+            self._items.append(item)
+            self.stats['items'] += 1
+            if len(self._items) < MAX_ITEMS_PER_REQUEST:
+                return
+            batch, self._items = self._items, []
+        failed = self._write(batch)
+        with self._lock:
+            self._failed.extend(failed)
+            unwritten = set(self._key(item) for item in failed)
+            self._written.extend(item for item in batch if self._key(item) not in unwritten)
+
+    def _key(self, item):
+        return tuple(item[name] for name in self.key_names)
+
+    def discard(self, predicate):
+        '''Takes back the items put since the last flush for which predicate(item) is true.
+
+        Buffered items are dropped and items already written are deleted.
+        Returns the number of items discarded.'''
+        with self._lock:
+            dropped = [item for item in self._items + self._failed if predicate(item)]
+            self._items = [item for item in self._items if not predicate(item)]
+            self._failed = [item for item in self._failed if not predicate(item)]
+            written = [item for item in self._written if predicate(item)]
+            self._written = [item for item in self._written if not predicate(item)]
+            self.stats['discarded'] += len(dropped) + len(written)
+        for i in range(0, len(written), MAX_ITEMS_PER_REQUEST):
+            requests = [{'DeleteRequest': {'Key': dict(zip(self.key_names, self._key(item)))}}
+                        for item in written[i:i + MAX_ITEMS_PER_REQUEST]]
+            for request in self._send(requests):
+                print('Could not delete discarded item {}.'.format(request['DeleteRequest']['Key']))
+        return len(dropped) + len(written)
+
+    def flush(self):
+        '''Writes all buffered items. Returns the items that could not be written since the last flush.'''
+        with self._lock:
+            items, self._items = self._items, []
+            failed, self._failed = self._failed, []
+            self._written = []
+        for i in range(0, len(items), MAX_ITEMS_PER_REQUEST):
+            failed.extend(self._write(items[i:i + MAX_ITEMS_PER_REQUEST]))
+        return failed
+
+    def _write(self, items):
+        '''Puts items. Returns the items that could not be written.'''
+        unprocessed = self._send([{'PutRequest': {'Item': item}} for item in items])
+        with self._lock:
+            self.stats['written'] += len(items) - len(unprocessed)
+            self.stats['failed'] += len(unprocessed)
+        return [request['PutRequest']['Item'] for request in unprocessed]
+
+    def _send(self, requests):
+        '''Sends write requests with BatchWriteItem. Returns the requests that were not processed.'''
+        attempt = 0
+        while requests:
+            with self._lock:
+                self.stats['requests'] += 1
+            try:
+                response = self.dynamodb.batch_write_item(RequestItems={self.table_name: requests})
+                unprocessed = response.get('UnprocessedItems', {}).get(self.table_name, [])
+            except Exception as e:
+                print('BatchWriteItem failed: {}'.format(e))
+                unprocessed = requests
+
+            if not unprocessed:
+                return []
+
+            attempt += 1
+            if attempt > self.max_retries:
+                print('Giving up on {} items for table {}.'.format(len(unprocessed), self.table_name))
+                return unprocessed
+
+            with self._lock:
+                self.stats['retried'] += len(unprocessed)
+            time.sleep(random.uniform(0, min(self.max_backoff_secs, self.backoff_secs * (2 ** attempt))))
+            requests = unprocessed
+        return []
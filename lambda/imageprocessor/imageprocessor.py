@@ -5,25 +5,30 @@ import time
 from decimal import Decimal
 import uuid
 import json
-import pickle
-import boto3
 import pytz
-from pytz import timezone
 from copy import deepcopy
+from concurrent.futures import ThreadPoolExecutor
 import os
-
-hash = set()
+import warmruntime
+import frameformat
+import dedup
+import alerts
+import watchlist
+import framewriter
+import archive
+import recognition
+import deadletter
+import resultcache
+import facesearch
 
 def load_config():
-    '''Load configuration from file.'''
-    with open('imageprocessor-params.json', 'r') as conf_file:
-        conf_json = conf_file.read()
-        return json.loads(conf_json)
+    '''Load configuration from file. The file is read once per container.'''
+    return warmruntime.load_config('imageprocessor-params.json')
 
 def convert_ts(ts, config):
     '''Converts a timestamp to the configured timezone. Returns a localized datetime object.'''
     #lambda_tz = timezone('US/Pacific')
-    tz = timezone(config['timezone'])
+    tz = warmruntime.get_timezone(config['timezone'])
     utc = pytz.utc
     
     utc_dt = utc.localize(datetime.datetime.utcfromtimestamp(ts))
@@ -32,120 +37,283 @@ def convert_ts(ts, config):
 
     return localized_dt
 
+def process_record(record, ctx):
+    '''Runs the S3 upload, face search, alerting and DynamoDB write for one Kinesis record. Raises on failure.
 
-def process_image(event, context):
+    Returns the frame_id, and the S3 key the frame was archived under, or None if it was not archived.'''
+    config = ctx['config']
+    s3_bucket = config["s3_bucket"]
+    s3_key_frames_root = config["s3_key_frames_root"]
+    matches_only = config.get("archive_matches_only", False)
+
+    frame_package_b64 = record['kinesis']['data']
+    frame = frameformat.decode_frame(base64.b64decode(frame_package_b64),
+                                     allow_pickle=config.get("accept_pickle_frames", False))
+
+    #botocore only accepts bytes/bytearray blobs, so the payload view is materialized
+    #once here and shared by the S3 upload and the face search.
+    img_bytes = bytes(frame.payload)
+    approx_capture_ts = frame.capture_ts
+    frame_count = frame.frame_count
+    
+    now_ts = time.time()
+
+    frame_id = str(uuid.uuid4())
+    processed_timestamp = Decimal(now_ts)
+    approx_capture_timestamp = Decimal(approx_capture_ts)
+    
+    now = convert_ts(now_ts, config)
+    year = now.strftime("%Y")
+    mon = now.strftime("%m")
+    day = now.strftime("%d")
+    hour = now.strftime("%H")
+
+    #Store frame image in S3. The upload runs in the background while faces are searched,
+    #and a repeat of a recently stored frame reuses that frame's key, see archive.py
+    s3_key = (s3_key_frames_root + '{}/{}/{}/{}/{}.jpg').format(year, mon, day, hour, frame_id)
+
+    archived_key = None
+    if not matches_only:
+        s3_key = archived_key = ctx['archiver'].archive(img_bytes, frame.camera_id, s3_key, now_ts)
+
+    #Throttles and service errors are retried inside the caller; what still fails is raised
+    #and the record goes to the dead-letter store, see run_record(). A frame that looks like
+    #one this camera sent recently reuses that frame's result, see resultcache.py. Each face
+    #of a crowded frame is searched on its own, see facesearch.py
+    rekog_response = ctx['results'].search(
+        img_bytes,
+        config['rekognition_col_name'],
+        frame.camera_id,
+        ctx['watchlist'].current_version(),
+        lambda: ctx['faces'].search(img_bytes)
+    )
+
+    if 'FaceMatches' in rekog_response and rekog_response['FaceMatches']:
+        if matches_only:
+            s3_key = archived_key = ctx['archiver'].archive(img_bytes, frame.camera_id, s3_key, now_ts)
+        s3_url = f'https://{s3_bucket}.s3.us-east-1.amazonaws.com/{s3_key}'
+
+        for faces in rekog_response['FaceMatches']:
+            if ctx['dedup'].claim(faces['Face']['ExternalImageId'], frame.camera_id, now_ts):
+                #Alerts are sent as one digest per batch, see flush_alerts()
+                ctx['alerts'].add(faces['Face']['ExternalImageId'], frame.camera_id, s3_url, now, record)
+    
+        #Persist frame data in dynamodb. Items are written in batches, see framewriter.py
+
+        item = {
+            'frame_id': frame_id,
+            'processed_timestamp' : processed_timestamp,
+            'approx_capture_timestamp' : approx_capture_timestamp,
+            'processed_year_month' : year + mon, #To be used as a Hash Key for DynamoDB GSI
+            's3_bucket' : s3_bucket,
+            's3_key' : s3_key,
+            'camera_id' : frame.camera_id
+        }
+
+        ctx['frame_writer'].put(item)
+
+    return frame_id, archived_key
+
+
+def run_record(record, ctx):
+    '''Processes one record in isolation. Returns (frame_id, s3_key, None), or (None, None, error) if it failed.'''
+    try:
+        frame_id, s3_key = process_record(record, ctx)
+        return frame_id, s3_key, None
+    except Exception as e:
+        print('Failed to process record {}: {}'.format(record['kinesis'].get('sequenceNumber'), e))
+        return None, None, e
+
+
+def discard_unarchived(ctx, records, results, failed_keys):
+    '''Takes back the metadata and queued alerts of frames whose S3 upload failed.
+
+    failed_keys is {s3_key: error}. This includes frames that reused the key of
+    a repeated frame whose upload failed. Returns {frame_id: error}.'''
+    lost = dict((frame_id, (record, failed_keys[s3_key]))
+                for record, (frame_id, s3_key, error) in zip(records, results)
+                if error is None and s3_key in failed_keys)
+    if not lost:
+        return {}
+    ctx['frame_writer'].discard(lambda item: item['frame_id'] in lost)
+    for alert in ctx['alerts'].discard(record for record, _ in lost.values()):
+        ctx['dedup'].release(alert['external_image_id'], alert['camera_id'])
+    return dict((frame_id, cause) for frame_id, (_, cause) in lost.items())
 
-    #Initialize clients
-    rekog_client = boto3.client('rekognition')
-    sns_client = boto3.client('sns')
-    s3_client = boto3.client('s3')
-    dynamodb = boto3.resource('dynamodb')
+
+def store_failures(ctx, failures):
+    '''Sends failed (record, error) pairs to the dead-letter store. Returns the records that could not be stored.'''
+    if not failures:
+        return []
+    store = ctx['dead_letters']
+    if store is not None and store.put(failures):
+        return []
+    return [record for record, _ in failures]
+
+
+def lookup_watchlist(ctx, external_image_ids):
+    '''Fetches Name and Message of watchlist people through the container cache. Returns {ExternalImageId: item}.'''
+    return ctx['watchlist'].get_many(external_image_ids)
+
+
+def flush_alerts(ctx):
+    '''Publishes the alerts collected so far as digest messages. Returns the records whose alerts were not sent.
+
+    Their dedup claims are released, so replaying the records alerts again.'''
+    unsent = ctx['alerts'].flush(lambda external_image_ids: lookup_watchlist(ctx, external_image_ids))
+    for alert in unsent:
+        ctx['dedup'].release(alert['external_image_id'], alert['camera_id'])
+    return [alert['source'] for alert in unsent if alert['source'] is not None]
+
+
+def build_context():
+    '''Builds the clients, tables and settings shared by every record. Called once per container.'''
 
     #Load config
     config = load_config()
 
-    s3_bucket = config["s3_bucket"]
-    s3_key_frames_root = config["s3_key_frames_root"]
+    #Size the HTTP connection pools to the number of records processed at once.
+    max_concurrency = max(1, int(config.get("max_concurrency", 1)))
+    pool_size = max(10, max_concurrency)
 
-    ddb_table = dynamodb.Table(config["ddb_table"])
-    ddb_frame_table = dynamodb.Table(config['ddb_input_image_table'])
+    #Initialize clients
+    dynamodb = warmruntime.get_resource('dynamodb', pool_size)
+
+    #Repeat alerts for the same person and camera are suppressed for alert_cooldown_secs.
+    #With ddb_dedup_table set, containers share that decision through DynamoDB.
+    dedup_table_name = config.get("ddb_dedup_table")
+    alert_dedup = dedup.AlertDeduplicator(
+        dynamodb.Table(dedup_table_name) if dedup_table_name else None,
+        cooldown_secs=int(config.get("alert_cooldown_secs", 600)),
+        max_entries=int(config.get("dedup_cache_size", 1024))
+    )
       
+    #Face search results of near-identical frames are reused for recognition_cache_ttl_secs.
+    #With ddb_recognition_cache_table set, containers share them through DynamoDB.
+    hash_size = int(config.get("recognition_cache_hash_size", 16))
+    results_table_name = config.get("ddb_recognition_cache_table")
+    recognition_cache = resultcache.RecognitionCache(
+        resultcache.LocalResultStore(int(config.get("recognition_cache_size", 1024))),
+        resultcache.DynamoResultStore(dynamodb, results_table_name, hash_bits=hash_size * hash_size)
+        if results_table_name else None,
+        hash_mode=config.get("recognition_cache_hash", "phash"),
+        hash_size=hash_size,
+        max_distance=int(config.get("recognition_cache_max_distance", 8)),
+        ttl_secs=float(config.get("recognition_cache_ttl_secs", 60))
+    )
+
+    #botocore retries are turned off; RekognitionCaller retries and slows down on its own.
+    rekognition = recognition.RekognitionCaller(
+        warmruntime.get_client('rekognition', pool_size + int(config.get("face_search_workers", 4)),
+                               max_attempts=1),
+        tps=float(config.get("rekognition_tps", 50)),
+        max_retries=int(config.get("rekognition_max_retries", 5)),
+        acquire_timeout_secs=float(config.get("rekognition_acquire_timeout_secs", 10))
+    )
+
     #### label_watch_sns_topic_arn = config.get("label_watch_sns_topic_arn", "")
 
-    # Retrieve the SNS topic ARN from the environment variable
-    label_watch_sns_topic_arn = os.environ.get('SNS_TOPIC_ARN')
-    collection_id = config['rekognition_col_name']
-
-    #Iterate on frames fetched from Kinesis
-    for record in event['Records']:
-
-        frame_package_b64 = record['kinesis']['data']
-        frame_package = pickle.loads(base64.b64decode(frame_package_b64))
-
-        img_bytes = frame_package["ImageBytes"]
-        approx_capture_ts = frame_package["ApproximateCaptureTime"]
-        frame_count = frame_package["FrameCount"]
-        
-        now_ts = time.time()
-
-        frame_id = str(uuid.uuid4())
-        processed_timestamp = Decimal(now_ts)
-        approx_capture_timestamp = Decimal(approx_capture_ts)
-        
-        now = convert_ts(now_ts, config)
-        year = now.strftime("%Y")
-        mon = now.strftime("%m")
-        day = now.strftime("%d")
-        hour = now.strftime("%H")
-
-        #Store frame image in S3
-        s3_key = (s3_key_frames_root + '{}/{}/{}/{}/{}.jpg').format(year, mon, day, hour, frame_id)
-        
-        s3_client.put_object(
-            Bucket=s3_bucket,
-            Key=s3_key,
-            Body=img_bytes
+    return {
+        'config': config,
+        'max_concurrency': max_concurrency,
+        'rekognition': rekognition,
+        'faces': facesearch.FaceSearcher(
+            rekognition,
+            config['rekognition_col_name'],
+            threshold=40,
+            mode=config.get("face_search_mode", "largest"),
+            max_faces=int(config.get("face_search_max_faces", 5)),
+            min_face_px=int(config.get("face_search_min_face_px", 24)),
+            max_workers=int(config.get("face_search_workers", 4))
+        ),
+        'dead_letters': deadletter.S3DeadLetterStore(
+            warmruntime.get_client('s3', pool_size),
+            config["s3_bucket"],
+            config["s3_key_dead_letter_root"]
+        ) if config.get("s3_key_dead_letter_root") else None,
+        'archiver': archive.FrameArchiver(
+            warmruntime.get_client('s3', pool_size),
+            config["s3_bucket"],
+            max_workers=max_concurrency,
+            dedup_window_secs=float(config.get("archive_dedup_window_secs", 300)),
+            hash_mode=config.get("archive_dedup_hash", "content"),
+            max_distance=int(config.get("archive_dedup_max_distance", 4))
+        ),
+        'frame_writer': framewriter.BatchWriter(dynamodb, config["ddb_table"]),
+        'watchlist': watchlist.WatchlistCache(
+            dynamodb,
+            config['ddb_input_image_table'],
+            ttl_secs=float(config.get("watchlist_cache_ttl_secs", 300)),
+            max_entries=int(config.get("watchlist_cache_size", 1024)),
+            version_check_secs=float(config.get("watchlist_version_check_secs", 30))
+        ),
+        'results': recognition_cache,
+        'dedup': alert_dedup,
+        'alerts': alerts.AlertAggregator(
+            warmruntime.get_client('sns', pool_size),
+            # Retrieve the SNS topic ARN from the environment variable
+            os.environ.get('SNS_TOPIC_ARN'),
+            max_alerts_per_message=int(config.get("alert_max_per_message", 20)),
+            max_messages_per_minute=int(config.get("alert_max_messages_per_minute", 10))
         )
+    }
 
-        s3_url = f'https://{s3_bucket}.s3.us-east-1.amazonaws.com/{s3_key}'
 
-        try:
-            rekog_response = rekog_client.search_faces_by_image(
-                CollectionId=collection_id,
-                FaceMatchThreshold=40,
-                Image={
-                    'Bytes': img_bytes
-                }
-            )
-        except Exception as e:
-            #Log error and ignore frame. You might want to add that frame to a dead-letter queue.
-            print(e)
-            return
-            
-
-        if 'FaceMatches' in rekog_response and rekog_response['FaceMatches']:
-            for faces in rekog_response['FaceMatches']:
-                if faces['Face']['ExternalImageId'] not in hash:
-
-                    res = ddb_frame_table.get_item(
-                        Key={
-                            'ID': int(faces['Face']['ExternalImageId'])
-                        }
-                    )
-
-                    notification_txt = 'On {}...\n'.format(now.strftime('%x, %-I:%M %p %Z'))
-
-                    notification_txt += '- "{}" was detected. {}. Click on {} to view the image'.format(
-                        res['Item']['Name'], res['Item']['Message'], s3_url)
-
-                    
-
-                    if label_watch_sns_topic_arn:
-                        resp = sns_client.publish(
-                            TopicArn=label_watch_sns_topic_arn,
-                            Message=notification_txt,
-                            Subject='Felon detected'
-                        )
-
-                    if resp.get("MessageId", ""):
-                        print("Successfully published alert message to SNS.")
-                    hash.add(faces['Face']['ExternalImageId'])
-        
-            #Persist frame data in dynamodb
-
-            item = {
-                'frame_id': frame_id,
-                'processed_timestamp' : processed_timestamp,
-                'approx_capture_timestamp' : approx_capture_timestamp,
-                'processed_year_month' : year + mon, #To be used as a Hash Key for DynamoDB GSI
-                's3_bucket' : s3_bucket,
-                's3_key' : s3_key
-            }
-
-            ddb_table.put_item(Item=item)
-
-    print('Successfully processed {} records.'.format(len(event['Records'])))
-    return
+def process_image(event, context):
+
+    ctx = warmruntime.cached('imageprocessor.context', build_context)
+    max_concurrency = ctx['max_concurrency']
+
+    records = event['Records']
+
+    #Process frames fetched from Kinesis concurrently. Results keep the record order,
+    #and a failed record does not stop the others.
+    if max_concurrency == 1 or len(records) <= 1:
+        results = [run_record(record, ctx) for record in records]
+    else:
+        with ThreadPoolExecutor(max_workers=min(max_concurrency, len(records))) as executor:
+            results = list(executor.map(lambda record: run_record(record, ctx), records))
+
+    #Frames whose image could not be stored in S3 fail, and their metadata and alerts are
+    #taken back so nothing points at the missing object.
+    unarchived = discard_unarchived(ctx, records, results, ctx['archiver'].wait())
+
+    #Frames whose metadata could not be written count as failed too.
+    unwritten = set(item['frame_id'] for item in ctx['frame_writer'].flush())
+    #Alerts are not held over to the next invocation, as the container may not get one.
+    #Frames whose alerts were rate limited or not published count as failed.
+    unalerted = set(id(record) for record in flush_alerts(ctx))
+    failures = []
+    for record, (frame_id, s3_key, error) in zip(records, results):
+        if error is None and frame_id in unarchived:
+            cause = unarchived[frame_id]
+            error = deadletter.FrameError('Could not store frame {} in S3 as {}: {}'.format(frame_id, s3_key, cause),
+                                          'ArchiveFailed', deadletter.is_transient(cause))
+        if error is None and frame_id in unwritten:
+            #BatchWriter gives up on items DynamoDB kept leaving unprocessed, which is a throughput problem
+            error = deadletter.FrameError('Could not write frame metadata for {}'.format(frame_id),
+                                          'UnprocessedItems', True)
+        if error is None and id(record) in unalerted:
+            error = alerts.AlertNotSent('Could not send the alert for frame {}'.format(frame_id))
+        if error is not None:
+            failures.append((record, error))
+
+    unstored = store_failures(ctx, failures)
+
+    print('Frame archive: {}'.format(ctx['archiver'].stats))
+    print('Frame writer: {}'.format(ctx['frame_writer'].stats))
+    print('Watchlist cache: {}'.format(ctx['watchlist'].stats))
+    print('Face search: {}'.format(ctx['faces'].stats))
+    print('Recognition cache: {}, {:.0%} hit rate'.format(ctx['results'].stats, ctx['results'].hit_rate()))
+    print('Rekognition: {}, {:.1f} TPS allowed'.format(ctx['rekognition'].stats, ctx['rekognition'].current_tps()))
+
+    print('Successfully processed {} of {} records.'.format(len(records) - len(failures), len(records)))
+
+    #Records that were neither processed nor dead-lettered are reported back, and Lambda
+    #retries the batch from the first of them.
+    return {
+        'batchItemFailures': [{'itemIdentifier': record['kinesis']['sequenceNumber']} for record in unstored]
+    }
 
 def handler(event, context):
-    return process_image(event, context)
\ No newline at end of file
+    return process_image(event, context)
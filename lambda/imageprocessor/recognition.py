@@ -0,0 +1,118 @@
+from __future__ import print_function
+import random
+import threading
+import time
+
+from botocore.exceptions import ClientError, BotoCoreError
+
+from ratelimit import TokenBucket
+
+THROTTLING_ERRORS = (
+    'ThrottlingException',
+    'ProvisionedThroughputExceededException',
+    'LimitExceededException',
+    'TooManyRequestsException',
+)
+TRANSIENT_ERRORS = (
+    'InternalServerError',
+    'ServiceUnavailableException',
+    'ServiceUnavailable',
+)
+
+
+class RekognitionError(Exception):
+    '''A Rekognition call that failed for good. retryable tells whether replaying the frame later may help.'''
+
+    def __init__(self, message, code=None, retryable=False):
+        Exception.__init__(self, message)
+        self.code = code
+        self.retryable = retryable
+
+
+def error_code(e):
+    if isinstance(e, ClientError):
+        return e.response.get('Error', {}).get('Code')
+    return None
+
+
+class RekognitionCaller(object):
+    '''Calls Rekognition through a token bucket matched to the account's TPS quota.
+
+    Throttled calls are retried with full-jitter exponential backoff, and each
+    throttle halves the bucket's rate (down to min_tps); every success adds
+    back tps / 20, up to tps. Service-side failures are retried the same way
+    without slowing down. Anything else, such as an invalid image, raises
+    RekognitionError at once. Pass a client created with botocore retries
+    turned off, so attempts are not multiplied.'''
+
+    def __init__(self, client, tps=50, min_tps=1, max_retries=5, backoff_secs=0.1, max_backoff_secs=5.0,
+                 acquire_timeout_secs=10.0):
+        self.client = client
+        self.tps = float(tps)
+        self.min_tps = float(min(min_tps, tps))
+        self.max_retries = max_retries
+        self.backoff_secs = backoff_secs
+        self.max_backoff_secs = max_backoff_secs
+        self.acquire_timeout_secs = acquire_timeout_secs
+        self.limiter = TokenBucket(self.tps, max(1.0, self.tps))
+        self._lock = threading.Lock()
+        self.stats = {
+            'calls': 0,
+            'throttled': 0,
+            'retried': 0,
+            'failed': 0,
+        }
+
+    def current_tps(self):
+        return self.limiter.rate
+
+    def _throttled(self):
+        with self._lock:
+            self.stats['throttled'] += 1
+            self.limiter.set_rate(max(self.min_tps, self.limiter.rate / 2))
+
+    def _succeeded(self):
+        with self._lock:
+            self.stats['calls'] += 1
+            if self.limiter.rate < self.tps:
+                self.limiter.set_rate(min(self.tps, self.limiter.rate + self.tps / 20))
+
+    def _failed(self, message, code, retryable):
+        with self._lock:
+            self.stats['failed'] += 1
+        raise RekognitionError(message, code, retryable)
+
+    def call(self, operation, **kwargs):
+        '''Runs client.<operation>(**kwargs) within the rate limit, retrying throttles and service errors.'''
+        attempt = 0
+        while True:
+            if not self.limiter.acquire(timeout=self.acquire_timeout_secs):
+                self._failed('Timed out waiting for Rekognition capacity', 'RateLimited', True)
+            try:
+                response = getattr(self.client, operation)(**kwargs)
+                self._succeeded()
+                return response
+            except ClientError as e:
+                code = error_code(e)
+                if code in THROTTLING_ERRORS:
+                    self._throttled()
+                elif code not in TRANSIENT_ERRORS:
+                    self._failed(str(e), code, False)
+                last_error = e
+            except BotoCoreError as e:
+                #Connection and read timeouts
+                code = type(e).__name__
+                last_error = e
+
+            attempt += 1
+            if attempt > self.max_retries:
+                self._failed(str(last_error), code, True)
+            with self._lock:
+                self.stats['retried'] += 1
+            time.sleep(random.uniform(0, min(self.max_backoff_secs, self.backoff_secs * (2 ** attempt))))
+
+    def search_faces_by_image(self, **kwargs):
+        return self.call('search_faces_by_image', **kwargs)
+
+    def detect_faces(self, **kwargs):
+        return self.call('detect_faces', **kwargs)
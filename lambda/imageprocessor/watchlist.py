@@ -0,0 +1,139 @@
+from __future__ import print_function
+import random
+import threading
+import time
+from collections import OrderedDict
+
+# Item in the watchlist metadata table whose "Version" attribute is bumped by
+# application.py whenever people are enrolled. Real entries use IDs derived from
+# their photo, see enrollment.watchlist_id; older ones used the enrollment time.
+WATCHLIST_VERSION_ID = 0
+
+# BatchGetItem limit
+MAX_KEYS_PER_REQUEST = 100
+
+
+class WatchlistCache(object):
+    '''Container-level cache of watchlist metadata (Name, Message) keyed by ExternalImageId.
+
+    Misses are loaded together with BatchGetItem. Entries expire after
+    ttl_secs, the least recently used are evicted beyond max_entries, and the
+    whole cache is dropped when the watchlist version stamp changes. The stamp
+    is re-read at most every version_check_secs, in the same request as any
+    misses when there are some.'''
+
+    def __init__(self, dynamodb, table_name, ttl_secs=300, max_entries=1024, version_check_secs=30,
+                 max_retries=5):
+        self.dynamodb = dynamodb
+        self.table_name = table_name
+        self.ttl_secs = ttl_secs
+        self.max_entries = max_entries
+        self.version_check_secs = version_check_secs
+        self.max_retries = max_retries
+        self.version = None
+        self._version_checked_at = 0.0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'requests': 0,
+            'invalidations': 0,
+        }
+
+    def current_version(self):
+        '''The watchlist version stamp, re-read when version_check_secs have passed since the last check.'''
+        self.get_many([])
+        return self.version
+
+    def get_many(self, external_image_ids):
+        '''Returns {ExternalImageId: item} for the ids that are on the watchlist.
+
+        Items still being enrolled (claimed, without a Name yet) are left out.'''
+        now = time.time()
+        found = {}
+        missing = []
+        with self._lock:
+            for external_image_id in set(external_image_ids):
+                entry = self._entries.get(external_image_id)
+                if entry is not None and entry[1] > now:
+                    self._entries.move_to_end(external_image_id)
+                    found[external_image_id] = entry[0]
+                else:
+                    missing.append(external_image_id)
+            self.stats['hits'] += len(found)
+            self.stats['misses'] += len(missing)
+            check_version = now - self._version_checked_at >= self.version_check_secs
+
+        if not missing and not check_version:
+            return found
+
+        keys = [{'ID': int(external_image_id)} for external_image_id in missing]
+        if check_version:
+            keys.append({'ID': WATCHLIST_VERSION_ID})
+        items = self._batch_get(keys)
+        stale = []
+
+        with self._lock:
+            if check_version:
+                version_item = next((item for item in items if int(item['ID']) == WATCHLIST_VERSION_ID), {})
+                version = int(version_item.get('Version', 0))
+                if self.version is not None and version != self.version:
+                    # A person was enrolled or changed; everything cached may be stale.
+                    self.stats['invalidations'] += 1
+                    self._entries.clear()
+                    stale = list(found)
+                    found = {}
+                self.version = version
+                self._version_checked_at = now
+
+            for item in items:
+                if int(item['ID']) == WATCHLIST_VERSION_ID:
+                    continue
+                if 'Name' not in item:
+                    # Only claimed by an enrollment still in progress; treat it as a miss
+                    # and don't cache it, so the finished entry is read next time.
+                    continue
+                external_image_id = str(item['ID'])
+                self._entries[external_image_id] = (item, now + self.ttl_secs)
+                self._entries.move_to_end(external_image_id)
+                found[external_image_id] = item
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+        if stale:
+            # The hits came from before the version changed; load them again.
+            found.update(self.get_many(stale))
+        return found
+
+    def _batch_get(self, keys):
+        items = []
+        for i in range(0, len(keys), MAX_KEYS_PER_REQUEST):
+            request = {
+                self.table_name: {
+                    'Keys': keys[i:i + MAX_KEYS_PER_REQUEST],
+                    'ProjectionExpression': 'ID, #name, Message, Version',
+                    'ExpressionAttributeNames': {'#name': 'Name'}
+                }
+            }
+            attempt = 0
+            while request:
+                with self._lock:
+                    self.stats['requests'] += 1
+                response = self.dynamodb.batch_get_item(RequestItems=request)
+                items.extend(response.get('Responses', {}).get(self.table_name, []))
+                request = response.get('UnprocessedKeys') or None
+                if request:
+                    attempt += 1
+                    if attempt > self.max_retries:
+                        print('Giving up on {} unprocessed watchlist keys.'.format(
+                            len(request[self.table_name]['Keys'])))
+                        break
+                    time.sleep(random.uniform(0, min(1.0, 0.05 * (2 ** attempt))))
+        return items
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.version = None
+            self._version_checked_at = 0.0
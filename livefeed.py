@@ -0,0 +1,244 @@
+'''Live feed of new detections for the web app.
+
+One background thread per process reads new EnrichedFrame items from a
+tailer and keeps the latest ones in memory. Browser clients wait on that
+buffer through server-sent events or long polling. However many clients are
+connected, DynamoDB is read by that one thread only.
+
+Tailers have one method, read(timeout), which returns the items that arrived
+since the last call. It returns an empty list once timeout seconds pass without
+any. DynamoStreamTailer reads the table's DynamoDB stream. LocalTailer is an
+in-process stand-in for development and benchmarks.'''
+import collections
+import decimal
+import json
+import queue
+import threading
+import time
+
+from boto3.dynamodb.types import TypeDeserializer
+from botocore.exceptions import ClientError
+
+
+def _json_default(o):
+    if isinstance(o, decimal.Decimal):
+        return int(o) if o == o.to_integral_value() else float(o)
+    raise TypeError('Object of type {} is not JSON serializable'.format(type(o).__name__))
+
+
+class LocalTailer(object):
+    '''Hands out items given to publish(), standing in for a DynamoDB stream.'''
+
+    def __init__(self):
+        self._queue = queue.Queue()
+
+    def publish(self, item):
+        self._queue.put(item)
+
+    def read(self, timeout):
+        items = []
+        try:
+            items.append(self._queue.get(timeout=timeout))
+            while True:
+                items.append(self._queue.get_nowait())
+        except queue.Empty:
+            return items
+
+
+class DynamoStreamTailer(object):
+    '''Reads inserted and modified items from a DynamoDB stream with a NEW_IMAGE view.
+
+    Reading starts at the newest record of every open shard. Shards that open
+    later are read from their start, so no record written after the first read
+    is skipped. The shard list is refreshed every refresh_secs and whenever a
+    shard closes. Every shard is read at most once per poll_secs, which keeps
+    within the 5 GetRecords calls per second a shard allows.'''
+
+    def __init__(self, streams_client, stream_arn, poll_secs=0.5, refresh_secs=60):
+        self.client = streams_client
+        self.stream_arn = stream_arn
+        self.poll_secs = poll_secs
+        self.refresh_secs = refresh_secs
+        self._deserializer = TypeDeserializer()
+        self._iterators = {}
+        self._known = set()
+        self._refreshed = None
+        self.stats = {'requests': 0, 'records': 0, 'expired': 0}
+
+    def _shards(self):
+        shards = []
+        kwargs = {'StreamArn': self.stream_arn}
+        while True:
+            self.stats['requests'] += 1
+            description = self.client.describe_stream(**kwargs)['StreamDescription']
+            shards.extend(description['Shards'])
+            if not description.get('LastEvaluatedShardId'):
+                return shards
+            kwargs['ExclusiveStartShardId'] = description['LastEvaluatedShardId']
+
+    def _refresh(self):
+        first = self._refreshed is None
+        for shard in self._shards():
+            shard_id = shard['ShardId']
+            if shard_id in self._known:
+                continue
+            self._known.add(shard_id)
+            if first and 'EndingSequenceNumber' in shard['SequenceNumberRange']:
+                #Closed before we started, so it holds nothing new
+                continue
+            self.stats['requests'] += 1
+            self._iterators[shard_id] = self.client.get_shard_iterator(
+                StreamArn=self.stream_arn,
+                ShardId=shard_id,
+                ShardIteratorType='LATEST' if first else 'TRIM_HORIZON'
+            )['ShardIterator']
+        self._refreshed = time.time()
+
+    def _reset(self):
+        '''Starts again from the newest records, after iterators expired.'''
+        self.stats['expired'] += 1
+        self._iterators = {}
+        self._known = set()
+        self._refreshed = None
+
+    def _read_shard(self, shard_id, items):
+        try:
+            self.stats['requests'] += 1
+            response = self.client.get_records(ShardIterator=self._iterators[shard_id], Limit=1000)
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ExpiredIteratorException':
+                self._reset()
+                return False
+            raise
+        for record in response['Records']:
+            if record['eventName'] in ('INSERT', 'MODIFY') and 'NewImage' in record['dynamodb']:
+                image = record['dynamodb']['NewImage']
+                items.append(dict((name, self._deserializer.deserialize(value)) for name, value in image.items()))
+                self.stats['records'] += 1
+        if response.get('NextShardIterator'):
+            self._iterators[shard_id] = response['NextShardIterator']
+        else:
+            #The shard closed; its children show up in the next refresh
+            del self._iterators[shard_id]
+            self._refreshed = 0
+        return True
+
+    def read(self, timeout):
+        deadline = time.time() + timeout
+        while True:
+            started = time.time()
+            if self._refreshed is None or started - self._refreshed >= self.refresh_secs:
+                self._refresh()
+            items = []
+            for shard_id in list(self._iterators):
+                if not self._read_shard(shard_id, items):
+                    break
+            now = time.time()
+            if items or now >= deadline:
+                return items
+            time.sleep(max(0.0, min(self.poll_secs - (now - started), deadline - now)))
+
+
+class FeedHub(object):
+    '''Fans out the items read by one tailer thread to any number of waiting clients.
+
+    Each item is turned into an event once: transform(item) gives the dict that
+    is sent, and it is serialized to JSON in the reader thread. Events get
+    increasing ids. The last history events are kept, so a client that
+    reconnects with the id of the last event it saw gets what it missed.'''
+
+    def __init__(self, tailer, transform=None, history=500, read_timeout=1.0):
+        self.tailer = tailer
+        self.transform = transform
+        self.read_timeout = read_timeout
+        self._events = collections.deque(maxlen=history)
+        self._last_id = 0
+        self._cond = threading.Condition()
+        self._thread = None
+        self.stats = {'read': 0, 'events': 0, 'errors': 0, 'clients': 0}
+
+    def start(self):
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='livefeed-reader')
+                self._thread.daemon = True
+                self._thread.start()
+        return self
+
+    def _run(self):
+        backoff = 1.0
+        while True:
+            try:
+                items = self.tailer.read(self.read_timeout)
+                backoff = 1.0
+            except Exception as e:
+                #Keep the feed alive through outages; clients see no events until it recovers
+                print('Live feed read failed, retrying in {:.0f} s: {}'.format(backoff, e))
+                self.stats['errors'] += 1
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 30.0)
+                continue
+            self.stats['read'] += len(items)
+            if items:
+                self.publish(items)
+
+    def publish(self, items):
+        items = sorted(items, key=lambda item: item.get('processed_timestamp', 0))
+        payloads = [json.dumps(self.transform(item) if self.transform else item, default=_json_default)
+                    for item in items]
+        with self._cond:
+            for payload in payloads:
+                self._last_id += 1
+                self._events.append((self._last_id, payload))
+            self.stats['events'] += len(payloads)
+            self._cond.notify_all()
+
+    def client_count(self, change=0):
+        '''Adds change to the number of connected streaming clients and returns it.'''
+        with self._cond:
+            self.stats['clients'] += change
+            return self.stats['clients']
+
+    def last_id(self):
+        with self._cond:
+            return self._last_id
+
+    def events_after(self, last_id, timeout):
+        '''Waits up to timeout seconds for events newer than last_id.
+
+        Returns (events, gap). events is a list of (id, JSON payload). gap is True
+        when events the client has not seen were already dropped from the history.'''
+        with self._cond:
+            if self._last_id <= last_id:
+                self._cond.wait_for(lambda: self._last_id > last_id, timeout)
+            events = [event for event in self._events if event[0] > last_id]
+            gap = bool(events) and events[0][0] > last_id + 1 and last_id > 0
+            return events, gap
+
+
+def sse_stream(hub, last_id, stream_secs=300, heartbeat_secs=15):
+    '''Server-sent events for a client that saw events up to last_id.
+
+    The stream ends after stream_secs so long-lived connections do not pile up
+    on the web server. Browsers reconnect by themselves and send the id of the
+    last event they got. A comment line every heartbeat_secs keeps proxies
+    from closing an idle connection. The client is counted in hub.client_count()
+    while the stream runs.'''
+    hub.client_count(1)
+    try:
+        yield 'retry: 2000\n\n'
+        deadline = time.time() + stream_secs
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return
+            events, gap = hub.events_after(last_id, min(heartbeat_secs, remaining))
+            if not events:
+                yield ': keep-alive\n\n'
+                continue
+            if gap:
+                yield 'event: gap\ndata: {}\n\n'
+            yield ''.join('id: {}\ndata: {}\n\n'.format(event_id, payload) for event_id, payload in events)
+            last_id = events[-1][0]
+    finally:
+        hub.client_count(-1)